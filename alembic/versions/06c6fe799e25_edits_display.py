@@ -0,0 +1,99 @@
+"""edits display, compressed and by lang and rev_id
+
+Revision ID: 06c6fe799e25
+Revises: 0a0dbee959f8
+Create Date: 2026-10-18 14:05:12.481530
+
+"""
+import json
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# revision identifiers, used by Alembic.
+revision = '06c6fe799e25'
+down_revision = '0a0dbee959f8'
+branch_labels = None
+depends_on = None
+
+# the edits columns that move into edits_display's compressed payload
+MOVED_COLUMNS = {'diffHTML': mysql.MEDIUMTEXT(), 'newRevComment': sa.TEXT(), 'oldRevComment': sa.TEXT()}
+PAYLOAD_KEYS = ['diffHTML', 'newRevComment', 'oldRevComment']
+
+
+# the payload format as of this revision, kept here so later changes to display_store don't change it
+def compress(data):
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'zlib', zlib.compress(data, 6)
+
+
+def decompress(codec, blob):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('this display data was compressed with zstd, pip install zstandard to read it')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    if codec == 'zlib':
+        return zlib.decompress(blob)
+    raise ValueError(f'unknown codec {codec}')
+
+
+def upgrade():
+    edits_display = op.create_table('edits_display',
+    sa.Column('lang', sa.String(length=16), autoincrement=False, nullable=False),
+    sa.Column('rev_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('page_title', sa.TEXT(), nullable=True),
+    sa.Column('new_rev_date', sa.String(length=32), nullable=True),
+    sa.Column('new_rev_user', sa.String(length=255), nullable=True),
+    sa.Column('old_rev_id', sa.Integer(), nullable=True),
+    sa.Column('old_rev_date', sa.String(length=32), nullable=True),
+    sa.Column('old_rev_user', sa.String(length=255), nullable=True),
+    sa.Column('codec', sa.String(length=8), nullable=True),
+    sa.Column('payload', sa.LargeBinary().with_variant(mysql.MEDIUMBLOB(), 'mysql'), nullable=True),
+    sa.PrimaryKeyConstraint('lang', 'rev_id'),
+    mysql_charset='utf8',
+    mysql_collate='utf8_general_ci',
+    mysql_engine='InnoDB'
+    )
+
+    # the display data already in edits, once per (lang, rev_id)
+    rows = op.get_bind().execute(sa.text(
+        """select lang, rev_id, page_name, newRevDate, newRevUser, oldRevId, oldRevDate, oldRevUser,
+                  diffHTML, newRevComment, oldRevComment
+           from edits where diffHTML is not null"""))
+    display_rows = {}
+    for row in rows.mappings():
+        codec, payload = compress(json.dumps({key: row[key] for key in PAYLOAD_KEYS}).encode('utf-8'))
+        display_rows[(row['lang'], row['rev_id'])] = {
+            'lang': row['lang'], 'rev_id': row['rev_id'], 'page_title': row['page_name'],
+            'new_rev_date': row['newRevDate'], 'new_rev_user': row['newRevUser'], 'old_rev_id': row['oldRevId'],
+            'old_rev_date': row['oldRevDate'], 'old_rev_user': row['oldRevUser'], 'codec': codec, 'payload': payload}
+    if display_rows:
+        op.bulk_insert(edits_display, list(display_rows.values()))
+
+    for column_name in MOVED_COLUMNS:
+        op.drop_column('edits', column_name)
+
+
+def downgrade():
+    for column_name, column_type in MOVED_COLUMNS.items():
+        op.add_column('edits', sa.Column(column_name, column_type, nullable=True))
+
+    con = op.get_bind()
+    rows = con.execute(sa.text('select lang, rev_id, codec, payload from edits_display'))
+    for row in rows.mappings():
+        payload = json.loads(decompress(row['codec'], row['payload']).decode('utf-8'))
+        con.execute(sa.text("""update edits set diffHTML = :diffHTML, newRevComment = :newRevComment,
+                                                oldRevComment = :oldRevComment
+                               where lang = :lang and rev_id = :rev_id"""),
+                    dict(payload, lang=row['lang'], rev_id=row['rev_id']))
+
+    op.drop_table('edits_display')
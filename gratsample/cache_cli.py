@@ -0,0 +1,171 @@
+"""
+command line tools for the make_cached_df cache, installed as gratsample-cache.
+
+    gratsample-cache stats
+    gratsample-cache gc recent_edits active_users --dry-run
+    gratsample-cache gc timestamps --max-mb 2000
+    gratsample-cache migrate ../cache/edithistory edithistory --cache-root ../cache
+"""
+import argparse
+import json
+import os
+import time
+
+from gratsample import cached_df
+from gratsample.cached_df import open_store, SERIALIZER_BY_EXTENSION, SqliteBackend, read_policy, \
+    collect_garbage
+
+
+def iter_pickle_dir(pickle_dir, skipped=None):
+    """yield ((key, serializer_name, bytes, manifest), source_paths) for every cache file in `pickle_dir`,
+    source_paths being the file and its manifest if it has one.
+    files without a known extension are the old make_cached_df pickles, keyed by the repr of their
+    arguments. nothing looks those keys up anymore, so they're left alone and added to `skipped`"""
+    for fname in sorted(os.listdir(pickle_dir)):
+        path = os.path.join(pickle_dir, fname)
+        key, extension = os.path.splitext(fname)
+        if (extension == '.json' or fname.startswith('.') or fname.startswith(SqliteBackend.db_name)
+                or not os.path.isfile(path)):
+            continue
+        serializer = SERIALIZER_BY_EXTENSION.get(extension)
+        if serializer is None:
+            if skipped is not None:
+                skipped.append(path)
+            continue
+        manifest_path = os.path.join(pickle_dir, key + '.json')
+        source_paths = [path]
+        if os.path.exists(manifest_path):
+            manifest = json.load(open(manifest_path, 'r'))
+            source_paths.append(manifest_path)
+        else:
+            manifest = {'migrated_from': path}
+        with open(path, 'rb') as f:
+            yield (key, serializer.name, f.read(), manifest), source_paths
+
+
+def migrate_pickle_dir(pickle_dir, cache_sub_dir, cache_root=None, batch_size=1000, delete=False):
+    """import every entry of a one-file-per-entry cache dir into the sqlite store of `cache_sub_dir`.
+    `delete` removes the files that were imported once they all are, anything skipped stays"""
+    store = open_store(cache_sub_dir, backend='sqlite', cache_root=cache_root)
+    migrated = 0
+    imported_paths = []
+    batch = []
+    batch_paths = []
+    skipped = []
+    for entry, source_paths in iter_pickle_dir(pickle_dir, skipped):
+        batch.append(entry)
+        batch_paths += source_paths
+        if len(batch) >= batch_size:
+            store.put_raw_many(batch)
+            migrated += len(batch)
+            imported_paths += batch_paths
+            batch, batch_paths = [], []
+    if batch:
+        store.put_raw_many(batch)
+        migrated += len(batch)
+        imported_paths += batch_paths
+
+    if skipped:
+        print(f'skipped {len(skipped)} files without a known extension, their keys can no longer be looked up:')
+        for path in skipped:
+            print(f'  {path}')
+    if delete:
+        for path in imported_paths:
+            os.remove(path)
+    return migrated
+
+
+def namespace_stores(cache_root):
+    """(namespace, store) for every backend that has entries under `cache_root`"""
+    for namespace in sorted(os.listdir(cache_root)):
+        cache_dir = os.path.join(cache_root, namespace)
+        if not os.path.isdir(cache_dir):
+            continue
+        fnames = os.listdir(cache_dir)
+        if SqliteBackend.db_name in fnames:
+            yield namespace, open_store(namespace, backend='sqlite', cache_root=cache_root)
+        if any(os.path.splitext(fname)[1] in SERIALIZER_BY_EXTENSION for fname in fnames):
+            yield namespace, open_store(namespace, backend='files', cache_root=cache_root)
+
+
+def format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            return f'{nbytes:.1f}{unit}'
+        nbytes /= 1024
+    return f'{nbytes:.1f}TB'
+
+
+def format_age(seconds):
+    return '-' if seconds is None else f'{seconds / 86400:.1f}d'
+
+
+def print_stats(cache_root):
+    now = time.time()
+    print(f"{'namespace':<20}{'backend':<9}{'entries':>10}{'size':>12}{'oldest':>9}{'newest':>9}"
+          f"{'idle':>9}  policy")
+    for namespace, store in namespace_stores(cache_root):
+        entries = list(store.entries())
+        policy = read_policy(store.cache_dir)
+        print(f"{namespace:<20}{store.name:<9}{len(entries):>10}"
+              f"{format_bytes(sum(entry[1] for entry in entries)):>12}"
+              f"{format_age(now - min(entry[2] for entry in entries) if entries else None):>9}"
+              f"{format_age(now - max(entry[2] for entry in entries) if entries else None):>9}"
+              f"{format_age(now - max(entry[3] for entry in entries) if entries else None):>9}"
+              f"  ttl={format_age(policy['ttl_seconds'])} "
+              f"max={format_bytes(policy['max_bytes']) if policy['max_bytes'] else '-'}")
+
+
+def run_gc(cache_root, namespaces=None, ttl_days=None, max_mb=None, dry_run=False):
+    """apply each namespace's saved policy, or the ttl/size given on the command line instead"""
+    for namespace, store in namespace_stores(cache_root):
+        if namespaces and namespace not in namespaces:
+            continue
+        policy = read_policy(store.cache_dir)
+        ttl_seconds = ttl_days * 86400 if ttl_days is not None else policy['ttl_seconds']
+        max_bytes = max_mb * 2 ** 20 if max_mb is not None else policy['max_bytes']
+        if ttl_seconds is None and max_bytes is None:
+            continue
+        dropped = collect_garbage(store, ttl_seconds=ttl_seconds, max_bytes=max_bytes, dry_run=dry_run)
+        verb = 'would drop' if dry_run else 'dropped'
+        print(f'{namespace} ({store.name}): {verb} {len(dropped)} entries, '
+              f'{format_bytes(sum(nbytes for _, nbytes in dropped))}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gratsample-cache', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    stats_parser = subparsers.add_parser('stats', help='size, entry count and age of every namespace')
+    gc_parser = subparsers.add_parser('gc', help='drop expired and least recently used entries')
+    gc_parser.add_argument('namespaces', nargs='*', help='defaults to every namespace')
+    gc_parser.add_argument('--ttl-days', type=float, default=None, help="instead of the namespace's ttl")
+    gc_parser.add_argument('--max-mb', type=float, default=None, help="instead of the namespace's size cap")
+    gc_parser.add_argument('--dry-run', action='store_true')
+    for subparser in (stats_parser, gc_parser):
+        subparser.add_argument('--cache-root', default=None,
+                               help=f'defaults to CACHE_DIR ({cached_df.CACHE_ROOT})')
+
+    migrate_parser = subparsers.add_parser('migrate', help='import a directory of pickles into a sqlite store')
+    migrate_parser.add_argument('pickle_dir')
+    migrate_parser.add_argument('cache_sub_dir')
+    migrate_parser.add_argument('--cache-root', default=None,
+                                help=f'defaults to CACHE_DIR ({cached_df.CACHE_ROOT})')
+    migrate_parser.add_argument('--delete', action='store_true', help='remove the files once imported')
+
+    args = parser.parse_args(argv)
+    if args.command == 'stats':
+        print_stats(args.cache_root or cached_df.CACHE_ROOT)
+    elif args.command == 'gc':
+        run_gc(args.cache_root or cached_df.CACHE_ROOT, namespaces=args.namespaces, ttl_days=args.ttl_days,
+               max_mb=args.max_mb, dry_run=args.dry_run)
+    elif args.command == 'migrate':
+        migrated = migrate_pickle_dir(args.pickle_dir, args.cache_sub_dir, cache_root=args.cache_root,
+                                      delete=args.delete)
+        print(f'migrated {migrated} entries from {args.pickle_dir} into {args.cache_sub_dir}')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,671 @@
+import contextlib
+import datetime
+import functools
+import hashlib
+import inspect
+import io
+import json
+import logging
 import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locking off posix
+    fcntl = None
+
+import numpy as np
 import pandas as pd
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
 
 CACHE_ROOT = os.getenv("CACHE_DIR", 'cache')
+# default byte budget of the in-process tier in front of every cache, 0 turns it off
+CACHE_MEMORY_BYTES = int(os.getenv("CACHE_MEMORY_BYTES", 0))
+# sequences longer than this are summarized in manifests instead of written out
+MANIFEST_MAX_ITEMS = 100
+
+
+class PickleSerializer():
+    """the original on-disk format, works for any DataFrame"""
+    name = 'pickle'
+    extension = '.pickle'
+
+    def dump(self, df, path):
+        df.to_pickle(path)
+
+    def load(self, path):
+        return pd.read_pickle(path)
+
+    def dumps(self, df):
+        return pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, value):
+        return pickle.loads(value)
+
+
+class ParquetSerializer():
+    """typed columnar format, much faster to load and smaller on disk for big frames.
+    needs pyarrow, and the frame's columns have to be arrow-typeable (no mixed python objects)"""
+    name = 'parquet'
+    extension = '.parquet'
+
+    def dump(self, df, path):
+        df.to_parquet(path, engine='pyarrow', index=True)
+
+    def load(self, path):
+        return pd.read_parquet(path, engine='pyarrow')
+
+    def dumps(self, df):
+        buf = io.BytesIO()
+        df.to_parquet(buf, engine='pyarrow', index=True)
+        return buf.getvalue()
+
+    def loads(self, value):
+        return pd.read_parquet(io.BytesIO(value), engine='pyarrow')
+
+
+SERIALIZERS = {'pickle': PickleSerializer(),
+               'parquet': ParquetSerializer()}
+SERIALIZER_BY_EXTENSION = {serializer.extension: serializer for serializer in SERIALIZERS.values()}
+
+
+def _callable_name(fn):
+    return f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', repr(fn))}"
+
+
+def _hash_arg(hasher, arg):
+    """feed a stable representation of `arg` into `hasher`.
+    str() isn't good enough because numpy and pandas shorten the repr of anything large"""
+    if hasattr(arg, 'cache_token'):
+        hasher.update(b'token:' + str(arg.cache_token()).encode('utf-8'))
+    elif isinstance(arg, Engine):
+        # repr of the url hides the password, and which server we talk to is all that matters
+        hasher.update(b'engine:' + repr(arg.url).encode('utf-8'))
+    elif isinstance(arg, pd.DataFrame):
+        hasher.update(b'dataframe:' + repr(list(arg.columns)).encode('utf-8'))
+        hasher.update(repr([str(dtype) for dtype in arg.dtypes]).encode('utf-8'))
+        hasher.update(pd.util.hash_pandas_object(arg, index=True).values.tobytes())
+    elif isinstance(arg, (pd.Series, pd.Index)):
+        hasher.update(f'{type(arg).__name__}:{arg.dtype}:'.encode('utf-8'))
+        hasher.update(pd.util.hash_pandas_object(arg).values.tobytes())
+    elif isinstance(arg, np.ndarray):
+        hasher.update(f'ndarray:{arg.dtype.str}:{arg.shape}:'.encode('utf-8'))
+        if arg.dtype == object:
+            for item in arg.ravel():
+                _hash_arg(hasher, item)
+        else:
+            hasher.update(np.ascontiguousarray(arg).tobytes())
+    elif isinstance(arg, np.generic):
+        # so that a user_id pulled out of df.values keys the same as a plain int
+        _hash_arg(hasher, arg.item())
+    elif isinstance(arg, (datetime.datetime, datetime.date)):
+        hasher.update(b'datetime:' + arg.isoformat().encode('utf-8'))
+    elif isinstance(arg, datetime.timedelta):
+        hasher.update(b'timedelta:' + repr(arg.total_seconds()).encode('utf-8'))
+    elif isinstance(arg, (list, tuple, set, frozenset)):
+        items = sorted(arg, key=repr) if isinstance(arg, (set, frozenset)) else arg
+        hasher.update(f'{type(arg).__name__}:{len(items)}:'.encode('utf-8'))
+        for item in items:
+            _hash_arg(hasher, item)
+    elif isinstance(arg, dict):
+        hasher.update(f'dict:{len(arg)}:'.encode('utf-8'))
+        for k in sorted(arg, key=repr):
+            _hash_arg(hasher, k)
+            _hash_arg(hasher, arg[k])
+    elif callable(arg):
+        hasher.update(b'callable:' + _callable_name(arg).encode('utf-8'))
+    else:
+        hasher.update(f'{type(arg).__name__}:{arg!r}'.encode('utf-8'))
+    hasher.update(b'|')
+
+
+def _content_hash(arg):
+    hasher = hashlib.blake2b(digest_size=16)
+    _hash_arg(hasher, arg)
+    return hasher.hexdigest()
+
+
+def _summary(arg):
+    """what the manifest keeps of a big argument, its contents are already in the key's hash"""
+    summary = {'type': type(arg).__name__, 'length': len(arg), 'hash': _content_hash(arg)}
+    if isinstance(arg, pd.DataFrame):
+        summary['columns'] = [str(column) for column in arg.columns]
+    return summary
+
+
+def _jsonable(arg):
+    """turn an argument into something json can store in the manifest.
+    frames, arrays and long sequences are only summarized, a manifest per entry with 100k rev_ids each adds up"""
+    if hasattr(arg, 'cache_token'):
+        return str(arg.cache_token())
+    if isinstance(arg, Engine):
+        return repr(arg.url)
+    if isinstance(arg, (pd.DataFrame, pd.Series, pd.Index, np.ndarray)):
+        return _summary(arg)
+    if isinstance(arg, np.generic):
+        return arg.item()
+    if isinstance(arg, (datetime.datetime, datetime.date)):
+        return arg.isoformat()
+    if isinstance(arg, (str, int, float, bool)) or arg is None:
+        return arg
+    if isinstance(arg, (list, tuple, set, frozenset)):
+        if len(arg) > MANIFEST_MAX_ITEMS:
+            return _summary(arg)
+        items = sorted(arg, key=repr) if isinstance(arg, (set, frozenset)) else arg
+        return [_jsonable(item) for item in items]
+    if isinstance(arg, dict):
+        return {str(k): _jsonable(v) for k, v in arg.items()}
+    if callable(arg):
+        return _callable_name(arg)
+    return repr(arg)
+
+
+def bind_arguments(fn, args, kwargs):
+    """name every argument the way `fn` sees it, so f(1, b=2) and f(1, 2) are the same call"""
+    bound = inspect.signature(fn).bind(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.arguments
+
+
+def make_cache_key(fn, arguments):
+    """the function name plus a content hash of its (named) arguments"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(_callable_name(fn).encode('utf-8') + b'|')
+    for name, value in arguments.items():
+        hasher.update(name.encode('utf-8') + b'=')
+        _hash_arg(hasher, value)
+    return f'{fn.__name__}_{hasher.hexdigest()}'
+
+
+def make_manifest(fn, arguments, serializer):
+    return {'function': _callable_name(fn),
+            'serializer': serializer.name,
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'arguments': {name: _jsonable(value) for name, value in arguments.items()}}
+
+
+class KeyLocks():
+    """single-flight locking per cache key. a thread lock makes callers in this process
+    wait on one computation, and an flock on the key's own lock file does the same for
+    other processes sharing CACHE_DIR. the lock file is removed when it's released, so
+    whoever opened it in the meantime checks it's still the one in place and retries if not"""
+
+    def __init__(self, cache_dir):
+        self.lock_dir = os.path.join(cache_dir, '.locks')
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._thread_locks = {}
+        self._guard = threading.Lock()
+
+    @contextlib.contextmanager
+    def _file_lock(self, key):
+        if fcntl is None:
+            yield
+            return
+        path = os.path.join(self.lock_dir, f'{key}.lock')
+        while True:
+            lock_file = open(path, 'a')
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        try:
+            yield
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    @contextlib.contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._thread_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0], self._file_lock(key):
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._thread_locks[key]
+
+
+def write_policy(cache_dir, ttl_seconds, max_bytes):
+    """store the lifecycle policy of a sub-dir next to its entries so gratsample-cache can find it"""
+    policy = {'ttl_seconds': ttl_seconds, 'max_bytes': max_bytes}
+    policy_path = os.path.join(cache_dir, '.policy.json')
+    if read_policy(cache_dir) != policy:
+        with open(policy_path, 'w') as f:
+            json.dump(policy, f)
+
+
+def read_policy(cache_dir):
+    try:
+        return json.load(open(os.path.join(cache_dir, '.policy.json'), 'r'))
+    except FileNotFoundError:
+        return {'ttl_seconds': None, 'max_bytes': None}
+
+
+class FileBackend():
+    """one file per entry, with its json manifest next to it, in the sub-dir.
+    files are written to a temp name and renamed into place so readers never see half an entry"""
+    name = 'files'
+
+    def __init__(self, cache_dir, serializer):
+        self.cache_dir = cache_dir
+        self.serializer = serializer
+        self.ttl_seconds = None
+        self.max_bytes = None
+        os.makedirs(cache_dir, exist_ok=True)
+        self.locks = KeyLocks(cache_dir)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _atomic_write(self, path, write_fn):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        os.close(fd)
+        try:
+            write_fn(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
 
-def make_cached_df(cache_sub_dir):
+    def get(self, key):
+        path = self._path(key) + self.serializer.extension
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise KeyError(key)
+        if self.ttl_seconds is not None and time.time() - stat.st_mtime > self.ttl_seconds:
+            raise KeyError(key)
+        try:
+            df = self.serializer.load(path)
+        except FileNotFoundError:
+            raise KeyError(key)
+        except Exception as e:
+            logger.warning(f'removing corrupt cache entry {path}: {e!r}')
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            raise KeyError(key)
+        # the access time is what LRU garbage collection goes by, the modification time stays the creation time
+        with contextlib.suppress(OSError):
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        return df
+
+    def put(self, key, df, manifest):
+        def write_manifest(path):
+            with open(path, 'w') as f:
+                json.dump(manifest, f, default=repr)
+
+        # the data goes last, its existence is what makes the entry a hit
+        self._atomic_write(self._path(key) + '.json', write_manifest)
+        self._atomic_write(self._path(key) + self.serializer.extension,
+                           lambda path: self.serializer.dump(df, path))
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            try:
+                found[key] = self.get(key)
+            except KeyError:
+                continue
+        return found
+
+    def put_many(self, entries):
+        for key, df, manifest in entries:
+            self.put(key, df, manifest)
+
+    def entries(self):
+        """(key, bytes, created_at, accessed_at) of every entry, whatever format it was written in"""
+        for fname in os.listdir(self.cache_dir):
+            key, extension = os.path.splitext(fname)
+            if fname.startswith('.') or extension not in SERIALIZER_BY_EXTENSION:
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, fname))
+            nbytes = stat.st_size
+            with contextlib.suppress(FileNotFoundError):
+                nbytes += os.stat(self._path(key) + '.json').st_size
+            yield key, nbytes, stat.st_mtime, max(stat.st_atime, stat.st_mtime)
+
+    def delete_many(self, keys):
+        for key in keys:
+            for extension in list(SERIALIZER_BY_EXTENSION) + ['.json']:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(key) + extension)
+
+
+class SqliteBackend():
+    """every entry of a sub-dir in a single sqlite database, so a run
+    doesn't leave hundreds of thousands of tiny files behind"""
+    name = 'sqlite'
+    db_name = 'entries.sqlite'
+    # stays under sqlite's limit on the number of bound variables
+    batch_size = 500
+
+    def __init__(self, cache_dir, serializer):
+        self.cache_dir = cache_dir
+        self.serializer = serializer
+        self.ttl_seconds = None
+        self.max_bytes = None
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, self.db_name)
+        self.locks = KeyLocks(cache_dir)
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+
+    def _connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.db_path, timeout=60)
+            con.execute('pragma journal_mode=wal')
+            con.execute("""create table if not exists entries (
+                                key text primary key,
+                                serializer text not null,
+                                value blob not null,
+                                manifest text,
+                                created_at real not null,
+                                accessed_at real)""")
+            columns = [row[1] for row in con.execute('pragma table_info(entries)')]
+            if 'accessed_at' not in columns:
+                con.execute('alter table entries add column accessed_at real')
+            con.commit()
+            self._local.con = con
+        return con
+
+    def _loads(self, serializer_name, value):
+        if serializer_name == self.serializer.name:
+            return self.serializer.loads(value)
+        return SERIALIZERS[serializer_name].loads(value)
+
+    def get(self, key):
+        found = self.get_many([key])
+        if key not in found:
+            raise KeyError(key)
+        return found[key]
+
+    def put(self, key, df, manifest):
+        self.put_many([(key, df, manifest)])
+
+    def get_many(self, keys):
+        con = self._connect()
+        keys = list(keys)
+        now = time.time()
+        oldest = now - self.ttl_seconds if self.ttl_seconds is not None else float('-inf')
+        found = {}
+        for start in range(0, len(keys), self.batch_size):
+            batch = keys[start:start + self.batch_size]
+            rows = con.execute(f"""select key, serializer, value from entries
+                                   where key in ({','.join('?' * len(batch))}) and created_at >= ?""",
+                               batch + [oldest])
+            for key, serializer_name, value in rows.fetchall():
+                try:
+                    found[key] = self._loads(serializer_name, value)
+                except Exception as e:
+                    logger.warning(f'removing corrupt cache entry {key} from {self.db_path}: {e!r}')
+                    with con:
+                        con.execute('delete from entries where key = ?', (key,))
+        if found:
+            with con:
+                con.executemany('update entries set accessed_at = ? where key = ?',
+                                [(now, key) for key in found])
+        return found
+
+    def put_many(self, entries):
+        self.put_raw_many((key, self.serializer.name, self.serializer.dumps(df), manifest)
+                          for key, df, manifest in entries)
+
+    def put_raw_many(self, entries):
+        """write already serialized (key, serializer_name, bytes, manifest) entries in one transaction"""
+        con = self._connect()
+        now = time.time()
+        rows = [(key, serializer_name, sqlite3.Binary(value), json.dumps(manifest, default=repr), now, now)
+                for key, serializer_name, value, manifest in entries]
+        with con:
+            con.executemany("""insert or replace into entries (key, serializer, value, manifest, created_at, accessed_at)
+                               values (?, ?, ?, ?, ?, ?)""", rows)
+
+    def entries(self):
+        """(key, bytes, created_at, accessed_at) of every entry"""
+        rows = self._connect().execute("""select key, length(value) + coalesce(length(manifest), 0),
+                                                 created_at, coalesce(accessed_at, created_at)
+                                          from entries""")
+        return rows.fetchall()
+
+    def delete_many(self, keys):
+        con = self._connect()
+        keys = list(keys)
+        with con:
+            for start in range(0, len(keys), self.batch_size):
+                batch = keys[start:start + self.batch_size]
+                con.execute(f"delete from entries where key in ({','.join('?' * len(batch))})", batch)
+        if keys:
+            # give the space back to the filesystem
+            con.execute('vacuum')
+
+
+def collect_garbage(store, ttl_seconds=None, max_bytes=None, dry_run=False):
+    """drop the entries of `store` older than `ttl_seconds`, then the least recently
+    used ones until it fits in `max_bytes`. returns the (key, bytes) that were dropped"""
+    now = time.time()
+    entries = sorted(store.entries(), key=lambda entry: entry[3])
+    expired = []
+    if ttl_seconds is not None:
+        expired = [entry for entry in entries if now - entry[2] > ttl_seconds]
+        entries = [entry for entry in entries if now - entry[2] <= ttl_seconds]
+    if max_bytes is not None:
+        total_bytes = sum(entry[1] for entry in entries)
+        for entry in entries:
+            if total_bytes <= max_bytes:
+                break
+            expired.append(entry)
+            total_bytes -= entry[1]
+    if not dry_run:
+        store.delete_many([entry[0] for entry in expired])
+    return [(entry[0], entry[1]) for entry in expired]
+
+
+class MemoryLRU():
+    """keeps the most recently used frames in memory up to `max_bytes`,
+    evicting the least recently used ones first. frames are copied on the way
+    in and out because callers add columns to what they get back"""
+
+    def __init__(self, max_bytes, ttl_seconds=None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                df, nbytes, stored_at = self._entries[key]
+                if self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds:
+                    raise KeyError(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return df.copy()
+
+    def put(self, key, df):
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        df = df.copy()
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= self._entries.pop(key)[1]
+            while self._entries and self.used_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes, _) = self._entries.popitem(last=False)
+                self.used_bytes -= evicted_bytes
+                self.evictions += 1
+            self._entries[key] = (df, nbytes, time.time())
+            self.used_bytes += nbytes
+
+    def stats(self):
+        return {'memory_hits': self.hits, 'memory_misses': self.misses, 'memory_evictions': self.evictions,
+                'memory_entries': len(self._entries), 'memory_bytes': self.used_bytes}
+
+
+BACKENDS = {'files': FileBackend,
+            'sqlite': SqliteBackend}
+_open_stores = {}
+_open_stores_lock = threading.Lock()
+
+
+def open_store(cache_sub_dir, backend='sqlite', serializer='pickle', cache_root=None, ttl=None, max_bytes=None):
+    """the keyed store behind a sub-dir of the cache, for callers that manage their own keys.
+    entries older than `ttl` (a timedelta) are misses, and the ttl and `max_bytes`
+    are saved as the sub-dir's policy for gratsample-cache gc.
+    a sub-dir has one store per process, so asking for it with a different policy than it
+    was opened with is a ValueError. opening it without a policy takes whatever it has"""
+    if isinstance(serializer, str):
+        serializer = SERIALIZERS[serializer]
+    cache_dir = os.path.abspath(os.path.join(cache_root or CACHE_ROOT, cache_sub_dir))
+    store_id = (backend, cache_dir, serializer.name)
+    ttl_seconds = ttl.total_seconds() if ttl is not None else None
+    with _open_stores_lock:
+        if store_id not in _open_stores:
+            _open_stores[store_id] = BACKENDS[backend](cache_dir, serializer)
+        store = _open_stores[store_id]
+        if ttl_seconds is None and max_bytes is None:
+            return store
+        if store.ttl_seconds is None and store.max_bytes is None:
+            store.ttl_seconds, store.max_bytes = ttl_seconds, max_bytes
+            write_policy(cache_dir, ttl_seconds, max_bytes)
+        elif (store.ttl_seconds, store.max_bytes) != (ttl_seconds, max_bytes):
+            raise ValueError(f'{cache_dir} is already open with ttl_seconds={store.ttl_seconds} and '
+                             f'max_bytes={store.max_bytes}, not ttl_seconds={ttl_seconds} and max_bytes={max_bytes}')
+        return store
+
+
+# every decorated function by cache sub-dir, so a run can report on all of them
+CACHED_FUNCTIONS = {}
+
+
+def cache_stats():
+    return {cache_sub_dir: fn.cache_stats() for cache_sub_dir, fn in CACHED_FUNCTIONS.items()}
+
+
+def print_cache_stats():
+    for cache_sub_dir, stats in cache_stats().items():
+        print(f'{cache_sub_dir}: ' + ', '.join(f'{k}={v}' for k, v in stats.items()))
+
+
+def make_cached_df(cache_sub_dir, serializer='pickle', backend='files', memory_bytes=None, ttl=None,
+                   max_bytes=None):
     """a decorator who input is a direcotry under env's CACHE_DIR
-    wraps a DataFrame returning function, and uses the repr of the arguments as a keys"""
+    wraps a DataFrame returning function, and uses a content hash of the arguments as a key.
+    the arguments themselves are stored alongside the entry as a manifest.
+    `serializer` is a name from SERIALIZERS or any object with name, extension, dump(s) and load(s),
+    `backend` is 'files' for one file per entry or 'sqlite' for a single database per sub-dir.
+    `memory_bytes` is the budget of an in-process LRU in front of the backend (defaults to CACHE_MEMORY_BYTES).
+    `ttl` (a timedelta) expires entries for functions whose answer depends on "now", and `ttl`
+    and `max_bytes` are what `gratsample-cache gc` enforces for the sub-dir.
+    the wrapped function also gets get_many/put_many for batched lookups and writes, and cache_stats"""
+    if memory_bytes is None:
+        memory_bytes = CACHE_MEMORY_BYTES
+
     # decorator factory
     def cached_df(df_returning_fn):
         # decorator
+        memory = MemoryLRU(memory_bytes, ttl.total_seconds() if ttl is not None else None) if memory_bytes else None
+        counts = {'hits': 0, 'misses': 0}
+
+        def store():
+            return open_store(cache_sub_dir, backend=backend, serializer=serializer, ttl=ttl, max_bytes=max_bytes)
+
+        def key_and_arguments(args, kwargs):
+            arguments = bind_arguments(df_returning_fn, args, kwargs)
+            return make_cache_key(df_returning_fn, arguments), arguments
+
+        @functools.wraps(df_returning_fn)
         def get_with_cache(*args, **kwargs):
             # wrapping function
-            cache_dir = os.path.join(CACHE_ROOT, cache_sub_dir)
-            if not os.path.exists(cache_dir):
-                os.makedirs(cache_dir, exist_ok=True)
-            all_args = args+tuple(kwargs.values())
-            str_args = "_".join([a.__name__ if callable(a) else str(a) for a in all_args])
-            str_args = str_args.replace('/', '___')
-            fname = f'{str_args}'
-            fname = fname[:255] # these can get long
-            cache_key = os.path.join(cache_dir, fname)
+            cache_key, arguments = key_and_arguments(args, kwargs)
+            if memory is not None:
+                try:
+                    return memory.get(cache_key)
+                except KeyError:
+                    pass
+            cache = store()
             try:
-                return pd.read_pickle(cache_key)
-            except FileNotFoundError:
-                df = df_returning_fn(*args, **kwargs)
-                df.to_pickle(cache_key)
-                return df
+                df = cache.get(cache_key)
+                counts['hits'] += 1
+            except KeyError:
+                # only one caller computes a missing key, the others wait and then read its result
+                with cache.locks.hold(cache_key):
+                    try:
+                        df = cache.get(cache_key)
+                        counts['hits'] += 1
+                    except KeyError:
+                        counts['misses'] += 1
+                        df = df_returning_fn(*args, **kwargs)
+                        cache.put(cache_key, df, make_manifest(df_returning_fn, arguments, cache.serializer))
+            if memory is not None:
+                memory.put(cache_key, df)
+            return df
+
+        def get_many(calls):
+            """look up many calls (tuples of positional args) at once,
+            returns a list lined up with `calls` that has None for the misses"""
+            keys = [key_and_arguments(call, {})[0] for call in calls]
+            found = {}
+            if memory is not None:
+                for key in keys:
+                    try:
+                        found[key] = memory.get(key)
+                    except KeyError:
+                        continue
+            from_store = store().get_many([key for key in keys if key not in found])
+            counts['hits'] += len(from_store)
+            counts['misses'] += len(set(keys)) - len(found) - len(from_store)
+            if memory is not None:
+                for key, df in from_store.items():
+                    memory.put(key, df)
+            found.update(from_store)
+            return [found.get(key) for key in keys]
+
+        def put_many(calls, dfs):
+            """store the results of many calls (tuples of positional args) at once"""
+            cache = store()
+            entries = []
+            for call, df in zip(calls, dfs):
+                cache_key, arguments = key_and_arguments(call, {})
+                entries.append((cache_key, df, make_manifest(df_returning_fn, arguments, cache.serializer)))
+                if memory is not None:
+                    memory.put(cache_key, df)
+            cache.put_many(entries)
+
+        def get_cache_stats():
+            stats = {'disk_hits': counts['hits'], 'disk_misses': counts['misses']}
+            if memory is not None:
+                stats.update(memory.stats())
+            return stats
 
+        get_with_cache.get_many = get_many
+        get_with_cache.put_many = put_many
+        get_with_cache.cache_stats = get_cache_stats
+        get_with_cache.cache_sub_dir = cache_sub_dir
+        CACHED_FUNCTIONS[cache_sub_dir] = get_with_cache
         return get_with_cache
 
     return cached_df
@@ -0,0 +1,84 @@
+"""
+get_display_data's results kept by (lang, rev_id) in the edits_display table, so a revision's diff is
+only ever fetched once. the diff html and comments are compressed together with zstd, or zlib when
+zstandard isn't installed, and every row says which.
+
+    display_store = DisplayDataStore(make_internal_db_session())
+    display_data = get_display_data_batched(rev_ids, lang, display_store=display_store)
+"""
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zlib is slower and bigger, but always there
+    zstandard = None
+
+from gratsample.orm_models import edits_display
+
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 6
+# the compressed fields of a display datum, the rest are columns
+PAYLOAD_KEYS = ['diffHTML', 'newRevComment', 'oldRevComment']
+
+
+def compress(data):
+    """(codec, compressed bytes)"""
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return 'zlib', zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(codec, blob):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('this display data was compressed with zstd, pip install zstandard to read it')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    if codec == 'zlib':
+        return zlib.decompress(blob)
+    raise ValueError(f'unknown codec {codec}')
+
+
+def to_row(lang, rev_id, display_datum):
+    codec, payload = compress(json.dumps({key: display_datum[key] for key in PAYLOAD_KEYS}).encode('utf-8'))
+    return edits_display(lang=lang, rev_id=int(rev_id), page_title=display_datum['pageTitle'],
+                         new_rev_date=display_datum['newRevDate'], new_rev_user=display_datum['newRevUser'],
+                         old_rev_id=display_datum['oldRevId'], old_rev_date=display_datum['oldRevDate'],
+                         old_rev_user=display_datum['oldRevUser'], codec=codec, payload=payload)
+
+
+def from_row(row):
+    payload = json.loads(decompress(row.codec, row.payload).decode('utf-8'))
+    return {'editDeleted': False, 'diffHTML': payload['diffHTML'], 'lang': row.lang,
+            'newRevId': row.rev_id, 'newRevDate': row.new_rev_date,
+            'newRevUser': row.new_rev_user, 'newRevComment': payload['newRevComment'],
+            'oldRevId': row.old_rev_id, 'oldRevDate': row.old_rev_date,
+            'oldRevUser': row.old_rev_user, 'oldRevComment': payload['oldRevComment'],
+            'pageTitle': row.page_title}
+
+
+class DisplayDataStore():
+    # rev_ids per `in` lookup
+    batch_size = 500
+
+    def __init__(self, db_session):
+        self.db_session = db_session
+
+    def get_many(self, lang, rev_ids):
+        """{rev_id: display datum} of the rev_ids that are stored"""
+        rev_ids = list(dict.fromkeys(int(rev_id) for rev_id in rev_ids))
+        found = {}
+        for start in range(0, len(rev_ids), self.batch_size):
+            rows = self.db_session.query(edits_display).filter(
+                edits_display.lang == lang,
+                edits_display.rev_id.in_(rev_ids[start:start + self.batch_size]))
+            for row in rows:
+                found[row.rev_id] = from_row(row)
+        return found
+
+    def put_many(self, lang, rev_ids, display_data):
+        """keep the display data of rev_ids. deleted edits aren't kept, they can come back"""
+        for rev_id, display_datum in zip(rev_ids, display_data):
+            if not display_datum['editDeleted']:
+                self.db_session.merge(to_row(lang, rev_id, display_datum))
+        self.db_session.commit()
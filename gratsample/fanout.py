@@ -0,0 +1,125 @@
+"""
+fan the one-query-per-user fetchers out over asyncio instead of waiting a tunnel round trip per user.
+
+    frames = fetch_users(get_total_user_edits, [('fa', 1), ('fa', 2)], start_date, end_date, wmf_con)
+
+the blocking queries run in a thread pool, at most `per_lang_limit` at a time for each language, and the
+jobs are fed through a bounded queue so a big population doesn't turn into a big pile of pending tasks.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sqlalchemy.exc import OperationalError
+
+from gratsample.wikipedia_helpers import lang_con
+
+# queries in flight per wiki, the replicas cap connections per account
+FANOUT_PER_LANG = int(os.getenv('FANOUT_PER_LANG', 4))
+FANOUT_RETRIES = int(os.getenv('FANOUT_RETRIES', 3))
+
+
+async def _run_jobs(jobs, fetch_fn, per_lang_limit, retries, backoff_seconds, queue_size):
+    langs = sorted(set(job[0] for job in jobs))
+    lang_semaphores = {lang: asyncio.Semaphore(per_lang_limit) for lang in langs}
+    num_workers = per_lang_limit * len(langs)
+    queue = asyncio.Queue(maxsize=queue_size or 2 * num_workers)
+    results = [None] * len(jobs)
+    loop = asyncio.get_running_loop()
+
+    async def fetch_with_retries(job):
+        for attempt in range(retries + 1):
+            try:
+                async with lang_semaphores[job[0]]:
+                    return await loop.run_in_executor(executor, fetch_fn, *job)
+            except OperationalError as e:
+                # the tunnel and the replicas drop connections now and then, the pool pings and reconnects
+                if attempt == retries:
+                    raise
+                print(f'{job}: {e}, retry {attempt + 1} of {retries}')
+                await asyncio.sleep(backoff_seconds * 2 ** attempt)
+
+    async def worker():
+        while True:
+            position, job = await queue.get()
+            try:
+                results[position] = await fetch_with_retries(job)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                queue.task_done()
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        workers = [asyncio.ensure_future(worker()) for _ in range(num_workers)]
+        try:
+            for position, job in enumerate(jobs):
+                if errors:
+                    break
+                # waits while the queue is full, that's the backpressure
+                await queue.put((position, job))
+            await queue.join()
+        finally:
+            for unfinished in workers:
+                unfinished.cancel()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_jobs(jobs, fetch_fn, per_lang_limit=None, retries=None, backoff_seconds=1, queue_size=None):
+    """
+    fetch_fn(*job) for every job, where job[0] is the language. blocking calls are made from a thread
+    pool with at most per_lang_limit per language in flight, transient OperationalErrors are retried
+    with exponential backoff. returns the results lined up with `jobs`.
+    called from inside a running event loop, like a notebook cell's, asyncio.run can't start another
+    one in that thread, so the fan-out gets a loop of its own in a helper thread and this blocks until it's done
+    """
+    jobs = [tuple(job) for job in jobs]
+    if not jobs:
+        return []
+    per_lang_limit = per_lang_limit or FANOUT_PER_LANG
+    retries = FANOUT_RETRIES if retries is None else retries
+    fan_out = _run_jobs(jobs, fetch_fn, per_lang_limit, retries, backoff_seconds, queue_size)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(fan_out)
+    with ThreadPoolExecutor(max_workers=1) as loop_thread:
+        return loop_thread.submit(asyncio.run, fan_out).result()
+
+
+def fetch_users(cached_fn, lang_user_ids, *args, **runner_kwargs):
+    """
+    call a make_cached_df fetcher whose signature starts (lang, user_id, ...) for many users, with
+    `args` as the rest of its positional arguments. the cache is read in one batch and only the misses
+    go to the replicas, through run_jobs. they go through cached_fn itself, so a key another fan-out
+    (or process) is already computing is waited for rather than queried twice, and each is written as it comes.
+    returns the frames lined up with `lang_user_ids`
+    """
+    calls = [(lang, user_id) + args for lang, user_id in lang_user_ids]
+    dfs = cached_fn.get_many(calls)
+    missing_positions = [position for position, df in enumerate(dfs) if df is None]
+    if missing_positions:
+        start = time.time()
+        missing_calls = [calls[position] for position in missing_positions]
+        fetched = run_jobs(missing_calls, cached_fn, **runner_kwargs)
+        for position, df in zip(missing_positions, fetched):
+            dfs[position] = df
+        print(f'{cached_fn.cache_sub_dir}: fetched {len(missing_calls)} of {len(calls)} in {time.time() - start:.1f}s')
+    return dfs
+
+
+def run_user_queries(lang_user_ids, sql, wmf_con, params=None, **runner_kwargs):
+    """
+    run a query template for many (lang, user_id) jobs through run_jobs. `sql` is a sqlalchemy.text
+    with a :user_id parameter, `params` are its other parameters.
+    returns the frames lined up with `lang_user_ids`
+    """
+    def query_user(lang, user_id):
+        with lang_con(wmf_con, lang) as con:
+            return pd.read_sql(sql, con, params=dict(params or {}, user_id=int(user_id)))
+
+    return run_jobs(lang_user_ids, query_user, **runner_kwargs)
@@ -0,0 +1,82 @@
+"""
+per-user feature columns built up over the make_data stages and joined onto the population once,
+instead of a one-row DataFrame per user and a merge per stage.
+
+    accumulator = FeatureAccumulator()
+    add_thanks(df, ..., accumulator=accumulator)
+    add_total_edits(df, ..., accumulator=accumulator)
+    df = accumulator.join(df)
+"""
+import threading
+
+import numpy as np
+import pandas as pd
+
+KEY_COLS = ['lang', 'user_id']
+
+
+class FeatureAccumulator():
+    def __init__(self):
+        self.col_names = []
+        # col_name -> [(langs, user_ids, values)] of arrays, and (col_name, lang) -> ([user_id], [value])
+        # for the scalars appended one user at a time
+        self.chunks = {}
+        self.scalars = {}
+        # the stages append from a thread per language
+        self.lock = threading.Lock()
+
+    def _see(self, col_name):
+        if col_name not in self.chunks:
+            self.col_names.append(col_name)
+            self.chunks[col_name] = []
+
+    def add(self, col_name, lang, user_ids, values):
+        """a whole language's values of col_name at once"""
+        user_ids = np.asarray(user_ids)
+        with self.lock:
+            self._see(col_name)
+            if not len(user_ids):
+                # an empty chunk would turn the user_ids into floats when concatenated
+                return
+            self.chunks[col_name].append((np.full(len(user_ids), lang, dtype=object), user_ids, np.asarray(values)))
+
+    def append(self, col_name, lang, user_id, value):
+        """one user's value of col_name"""
+        with self.lock:
+            self._see(col_name)
+            user_ids, values = self.scalars.setdefault((col_name, lang), ([], []))
+            user_ids.append(user_id)
+            values.append(value)
+
+    def append_frame(self, lang, user_id, user_df):
+        """every feature column of a one-row per-user frame, like the ones the per-user caches hold"""
+        for col_name in user_df.columns:
+            if col_name not in KEY_COLS:
+                self.append(col_name, lang, user_id, user_df[col_name].iloc[0])
+
+    def column(self, col_name):
+        """col_name as a Series indexed by (lang, user_id)"""
+        with self.lock:
+            chunks = list(self.chunks[col_name])
+            chunks += [(np.full(len(user_ids), lang, dtype=object), np.asarray(user_ids), np.asarray(values))
+                       for (scalar_col_name, lang), (user_ids, values) in self.scalars.items()
+                       if scalar_col_name == col_name]
+        if not chunks:
+            return pd.Series([], index=pd.MultiIndex.from_arrays([[], []], names=KEY_COLS), name=col_name,
+                             dtype=float)
+        index = pd.MultiIndex.from_arrays([np.concatenate([chunk[0] for chunk in chunks]),
+                                           np.concatenate([chunk[1] for chunk in chunks])], names=KEY_COLS)
+        series = pd.Series(np.concatenate([chunk[2] for chunk in chunks]), index=index, name=col_name)
+        return series[~series.index.duplicated(keep='last')]
+
+    def frame(self):
+        """all the features, one row per (lang, user_id)"""
+        if not self.col_names:
+            return pd.DataFrame(columns=KEY_COLS)
+        return pd.concat([self.column(col_name) for col_name in self.col_names], axis=1).reset_index()
+
+    def join(self, df, how='left'):
+        """the one merge of every feature onto df"""
+        if not self.col_names:
+            return df
+        return pd.merge(df, self.frame(), how=how, on=KEY_COLS)
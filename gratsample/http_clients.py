@@ -0,0 +1,88 @@
+"""
+one long-lived client per host for the HTTP APIs, so the thousands of per-user calls reuse kept-alive
+connections (and the ORES thread pool) instead of a new session, TLS handshake and thread start-up each.
+
+    session = get_mwapi_session(f'https://{lang}.wikipedia.org')
+    scores = get_ores_session().score('fawiki', ('damaging', 'goodfaith'), rev_ids)
+
+the thread pools that fan requests out are shared the same way, by name. everything is closed at
+interpreter exit, or by close_clients().
+"""
+import atexit
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mwapi
+import requests
+import requests.adapters
+
+from gratsample import ores_api
+
+USER_AGENT = 'CivilServant Experiment Sampler <max.klein@civilservant.io>'
+ORES_HOST = 'https://ores.wikimedia.org'
+# parallel ORES requests, and connections kept alive per MediaWiki host
+ORES_PARALLEL_REQUESTS = int(os.getenv('ORES_PARALLEL_REQUESTS', 4))
+MWAPI_POOL_SIZE = int(os.getenv('MWAPI_POOL_SIZE', 8))
+
+_clients = {}
+# the kwargs each client was made with
+_client_kwargs = {}
+_clients_lock = threading.Lock()
+
+
+def _get_or_make(key, make_client, client_kwargs=None):
+    """the client for `key`, made the first time. asking again with kwargs other than
+    the ones it was made with is a ValueError, asking without any takes it as it is"""
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = make_client()
+            _client_kwargs[key] = client_kwargs or {}
+        elif client_kwargs and client_kwargs != _client_kwargs[key]:
+            raise ValueError(f'{key} was already made with {_client_kwargs[key]}, not {client_kwargs}')
+        return _clients[key]
+
+
+def get_ores_session(host=ORES_HOST, **session_kwargs):
+    """the ores_api.Session for `host`. without session_kwargs it's whichever session was made first"""
+    def make_session():
+        return ores_api.Session(host, user_agent=USER_AGENT,
+                                **dict({'parallel_requests': ORES_PARALLEL_REQUESTS}, **session_kwargs))
+
+    return _get_or_make(('ores', host), make_session, session_kwargs)
+
+
+def get_mwapi_session(host, user_agent=USER_AGENT, pool_size=None):
+    """the mwapi.Session for `host`, with a connection pool big enough for pool_size parallel calls"""
+    def make_session():
+        pool_maxsize = pool_size or MWAPI_POOL_SIZE
+        requests_session = requests.Session()
+        requests_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize))
+        requests_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize))
+        return mwapi.Session(host, user_agent=user_agent, session=requests_session)
+
+    return _get_or_make(('mwapi', host), make_session)
+
+
+def get_executor(name, max_workers):
+    """a thread pool shared by every call that fans out `name` requests, max_workers only counts the first time"""
+    return _get_or_make(('executor', name), lambda: ThreadPoolExecutor(max_workers=max_workers,
+                                                                         thread_name_prefix=name))
+
+
+def close_clients():
+    """close every client's connections and thread pool, the next call for a host makes a new one"""
+    with _clients_lock:
+        clients = list(_clients.items())
+        _clients.clear()
+        _client_kwargs.clear()
+    for (kind, host), client in clients:
+        if kind == 'ores':
+            client.close()
+        elif kind == 'executor':
+            client.shutdown(wait=True)
+        else:
+            client.session.close()
+
+
+atexit.register(close_clients)
@@ -2,10 +2,9 @@ import sqlalchemy
 import yaml
 
 from gratsample.sample_thankees import make_populations, remove_inactive_users, add_experience_bin, add_edits_fn, \
-    remove_with_min_edit_count, add_thanks, add_has_email_currently, add_num_quality, \
-    stratified_subsampler
+    remove_with_min_edit_count, stratified_subsampler, make_feature_pipeline
 from gratsample.sample_thankees_revision_utils import get_recent_edits_alias
-from gratsample.wikipedia_helpers import to_wmftimestamp, make_wmf_con, namespace_all, namespace_mainonly, namespace_nontalk
+from gratsample.wikipedia_helpers import to_wmftimestamp, make_wmf_con, lang_con
 
 import os
 import pandas as pd
@@ -28,13 +27,13 @@ def sample_thankees_group_oriented(lang, db_con):
     # remove users w/ < n edits
     # remove editors in
 
-@make_cached_df('active_users')
+# the onboarder asks for users active up to utcnow, so these go stale
+@make_cached_df('active_users', ttl=timedelta(days=1))
 def get_active_users(lang, start_date, end_date, min_rev_id, wmf_con):
     """
     Return the first and last edits of only active users in `lang`wiki
     between the start_date and end_date.
     """
-    wmf_con.execute(f'use {lang}wiki_p;')
 
     active_sql = """select user_id, user_name, user_registration, user_editcount as live_edit_count
                         from (select distinct(rev_user) from revision 
@@ -45,7 +44,9 @@ def get_active_users(lang, start_date, end_date, min_rev_id, wmf_con):
     params = {"start_date":int(to_wmftimestamp(start_date)),
               "end_date":int(to_wmftimestamp(end_date)),
               "min_rev_id":min_rev_id}
-    active_df = pd.read_sql(active_sql_esc, con=wmf_con, params=params)
+    # not streamed: the query only returns users active in the window, and every row and column is kept
+    with lang_con(wmf_con, lang) as con:
+        active_df = pd.read_sql(active_sql_esc, con=con, params=params)
     return active_df
 
 
@@ -57,11 +58,17 @@ def output_bin_stats(df):
 
 
 
+# the pipeline columns the onboarder needs, the sim's edit windows aren't known yet at onboarding
+ONBOARD_COLUMNS = ['num_prev_thanks_in_90_pre_treatment', 'has_email', 'num_quality_pre_treatment',
+                   'num_quality_pre_treatment_non_talk', 'num_quality_pre_treatment_main_only']
+
+
 def make_data(subsample, wikipedia_start_date, sim_treatment_date, sim_observation_start_date, sim_experiment_end_date,
-              wmf_con):
+              wmf_con, columns=None):
     print('starting to make data')
-    df = make_populations(start_date=wikipedia_start_date, end_date=sim_treatment_date, wmf_con=wmf_con)
-    df = remove_inactive_users(df, start_date=sim_observation_start_date, end_date=sim_treatment_date)
+    df = make_populations(start_date=wikipedia_start_date, end_date=sim_treatment_date, wmf_con=wmf_con,
+                          chunk_filter=lambda span_df: remove_inactive_users(span_df, start_date=sim_observation_start_date,
+                                                                             end_date=sim_treatment_date))
     if not subsample:
         output_bin_stats(df)
     df = add_experience_bin(df)
@@ -86,20 +93,10 @@ def make_data(subsample, wikipedia_start_date, sim_treatment_date, sim_observati
     print('Second Random Stratified subsample to Get Edit Quality Data')
     print(df.groupby(['lang','experience_level_pre_treatment']).size())
 
-    print("adding thanks")
-    df = add_thanks(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
-                    col_name='num_prev_thanks_in_90_pre_treatment', wmf_con=wmf_con)
-
-    print("adding email")
-    df = add_has_email_currently(df, wmf_con=wmf_con)
-
-    print("adding quality")
-    df = add_num_quality(df, col_name='num_quality_pre_treatment', wmf_con=wmf_con, namespace_fn=namespace_all, end_date=sim_treatment_date)
-    print("adding quality nontalk")
-    df = add_num_quality(df, col_name='num_quality_pre_treatment_non_talk', namespace_fn=namespace_nontalk, end_date=sim_treatment_date, wmf_con=wmf_con)
-    print("adding quality main only")
-    df = add_num_quality(df, col_name='num_quality_pre_treatment_main_only', namespace_fn=namespace_mainonly, end_date=sim_treatment_date, wmf_con=wmf_con)
-
+    print('adding thanks, email and quality')
+    pipeline = make_feature_pipeline(wikipedia_start_date, sim_treatment_date, sim_observation_start_date,
+                                     sim_experiment_end_date, wmf_con)
+    df = pipeline.run(df, columns=columns or ONBOARD_COLUMNS)
     print('done')
     return df
 
@@ -128,8 +125,7 @@ class thankeeOnboarder():
         - add emailable status
         """
         for lang in self.langs.keys():
-            print('db')
-            print(self.wmf_con.execute('show databases;'))
+            self.wmf_con.ping(lang)
             df = get_active_users(lang, start_date=self.onboarding_earliest_active_date,
                                   end_date=self.onboarding_latest_active_date,
                                   min_rev_id=self.langs[lang]['min_rev_id'],
@@ -2,24 +2,236 @@
 This module provides a :class:`ores.api.Session` class that can maintain a
 client connection to an instance of ORES and efficiently generate scores.
 
-Batching and parallelism are set by constructor arguments.
+Batching and parallelism are set by constructor arguments.  Scores can be kept
+in a :class:`ScoreStore` so a revision is only ever scored once per model
+version.  :func:`Session.predictions` is a faster way to get just the
+predictions of binary models, as arrays.
 
 .. autoclass:: ores.api.Session
     :members:
 """
+import itertools
+import json
 import logging
+import os
+import random
+import sqlite3
+import threading
 import time
 import traceback
 import urllib.parse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+import numpy as np
 import requests
 import requests.adapters
 from more_itertools import chunked
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:  # the fast path still works, with the slower decoder
+    _loads = json.loads
+
 logger = logging.getLogger(__name__)
 
 
+class ScoreStore:
+    """
+    A sqlite database of scores keyed by (context, model, model_version,
+    rev_id).  A score for a fixed revision and model version never changes, so
+    they can be kept across calls and runs.
+
+    :Parameters:
+        path : str
+            The sqlite file to keep the scores in
+    """
+    # stays under sqlite's limit on the number of bound variables
+    batch_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # sqlite connections can't be shared between threads
+        self._local = threading.local()
+
+    def _connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=60)
+            con.execute('pragma journal_mode=wal')
+            con.execute("""create table if not exists scores (
+                               context text not null,
+                               model text not null,
+                               model_version text not null,
+                               rev_id integer not null,
+                               score text not null,
+                               primary key (context, model, model_version, rev_id)
+                           ) without rowid""")
+            con.commit()
+            self._local.con = con
+        return con
+
+    def get_many(self, context, model_versions, rev_ids):
+        """
+        Look up the stored scores of many revisions at once.
+
+        :Parameters:
+            context : str
+                The name of the context -- usually the database name of a wiki
+            model_versions : `dict`
+                The version of every model to look up, by model name
+            rev_ids : `iterable`
+                The revision IDs to look up
+
+        :Returns:
+            A `dict` of rev_id to a score document like the ones
+            :func:`~ores.api.Session.score` generates, for the revisions that
+            have a score stored for every model
+        """
+        con = self._connect()
+        found = {}
+        with con:
+            con.execute('create temp table if not exists lookup_rev_ids (rev_id integer primary key)')
+            con.execute('delete from lookup_rev_ids')
+            con.executemany('insert or ignore into lookup_rev_ids (rev_id) values (?)',
+                            ((int(rev_id),) for rev_id in rev_ids))
+            for model, model_version in model_versions.items():
+                rows = con.execute("""select scores.rev_id, scores.score from lookup_rev_ids
+                                      join scores on scores.rev_id = lookup_rev_ids.rev_id
+                                      where context = ? and model = ? and model_version = ?""",
+                                   (context, model, str(model_version)))
+                for rev_id, score in rows:
+                    found.setdefault(rev_id, {})[model] = json.loads(score)
+            con.execute('delete from lookup_rev_ids')
+        return {rev_id: score_doc for rev_id, score_doc in found.items()
+                if len(score_doc) == len(model_versions)}
+
+    def put_many(self, context, model_versions, rev_id_scores):
+        """
+        Store the scores of many revisions at once.  Models that errored
+        instead of scoring are left out, so they're retried next time.
+
+        :Parameters:
+            context : str
+                The name of the context -- usually the database name of a wiki
+            model_versions : `dict`
+                The version of every model that was scored, by model name
+            rev_id_scores : `iterable`
+                (rev_id, score document) pairs
+        """
+        rows = [(context, model, str(model_versions[model]), int(rev_id), json.dumps(model_score))
+                for rev_id, score_doc in rev_id_scores
+                for model, model_score in score_doc.items()
+                if model in model_versions and 'score' in model_score]
+        con = self._connect()
+        with con:
+            con.executemany("""insert or replace into scores (context, model, model_version, rev_id, score)
+                               values (?, ?, ?, ?, ?)""", rows)
+
+
+class Throttled(RuntimeError):
+    """ORES answered 429 or 503, `retry_after` is how long it asked us to wait"""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TransientError(RuntimeError):
+    """A request that failed in a way that's worth retrying as is, like a
+    dropped connection or a 5xx"""
+
+
+class TokenBucket:
+    """
+    Lets `rate` requests per second through on average, and up to `burst` at
+    once after a quiet spell.  A `rate` of None lets everything through.
+    """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        if self.rate is None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class AdaptiveConcurrency:
+    """
+    An additive-increase, multiplicative-decrease limit on the requests in
+    flight.  Every success raises the limit by about one per limit's worth of
+    requests, every throttle multiplies it by `decrease`.
+    """
+    def __init__(self, initial, minimum=1, maximum=None, decrease=0.5):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.decrease = decrease
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def succeeded(self):
+        with self.condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class LatencyHistogram:
+    """Counts of request latencies in seconds by outcome, in fixed buckets."""
+    bounds = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, seconds, outcome='ok'):
+        bucket = next(bound for bound in self.bounds if seconds <= bound)
+        with self.lock:
+            outcome_counts = self.counts.setdefault(outcome, dict.fromkeys(self.bounds, 0))
+            outcome_counts[bucket] += 1
+
+    def total(self, outcome=None):
+        with self.lock:
+            return sum(sum(outcome_counts.values()) for counted, outcome_counts in self.counts.items()
+                       if outcome is None or counted == outcome)
+
+    def __str__(self):
+        with self.lock:
+            return "\n".join("{0}: {1}".format(outcome, ", ".join(
+                "<={0}s {1}".format(bound, count) for bound, count in outcome_counts.items() if count))
+                for outcome, outcome_counts in sorted(self.counts.items()))
+
+
 class Session:
     """
     Constructs a session with an ORES API and provides facilities for scoring
@@ -33,28 +245,66 @@ class Session:
         batch_size : int
             The number of scores to batch per request.
         parallel_request : int
-            The maximum number of requests to make in parallel
+            The maximum number of requests to make in parallel.  Fewer are
+            made while ORES is throttling.
         retries : int
-            The maximum number of retries for basic HTTP errors before giving
-            up
+            The maximum number of retries of throttled requests, and of
+            connection errors and 5xx responses, before giving up
+        requests_per_second : float
+            Send requests no faster than this, on average
+        target_latency : float
+            Halve the batch size when a request takes longer than this many
+            seconds, is throttled or fails transiently, and grow it back to `batch_size` when requests
+            are fast again
+        backoff_seconds : float
+            The wait before the first retry of a failed request, doubled (and
+            jittered) for each retry after that
+        score_store : :class:`ScoreStore`
+            Where to look scores up before requesting them, and to keep the
+            new ones
+        batches_in_flight : int
+            The number of batches to keep submitted per parallel request, the
+            rest of the revisions aren't read until there's room
     """
     DEFAULT_USERAGENT = "ores.api default user-agent"
+    # revisions looked up in the score store at a time
+    store_window = 10000
 
     def __init__(self, host, user_agent=None, session=None,
-                 retries=5, batch_size=50, parallel_requests=4):
+                 retries=5, batch_size=50, parallel_requests=4,
+                 score_store=None, batches_in_flight=2,
+                 requests_per_second=None, target_latency=10,
+                 backoff_seconds=1):
         self.host = str(host)
+        self.retries = int(retries)
         if session is not None:
             self._session = session
         else:
-            self.retries = int(retries)
-
             self._session = requests.Session()
+            # a kept-alive connection for every parallel request.  The
+            # adapter doesn't retry, connection errors, 5xx and throttling
+            # are all retried by _controlled_score_request so the
+            # concurrency limit and backoff see them
             self._session.mount(self.host,
-                                requests.adapters.HTTPAdapter(max_retries=retries))
+                                requests.adapters.HTTPAdapter(max_retries=0,
+                                                              pool_maxsize=int(parallel_requests)))
 
         self.batch_size = int(batch_size)
+        self.max_batch_size = self.batch_size
         self.workers = int(parallel_requests)
+        # made on the first score() and reused by every call after it
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.batches_in_flight = int(batches_in_flight)
+        self.target_latency = target_latency
+        self.backoff_seconds = backoff_seconds
+        self.rate_limiter = TokenBucket(requests_per_second)
+        self.concurrency = AdaptiveConcurrency(self.workers)
+        self.latencies = LatencyHistogram()
+        self._batch_size_lock = threading.Lock()
         self.headers = {}
+        self.score_store = score_store
+        self._model_versions = {}
 
         if user_agent is None:
             logger.warning("Sending requests with default User-Agent.  " +
@@ -64,7 +314,7 @@ class Session:
         else:
             self.headers['User-Agent'] = user_agent
 
-    def score(self, context, models, revids):
+    def score(self, context, models, revids, ordered=True):
         """
         Genetate scores for model applied to a sequence of revisions.
 
@@ -74,46 +324,338 @@ class Session:
             models : `iterable`
                 The names of a models to apply
             revids : `iterable`
-                A sequence of revision IDs to score.
+                A sequence of revision IDs to score.  It's read lazily, so it
+                can be a generator over more revisions than fit in memory.
+            ordered : bool
+                Generate the scores in the order of `revids`.  When False,
+                (rev_id, score) pairs are generated as their batches finish.
+        """
+        if isinstance(revids, int):
+            rev_ids = [revids]
+        else:
+            rev_ids = (int(rid) for rid in revids)
+        models = list(models)
+
+        if self.score_store is None:
+            rev_id_scores = self._score(context, models, rev_ids, ordered)
+        else:
+            rev_id_scores = self._score_with_store(context, models, rev_ids,
+                                                   ordered)
+        if ordered:
+            return (score for _, score in rev_id_scores)
+        return rev_id_scores
+
+    def predictions(self, context, models, revids, probabilities=False):
+        """
+        Get the predictions of binary models for a sequence of revisions as
+        columns, without building a score document per revision.  Responses
+        are decoded with orjson when it's installed.
+
+        :Parameters:
+            context : str
+                The name of the context -- usually the database name of a wiki
+            models : `iterable`
+                The names of binary models to apply
+            revids : `iterable`
+                A sequence of revision IDs to score
+            probabilities : bool
+                Also return the probability of True for every model
+
+        :Returns:
+            A `dict` of numpy arrays lined up with `revids`: 'rev_id',
+            'scored' (False where any model errored), a boolean array of
+            predictions for every model (False where it errored), and
+            '<model>_probability' float arrays (NaN where it errored) when
+            `probabilities` is set
         """
+        models = list(models)
         if isinstance(revids, int):
             rev_ids = [revids]
         else:
-            rev_ids = [int(rid) for rid in revids]
+            rev_ids = (int(rid) for rid in revids)
+        if self.score_store is None:
+            rev_id_predictions = self._score(context, models, rev_ids,
+                                             compact=True)
+        else:
+            rev_id_predictions = self._score_with_store(context, models,
+                                                        rev_ids, True,
+                                                        compact=True)
+
+        rev_id_list = []
+        model_predictions = [[] for _ in models]
+        model_probabilities = [[] for _ in models]
+        for rev_id, predictions in rev_id_predictions:
+            rev_id_list.append(rev_id)
+            for position, (prediction, probability) in enumerate(predictions):
+                model_predictions[position].append(prediction)
+                model_probabilities[position].append(probability)
 
-        return self._score(context, models, rev_ids)
+        columns = {'rev_id': np.array(rev_id_list, dtype=np.int64)}
+        scored = np.ones(len(rev_id_list), dtype=bool)
+        for model, predictions in zip(models, model_predictions):
+            # None is an error
+            model_scored = np.array([prediction is not None for prediction in predictions], dtype=bool)
+            scored &= model_scored
+            columns[model] = np.array([bool(prediction) for prediction in predictions], dtype=bool)
+        columns['scored'] = scored
+        if probabilities:
+            for model, model_probability in zip(models, model_probabilities):
+                columns[model + '_probability'] = np.array(model_probability, dtype=float)
+        return columns
 
-    def _score(self, context, models, rev_ids):
-        logging.debug("Starting up thread pool with {0} workers"
-                      .format(self.workers))
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            future_rev_ids = []  # A list of future results and the revids
+    @staticmethod
+    def _compact_score(score_doc, models):
+        """(prediction, probability of True) for every model of a score
+        document, (None, NaN) for the models that errored"""
+        compact = []
+        for model in models:
+            try:
+                model_score = score_doc[model]['score']
+                compact.append((bool(model_score['prediction']),
+                                float(model_score.get('probability', {}).get('true', float('nan')))))
+            except (KeyError, TypeError):
+                compact.append((None, float('nan')))
+        return tuple(compact)
 
-            # This loop loads all rev_id_batch's into the executor for
-            # processing
-            for rev_id_batch in chunked(rev_ids, self.batch_size):
-                rev_id_batch = list(rev_id_batch)
+    @staticmethod
+    def _expand_compact(compact, models):
+        """the score document of a binary model's compact score, for the
+        score store"""
+        score_doc = {}
+        for model, (prediction, probability) in zip(models, compact):
+            if prediction is None:
+                score_doc[model] = {'error': 'not scored'}
+                continue
+            model_score = {'prediction': prediction}
+            if probability == probability:  # not NaN
+                model_score['probability'] = {'true': probability, 'false': 1 - probability}
+            score_doc[model] = {'score': model_score}
+        return score_doc
+
+    def model_versions(self, context, models):
+        """
+        The version of every model in a context, requested once per session.
+
+        :Returns:
+            A `dict` of model name to version
+        """
+        missing = [model for model in models
+                   if (context, model) not in self._model_versions]
+        if missing:
+            url = self.host + "/v3/scores/{0}/".format(urllib.parse.quote(context))
+            params = {'models': "|".join(urllib.parse.quote(model)
+                                         for model in missing),
+                      'model_info': 'version'}
+            response = self._session.get(url, params=params,
+                                         headers=self.headers, verify=True)
+            try:
+                doc = response.json()
+            except ValueError:
+                raise RuntimeError("Non-json response: " + response.text[:100])
+            if 'error' in doc:
+                raise RuntimeError(doc['error'])
+            for model in missing:
+                self._model_versions[(context, model)] = \
+                    doc[context]['models'][model]['version']
+        return {model: self._model_versions[(context, model)]
+                for model in models}
+
+    def _score_with_store(self, context, models, rev_ids, ordered,
+                          compact=False):
+        try:
+            model_versions = self.model_versions(context, models)
+        except (RuntimeError, KeyError, requests.RequestException):
+            logger.warning("Couldn't get model versions, scoring without the store:")
+            logger.warning(traceback.format_exc())
+            yield from self._score(context, models, rev_ids, ordered,
+                                   compact)
+            return
+
+        # a window at a time, so a lazy rev_ids is never read all at once
+        for rev_id_window in chunked(rev_ids, self.store_window):
+            stored = self.score_store.get_many(context, model_versions,
+                                               rev_id_window)
+            missing = list(dict.fromkeys(rev_id for rev_id in rev_id_window
+                                         if rev_id not in stored))
+            logging.debug("{0} of {1} revids scored already"
+                          .format(len(rev_id_window) - len(missing),
+                                  len(rev_id_window)))
+            if compact:
+                stored = {rev_id: self._compact_score(score_doc, models)
+                          for rev_id, score_doc in stored.items()}
+            scored = {}
+            if missing:
+                scored = dict(self._score(context, models, missing,
+                                          ordered=False, compact=compact))
+                self.score_store.put_many(
+                    context, model_versions,
+                    ((rev_id, self._expand_compact(score, models) if compact else score)
+                     for rev_id, score in scored.items()))
+
+            for rev_id in rev_id_window:
+                yield rev_id, stored[rev_id] if rev_id in stored else scored[rev_id]
+
+    def _score(self, context, models, rev_ids, ordered=True, compact=False):
+        """
+        Generate (rev_id, score) pairs with at most
+        `parallel_requests * batches_in_flight` batches submitted at a time.
+        When a batch finishes the next one is read from `rev_ids` and
+        submitted, so neither the revisions nor their scores pile up.
+        With `compact` the scores are :func:`_compact_score` tuples.
+        """
+        max_in_flight = self.workers * self.batches_in_flight
+        executor = self._get_executor()
+        in_flight = {}  # future -> rev_id_batch, in submission order
+        try:
+            for rev_id_batch in self._batches(rev_ids):
                 logging.debug("Starting batch of {0} revids"
                               .format(len(rev_id_batch)))
-                future_rev_ids.append((
-                    executor.submit(self._score_request, context, rev_id_batch,
-                                    models),
-                    rev_id_batch))
+                in_flight[executor.submit(self._score_batch,
+                                          context, rev_id_batch,
+                                          models, compact)] = rev_id_batch
+                if len(in_flight) >= max_in_flight:
+                    yield from self._finished_scores(in_flight, models,
+                                                     ordered, compact)
+            while in_flight:
+                yield from self._finished_scores(in_flight, models, ordered,
+                                                 compact)
+        finally:
+            # the caller stopped early, don't send what's still queued
+            for future in in_flight:
+                future.cancel()
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                logging.debug("Starting up thread pool with {0} workers"
+                              .format(self.workers))
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='ores')
+            return self._executor
+
+    def close(self):
+        """Stop the thread pool and close the kept-alive connections."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        self._session.close()
+
+    def _finished_scores(self, in_flight, models, ordered, compact=False):
+        if ordered:
+            # the oldest batch, the ones after it wait their turn
+            finished = [next(iter(in_flight))]
+        else:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in finished:
+            rev_id_batch = in_flight.pop(future)
+            try:
+                scores = future.result()
+            except RuntimeError as e:
+                logger.warning(
+                    "An ORES scoring job failed with the following error:")
+                logger.warning(traceback.format_exc())
+                scores = [self._error_score(models, e, compact)
+                          for _ in rev_id_batch]
+            yield from zip(rev_id_batch, scores)
+
+    def _error_score(self, models, error, compact=False):
+        if compact:
+            return tuple((None, float('nan')) for _ in models)
+        return {m: {"error": error.args[0]} for m in models}
+
+    def _batches(self, rev_ids):
+        """Batches of rev_ids, each as big as the batch size is when it's read."""
+        rev_ids = iter(rev_ids)
+        while True:
+            rev_id_batch = list(itertools.islice(rev_ids, self.batch_size))
+            if not rev_id_batch:
+                return
+            yield rev_id_batch
 
-            # This loop blocks on reading the futures as soon as they are ready
-            for (future, rev_id_batch) in future_rev_ids:
+    def _adapt_batch_size(self, seconds, failed):
+        with self._batch_size_lock:
+            if failed or seconds > self.target_latency:
+                self.batch_size = max(1, self.batch_size // 2)
+            elif seconds < self.target_latency / 2:
+                self.batch_size = min(self.max_batch_size, self.batch_size + 1)
+
+    def _backoff_seconds(self, attempt, retry_after=None):
+        """How long to wait before retry `attempt`, jittered so the parallel
+        requests that failed together don't all come back together."""
+        if retry_after is not None:
+            return retry_after
+        return self.backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def _controlled_score_request(self, context, rev_ids, models,
+                                  compact=False):
+        """
+        :func:`_score_request` through the rate limiter and the adaptive
+        concurrency limit, retrying throttled requests and transient failures
+        and recording latency.  Any other error is about the revisions rather
+        than how loaded ORES is, so it's raised without touching the batch
+        size.
+        """
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            with self.concurrency:
+                start = time.time()
                 try:
-                    for score in future.result():
-                        yield score
-                except RuntimeError as e:
-                    logger.warning(
-                        "An ORES scoring job failed with the following error:")
-                    logger.warning(traceback.format_exc())
-                    for rev_id in rev_id_batch:
-                        yield {m: {"error": e.args[0]}
-                               for m in models}
-
-    def _score_request(self, context, rev_ids, models):
+                    scores = self._score_request(context, rev_ids, models,
+                                                 compact)
+                except (Throttled, TransientError) as e:
+                    failure = e
+                else:
+                    seconds = time.time() - start
+                    self.latencies.record(seconds, 'ok')
+                    self.concurrency.succeeded()
+                    self._adapt_batch_size(seconds, failed=False)
+                    return scores
+            seconds = time.time() - start
+            if isinstance(failure, Throttled):
+                self.latencies.record(seconds, 'throttled')
+                self.concurrency.throttled()
+            else:
+                self.latencies.record(seconds, 'error')
+            self._adapt_batch_size(seconds, failed=True)
+            if attempt < self.retries:
+                wait_seconds = self._backoff_seconds(attempt, getattr(failure, 'retry_after', None))
+                logger.info("{0}, retrying in {1:.1f} seconds".format(failure, wait_seconds))
+                time.sleep(wait_seconds)
+        raise failure
+
+    def _score_batch(self, context, rev_ids, models, compact=False):
+        """
+        A score or an error for every revision in the batch.  A batch that
+        ORES rejects is split in half until the revisions that fail it are on
+        their own, so one bad revision only costs a few extra requests instead
+        of the whole batch's scores.  A batch that's still throttled or
+        failing transiently after its retries isn't split, the server is
+        struggling and more requests won't help, it fails as a whole.
+        """
+        try:
+            return self._controlled_score_request(context, rev_ids, models,
+                                                  compact)
+        except (Throttled, TransientError):
+            raise
+        except RuntimeError as e:
+            if len(rev_ids) == 1:
+                logger.warning("Couldn't score revision {0}: {1}"
+                               .format(rev_ids[0], e))
+                return [self._error_score(models, e, compact)]
+            logger.info("A batch of {0} revids failed, splitting it: {1}"
+                        .format(len(rev_ids), e))
+            half = len(rev_ids) // 2
+            return (self._score_batch(context, rev_ids[:half], models, compact) +
+                    self._score_batch(context, rev_ids[half:], models, compact))
+
+    def stats(self):
+        """The current concurrency limit and batch size, and the latencies so far."""
+        return {'concurrency_limit': self.concurrency.limit, 'batch_size': self.batch_size,
+                'requests': self.latencies.total(), 'throttled': self.latencies.total('throttled'),
+                'latencies': str(self.latencies)}
+
+    def _score_request(self, context, rev_ids, models, compact=False):
         url = self.host + "/v3/scores/{0}/".format(urllib.parse.quote(context))
 
         params = {'revids': "|".join(str(rid) for rid in rev_ids),
@@ -122,11 +664,24 @@ class Session:
         logging.debug("Sending score request for {0} revisions"
                       .format(len(rev_ids)))
         start = time.time()
-        response = self._session.get(url, params=params,
-                                     headers=self.headers,
-                                     verify=True, stream=True)
         try:
-            doc = response.json()
+            response = self._session.get(url, params=params,
+                                         headers=self.headers,
+                                         verify=True, stream=True)
+        except requests.RequestException as e:
+            raise TransientError("Request failed: {0}".format(e))
+        if response.status_code in (429, 503):
+            try:
+                retry_after = float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):  # missing, or an HTTP date
+                retry_after = None
+            raise Throttled("ORES responded {0}".format(response.status_code),
+                            retry_after)
+        if response.status_code >= 500:
+            raise TransientError("ORES responded {0}: {1}"
+                                 .format(response.status_code, response.text[:100]))
+        try:
+            doc = _loads(response.content) if compact else response.json()
         except ValueError:
             raise RuntimeError("Non-json response: " + response.text[:100])
 
@@ -142,5 +697,8 @@ class Session:
             for warning_doc in doc['warnings']:
                 logger.warn(warning_doc)
 
-        return [doc[context]['scores'][str(rev_id)]
-                for rev_id in rev_ids]
+        scores = doc[context]['scores']
+        if compact:
+            return [self._compact_score(scores[str(rev_id)], models)
+                    for rev_id in rev_ids]
+        return [scores[str(rev_id)] for rev_id in rev_ids]
@@ -1,6 +1,7 @@
 # example taken from http://pythoncentral.io/introductory-tutorial-python-sqlalchemy/
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, BigInteger, Index, Float, ForeignKey, TEXT
-from sqlalchemy.dialects.mysql import TINYTEXT, MEDIUMTEXT, LONGTEXT, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, BigInteger, Index, Float, ForeignKey, TEXT, \
+    LargeBinary
+from sqlalchemy.dialects.mysql import TINYTEXT, MEDIUMTEXT, LONGTEXT, JSON, MEDIUMBLOB
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
 
@@ -36,12 +37,27 @@ class edits(Base):
     de_flagged                  = Column(Boolean, default=None)
     de_flagged_algo_version     = Column(Boolean, default=None)
     edit_deleted                = Column(default=False)
-    diffHTML                    = Column(MEDIUMTEXT)
+    # the diff and comments are in edits_display, by lang and rev_id
     newRevId                    = Column(Integer)
     newRevDate                  = Column(TINYTEXT)
     newRevUser                  = Column(TINYTEXT)
-    newRevComment               = Column(TEXT)
     oldRevId                    = Column(Integer)
     oldRevDate                  = Column(TINYTEXT)
     oldRevUser                  = Column(TINYTEXT)
-    oldRevComment               = Column(TEXT)
+
+class edits_display(Base):
+    """get_display_data's output per revision, which never changes. the diff html and comments are big
+    so they're kept compressed together in `payload`, see display_store"""
+    __tablename__ = 'edits_display'
+    __table_args__ = {'mysql_engine': 'InnoDB', 'mysql_charset': 'utf8', 'mysql_collate': 'utf8_general_ci'}
+    lang                        = Column(String(16), primary_key=True, autoincrement=False)
+    rev_id                      = Column(Integer, primary_key=True, autoincrement=False)
+    created_at                  = Column(DateTime, default=datetime.datetime.utcnow)
+    page_title                  = Column(TEXT)
+    new_rev_date                = Column(String(32))
+    new_rev_user                = Column(String(255))
+    old_rev_id                  = Column(Integer)
+    old_rev_date                = Column(String(32))
+    old_rev_user                = Column(String(255))
+    codec                       = Column(String(8))
+    payload                     = Column(LargeBinary().with_variant(MEDIUMBLOB(), 'mysql'))
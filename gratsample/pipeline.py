@@ -0,0 +1,109 @@
+"""
+make_data's feature columns as a graph of nodes, each checkpointed once it's computed.
+
+a node is a stage function called as fn(df, accumulator=..., **params) that adds its output columns
+to the FeatureAccumulator, like the add_* functions do. a node's checkpoint is keyed by the node, its
+params and the population with the columns it reads, so a crashed run picks up after the last finished
+node, and asking for one new column only computes that column and whatever it reads.
+
+    pipeline = FeaturePipeline()
+    pipeline.add('num_prev_thanks', add_thanks, inputs=['user_name'], col_name='num_prev_thanks', ...)
+    df = pipeline.run(df, columns=['num_prev_thanks'])
+"""
+import time
+
+import pandas as pd
+
+from gratsample.cached_df import make_cache_key, make_manifest, open_store
+from gratsample.features import FeatureAccumulator, KEY_COLS
+
+
+class FeaturePipeline():
+    def __init__(self, checkpoint_sub_dir='feature_checkpoints', cache_root=None):
+        self.checkpoint_sub_dir = checkpoint_sub_dir
+        self.cache_root = cache_root
+        self.nodes = {}
+        self.column_nodes = {}
+
+    def add(self, name, fn, outputs=None, inputs=(), **params):
+        """register fn as the node `name`, making the columns `outputs` (just `name` by default) out of
+        the population's columns and other nodes' outputs listed in `inputs`"""
+        outputs = list(outputs) if outputs is not None else [name]
+        for output in outputs:
+            if output in self.column_nodes:
+                raise ValueError(f'{output} is already made by {self.column_nodes[output]}')
+            self.column_nodes[output] = name
+        self.nodes[name] = {'fn': fn, 'outputs': outputs, 'inputs': list(inputs), 'params': params}
+
+    def columns(self):
+        return [output for node in self.nodes.values() for output in node['outputs']]
+
+    def plan(self, columns=None):
+        """the nodes needed for `columns` (all of them by default), each after the nodes it reads from"""
+        columns = self.columns() if columns is None else columns
+        ordered = []
+        visiting = set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f'{name} depends on itself')
+            visiting.add(name)
+            for input_col in self.nodes[name]['inputs']:
+                if input_col in self.column_nodes:
+                    visit(self.column_nodes[input_col])
+            visiting.discard(name)
+            ordered.append(name)
+
+        for column in columns:
+            if column not in self.column_nodes:
+                raise KeyError(f'no node makes {column}')
+            visit(self.column_nodes[column])
+        return ordered
+
+    def checkpoint_key(self, name, input_df):
+        node = self.nodes[name]
+        arguments = dict(node=name, inputs=input_df, **node['params'])
+        return make_cache_key(node['fn'], arguments)
+
+    def run_node(self, name, input_df):
+        """the node's output columns for input_df's users, from its checkpoint if there is one"""
+        node = self.nodes[name]
+        store = open_store(self.checkpoint_sub_dir, cache_root=self.cache_root)
+        key = self.checkpoint_key(name, input_df)
+        try:
+            node_df = store.get(key)
+            print(f'{name}: checkpointed')
+            return node_df
+        except KeyError:
+            pass
+        start = time.time()
+        accumulator = FeatureAccumulator()
+        node['fn'](input_df, accumulator=accumulator, **node['params'])
+        node_df = accumulator.join(input_df[KEY_COLS])[KEY_COLS + node['outputs']]
+        manifest = make_manifest(node['fn'], dict(node=name, num_users=len(input_df), **node['params']), store.serializer)
+        store.put(key, node_df, manifest)
+        print(f'{name}: computed in {time.time() - start:.1f}s')
+        return node_df
+
+    def run(self, df, columns=None):
+        """df with `columns` (all the pipeline's columns by default) joined on, computing only the
+        nodes that are needed and don't have a checkpoint for this population yet"""
+        columns = self.columns() if columns is None else list(columns)
+        node_dfs = {}
+        for name in self.plan(columns):
+            node = self.nodes[name]
+            input_df = df[KEY_COLS + [input_col for input_col in node['inputs'] if input_col not in self.column_nodes]]
+            for input_col in node['inputs']:
+                if input_col in self.column_nodes:
+                    input_node_df = node_dfs[self.column_nodes[input_col]]
+                    input_df = pd.merge(input_df, input_node_df[KEY_COLS + [input_col]], how='left', on=KEY_COLS)
+            node_dfs[name] = self.run_node(name, input_df)
+
+        features = FeatureAccumulator()
+        for column in columns:
+            node_df = node_dfs[self.column_nodes[column]]
+            for lang, lang_df in node_df.groupby('lang', sort=False):
+                features.add(column, lang, lang_df['user_id'].values, lang_df[column].values)
+        return features.join(df)
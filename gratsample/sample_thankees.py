@@ -1,17 +1,28 @@
 import sqlalchemy
 
 from gratsample.sample_thankees_revision_utils import num_quality_revisions, get_timestamps_within_range, \
-    get_recent_edits_alias
+    get_recent_edits_alias, num_quality_revisions_by_namespace
 from gratsample.wikipedia_helpers import to_wmftimestamp, from_wmftimestamp, decode_or_nan, make_wmf_con, calc_labour_hours, \
-    ts_in_week, namespace_all, namespace_mainonly, namespace_nontalk
+    ts_in_week, namespace_all, namespace_mainonly, namespace_nontalk, as_microseconds, count_by_group, \
+    calc_labour_hours_by_group, ts_week_numbers, stream_sql_to_parquet, read_spilled, lang_con, \
+    run_per_lang
 
 import os
+import numpy as np
 import pandas as pd
-from gratsample.cached_df import make_cached_df
+from gratsample import cached_df
+from gratsample.cached_df import make_cached_df, print_cache_stats
+from gratsample.fanout import fetch_users
+from gratsample.features import FeatureAccumulator
+from gratsample.pipeline import FeaturePipeline
 
+from bisect import bisect_left
 from datetime import datetime as dt
 from datetime import timedelta as td
 
+# stream the user tables this many rows at a time instead of loading a whole wiki, 0 turns it off
+POPULATION_CHUNKSIZE = int(os.getenv('POPULATION_CHUNKSIZE', 0)) or None
+
 
 def output_bin_stats(df):
     bin_stats = pd.DataFrame(df.groupby(['experience_level_pre_treatment', 'lang']).size()).rename(
@@ -19,24 +30,53 @@ def output_bin_stats(df):
     bin_stats.to_csv('outputs/bin_stats_df_one_edit_min.csv', index=False)
 
 
-@make_cached_df('spans')
-def get_users_edit_spans(lang, start_date, end_date, wmf_con):
+@make_cached_df('span_chunks', backend='sqlite')
+def get_edit_spans_chunk(lang, min_user_id, max_user_id, start_date, end_date, wmf_con):
     """
-    Return the the first and last edits of all users in `lang`wiki
-    between the start_date and end_date
+    first and last edit between start_date and end_date of the users with
+    min_user_id <= user_id < max_user_id, in one grouped aggregation over revision_userindex
     """
-    db_prefix = f'{lang}wiki_p'
-    wmf_con.execute(f'use {db_prefix};')
-    reg_sql = '''select '{lang}' as lang, user_id, user_name, user_registration, user_editcount as live_edit_count,
-       (select min(rev_timestamp) from revision_userindex where rev_user=user_id and {start_date} <= rev_timestamp <= {end_date}) as first_edit, 
-       (select max(rev_timestamp) from revision_userindex where rev_user=user_id and {start_date} <= rev_timestamp <= {end_date}) as last_edit
+    chunk_sql = sqlalchemy.text("""select rev_user as user_id, min(rev_timestamp) as first_edit, max(rev_timestamp) as last_edit
+                                   from revision_userindex
+                                   where rev_user >= :min_user_id and rev_user < :max_user_id
+                                   and rev_timestamp >= :start_date and rev_timestamp <= :end_date
+                                   group by rev_user;""")
+    sql_params = {'min_user_id': int(min_user_id), 'max_user_id': int(max_user_id),
+                  'start_date': to_wmftimestamp(start_date), 'end_date': to_wmftimestamp(end_date)}
+    with lang_con(wmf_con, lang) as con:
+        return pd.read_sql(chunk_sql, con, params=sql_params)
+
+
+def registered_users_sql(lang, start_date, end_date):
+    return '''select '{lang}' as lang, user_id, user_name, user_registration, user_editcount as live_edit_count
 from user where coalesce(user_registration, 20010101000000) <= {end_date} 
      and 
-                coalesce(user_registration, 20010101000000) >= {start_date};
+                coalesce(user_registration, 20010101000000) >= {start_date}
+order by user_id;
 '''.format(start_date=to_wmftimestamp(start_date),
            end_date=to_wmftimestamp(end_date),
            lang=lang)
-    span_df = pd.read_sql(reg_sql, wmf_con)
+
+
+def fill_edit_spans(lang, span_df, start_date, end_date, wmf_con, chunk_size=20000):
+    """fill in the first and last edits of the users in span_df and decode the raw columns.
+    the edits are aggregated `chunk_size` user ids at a time, and each chunk is cached,
+    so a query never has to cover the whole wiki and an interrupted run picks up where it stopped"""
+    user_positions = pd.Index(span_df['user_id'])
+    first_edits = np.full(len(span_df), None, dtype=object)
+    last_edits = np.full(len(span_df), None, dtype=object)
+    if len(span_df):
+        # chunks start on multiples of chunk_size so that streamed batches of users share them
+        first_chunk_start = int(span_df['user_id'].min()) // chunk_size * chunk_size
+        for min_user_id in range(first_chunk_start, int(span_df['user_id'].max()) + 1, chunk_size):
+            chunk_df = get_edit_spans_chunk(lang, min_user_id, min_user_id + chunk_size, start_date, end_date, wmf_con)
+            positions = user_positions.get_indexer(chunk_df['user_id'])
+            in_population = positions >= 0
+            first_edits[positions[in_population]] = chunk_df['first_edit'].values[in_population]
+            last_edits[positions[in_population]] = chunk_df['last_edit'].values[in_population]
+    span_df['first_edit'] = first_edits
+    span_df['last_edit'] = last_edits
+
     span_df['user_registration'] = span_df['user_registration'].apply(from_wmftimestamp)
     span_df['first_edit'] = span_df['first_edit'].apply(from_wmftimestamp)
     span_df['last_edit'] = span_df['last_edit'].apply(from_wmftimestamp)
@@ -44,12 +84,46 @@ from user where coalesce(user_registration, 20010101000000) <= {end_date}
     return span_df
 
 
-def make_populations(start_date, end_date, wmf_con):
-    """for every registered user get first and last edit (or not of those users didn't edit in the period)"""
-    span_dfs = []
-    for lang in langs:
+@make_cached_df('spans', serializer='parquet')
+def get_users_edit_spans(lang, start_date, end_date, wmf_con, chunk_size=20000):
+    """
+    Return the the first and last edits of all users in `lang`wiki
+    between the start_date and end_date.
+    """
+    with lang_con(wmf_con, lang) as con:
+        span_df = pd.read_sql(registered_users_sql(lang, start_date, end_date), con)
+    return fill_edit_spans(lang, span_df, start_date, end_date, wmf_con, chunk_size=chunk_size)
+
+
+def spill_users_edit_spans(lang, start_date, end_date, wmf_con, chunksize, chunk_filter=None, chunk_size=20000):
+    """
+    get_users_edit_spans without holding the whole user table: the users come off a server-side cursor
+    `chunksize` at a time, get their spans filled in and filtered by chunk_filter, and what's left is
+    spilled to parquet in a run dir under CACHE_DIR/population_spill/spans/lang=`lang`. returns the run dir.
+    """
+    def span_chunk(users_df):
+        span_df = fill_edit_spans(lang, users_df, start_date, end_date, wmf_con, chunk_size=chunk_size)
+        return chunk_filter(span_df) if chunk_filter else span_df
+
+    spill_dir = os.path.join(cached_df.CACHE_ROOT, 'population_spill', 'spans', f'lang={lang}')
+    # the spans are filled on other connections from the pool while this one is held by the cursor
+    with lang_con(wmf_con, lang) as con:
+        return stream_sql_to_parquet(registered_users_sql(lang, start_date, end_date), con, spill_dir, chunksize,
+                                     chunk_fn=span_chunk)
+
+
+def make_populations(start_date, end_date, wmf_con, chunksize=POPULATION_CHUNKSIZE, chunk_filter=None):
+    """for every registered user get first and last edit (or not of those users didn't edit in the period).
+    with a chunksize the user tables are streamed and chunk_filter (eg. remove_inactive_users) is applied
+    to every chunk before it's kept"""
+    def lang_population(lang):
+        if chunksize:
+            return read_spilled(spill_users_edit_spans(lang, start_date, end_date, wmf_con, chunksize,
+                                                       chunk_filter=chunk_filter), remove=True)
         span_df = get_users_edit_spans(lang, start_date, end_date, wmf_con)
-        span_dfs.append(span_df)
+        return chunk_filter(span_df) if chunk_filter else span_df
+
+    span_dfs = run_per_lang(lang_population, langs, 'make_populations')
     return pd.concat(span_dfs)
 
 
@@ -63,90 +137,175 @@ def remove_inactive_users(df, start_date, end_date):
     active_df[f'active_in_{days_between.days}_pre_treatment'] = True
     return active_df
 
-@make_cached_df('disablemail')
+@make_cached_df('disablemail', backend='sqlite')
 def get_user_disablemail_properties(lang, user_id, wmf_con):
-    wmf_con.execute(f"use {lang}wiki_p;")
     user_prop_sql = f"""select * from user_properties where up_user = {user_id}
                         and up_property = 'disablemail';"""
-    df = pd.read_sql(user_prop_sql, wmf_con)
+    with lang_con(wmf_con, lang) as con:
+        df = pd.read_sql(user_prop_sql, con)
     return df
 
 
-def add_has_email_currently(df, wmf_con):
-    user_prop_dfs = []
-    for lang in langs:
+def get_users_disablemail_properties(lang, user_ids, wmf_con, chunk_size=1000):
+    """the disablemail properties of many users, with one `up_user in (...)` query per chunk of users
+    that aren't cached yet. each user's rows are also cached as get_user_disablemail_properties would"""
+    user_ids = [int(user_id) for user_id in user_ids]
+    cached = get_user_disablemail_properties.get_many([(lang, user_id, wmf_con) for user_id in user_ids])
+    user_prop_dfs = [user_prop_df for user_prop_df in cached if user_prop_df is not None]
+    missing_user_ids = [user_id for user_id, user_prop_df in zip(user_ids, cached) if user_prop_df is None]
+    for start in range(0, len(missing_user_ids), chunk_size):
+        chunk = missing_user_ids[start:start + chunk_size]
+        chunk_sql = f"""select * from user_properties where up_user in ({','.join(str(user_id) for user_id in chunk)})
+                        and up_property = 'disablemail';"""
+        with lang_con(wmf_con, lang) as con:
+            chunk_df = pd.read_sql(chunk_sql, con)
+        per_user = {user_id: user_df.reset_index(drop=True) for user_id, user_df in chunk_df.groupby('up_user')}
+        chunk_user_dfs = [per_user.get(user_id, chunk_df.iloc[0:0]) for user_id in chunk]
+        get_user_disablemail_properties.put_many([(lang, user_id, wmf_con) for user_id in chunk], chunk_user_dfs)
+        user_prop_dfs.append(chunk_df)
+    return pd.concat(user_prop_dfs) if user_prop_dfs else pd.DataFrame(columns=['up_user'])
+
+
+def add_has_email_currently(df, wmf_con, accumulator=None):
+    features = accumulator if accumulator is not None else FeatureAccumulator()
+
+    def lang_has_email(lang):
         user_ids = df[df['lang'] == lang]['user_id'].values
         # print(f'{lang} has {len(user_ids)} disablemails to get')
-        for user_id in user_ids:
-            user_prop_df = get_user_disablemail_properties(lang, user_id, wmf_con)
-            has_email = False if len(
-                user_prop_df) >= 1 else True  # the property disables email, if it doesn't exist the default its that it's on
-            user_prop_dfs.append(pd.DataFrame.from_dict({'has_email': [has_email],
-                                                         'user_id': [user_id],
-                                                         'lang': [lang]}, orient='columns'))
-
-    users_prop_df = pd.concat(user_prop_dfs)
-    df = pd.merge(df, users_prop_df, how='left', on=['lang', 'user_id'])
-    return df
+        disabled_user_ids = get_users_disablemail_properties(lang, user_ids, wmf_con)['up_user']
+        # the property disables email, if it doesn't exist the default its that it's on
+        features.add('has_email', lang, user_ids, ~pd.Series(user_ids).isin(disabled_user_ids).values)
 
+    run_per_lang(lang_has_email, langs, 'add_has_email_currently')
+    return df if accumulator is not None else features.join(df)
 
-@make_cached_df('thanks')
+
+@make_cached_df('thanks', backend='sqlite')
 def get_thanks_thanking_user(lang, user_name, start_date, end_date, wmf_con):
-    wmf_con.execute(f"use {lang}wiki_p;")
     user_thank_sql = """
                     select thank_timestamp, sender, receiver, ru.user_id as receiver_id, su.user_id as sender_id from
                         (select log_timestamp as thank_timestamp, replace(log_title, '_', ' ') as receiver, log_user_text as sender
                         from logging_logindex where log_title = :user_name
                         and log_action = 'thank'
-                        and :start_date <= log_timestamp <= :end_date ) t
+                        and log_timestamp >= :start_date and log_timestamp <= :end_date ) t
                     left join user ru on ru.user_name = t.receiver
                     left join user su on su.user_name = t.sender """
     user_thank_sql_esc = sqlalchemy.text(user_thank_sql)
     sql_params = {'user_name': user_name.replace(' ', '_'), 'start_date':to_wmftimestamp(start_date), 'end_date':to_wmftimestamp(end_date)}
-    df = pd.read_sql(user_thank_sql_esc, con=wmf_con, params=sql_params)
+    with lang_con(wmf_con, lang) as con:
+        df = pd.read_sql(user_thank_sql_esc, con=con, params=sql_params)
     df['thank_timestamp'] = df['thank_timestamp'].apply(from_wmftimestamp)
     df['sender'] = df['sender'].apply(decode_or_nan)
     df['receiver'] = df['receiver'].apply(decode_or_nan)
     return df
 
 
-def add_thanks(df, start_date, end_date, col_name, wmf_con):
-    user_thank_count_dfs = []
-    for lang in langs:
-        user_names = df[df['lang'] == lang]['user_name'].values
-        for user_name in user_names:
-            user_thank_df = get_thanks_thanking_user(lang, user_name, start_date, end_date, wmf_con)
-            user_thank_count_df = pd.DataFrame.from_dict({col_name: [len(user_thank_df)],
-                                                          'user_name': [user_name],
-                                                          'lang': [lang]}, orient='columns')
-            user_thank_count_dfs.append(user_thank_count_df)
-
-    thank_counts_df = pd.concat(user_thank_count_dfs)
-    df = pd.merge(df, thank_counts_df, how='left', on=['lang', 'user_name'])
+@make_cached_df('thanks_received', backend='sqlite')
+def get_thanks_received(lang, user_names, start_date, end_date, wmf_con):
+    """every thank logged between start_date and end_date for a chunk of receiving users,
+    in the same shape as get_thanks_thanking_user. the sender and receiver ids are
+    resolved with one user lookup for the whole chunk instead of two joins per user"""
+    thank_sql = sqlalchemy.text("""select log_timestamp as thank_timestamp, log_title as receiver, log_user_text as sender
+                                   from logging_logindex where log_title in :log_titles
+                                   and log_action = 'thank'
+                                   and log_timestamp >= :start_date and log_timestamp <= :end_date"""
+                                ).bindparams(sqlalchemy.bindparam('log_titles', expanding=True))
+    sql_params = {'log_titles': [user_name.replace(' ', '_') for user_name in user_names],
+                  'start_date': to_wmftimestamp(start_date), 'end_date': to_wmftimestamp(end_date)}
+    with lang_con(wmf_con, lang) as con:
+        df = pd.read_sql(thank_sql, con=con, params=sql_params)
+        df['thank_timestamp'] = df['thank_timestamp'].apply(from_wmftimestamp)
+        df['sender'] = df['sender'].apply(decode_or_nan)
+        df['receiver'] = df['receiver'].apply(decode_or_nan).str.replace('_', ' ')
+
+        thank_user_names = list(set(df['sender'].dropna()) | set(df['receiver'].dropna()))
+        if thank_user_names:
+            user_sql = sqlalchemy.text("select user_id, user_name from user where user_name in :user_names"
+                                       ).bindparams(sqlalchemy.bindparam('user_names', expanding=True))
+            user_df = pd.read_sql(user_sql, con=con, params={'user_names': thank_user_names})
+            user_ids = dict(zip(user_df['user_name'].apply(decode_or_nan), user_df['user_id']))
+        else:
+            user_ids = {}
+    df['receiver_id'] = df['receiver'].map(user_ids)
+    df['sender_id'] = df['sender'].map(user_ids)
     return df
 
 
-def add_num_quality(df: object, col_name: object, namespace_fn: object, end_date: object, wmf_con: object) -> object:
+def get_thanks_of_users(lang, user_names, start_date, end_date, wmf_con, chunk_size=500):
+    """the thank rows of many receivers, fetched and cached one chunk of names at a time.
+    fills the per-user cache of get_thanks_thanking_user on the way so later thank-based
+    features don't have to go back to the replica"""
+    user_names = [user_name for user_name in user_names if pd.notnull(user_name)]
+    thank_dfs = []
+    for start in range(0, len(user_names), chunk_size):
+        chunk = user_names[start:start + chunk_size]
+        thank_df = get_thanks_received(lang, chunk, start_date, end_date, wmf_con)
+        per_user = {user_name: user_df.reset_index(drop=True) for user_name, user_df in thank_df.groupby('receiver')}
+        get_thanks_thanking_user.put_many([(lang, user_name, start_date, end_date, wmf_con) for user_name in chunk],
+                                          [per_user.get(user_name, thank_df.iloc[0:0]) for user_name in chunk])
+        thank_dfs.append(thank_df)
+    return pd.concat(thank_dfs) if thank_dfs else pd.DataFrame(columns=['thank_timestamp', 'sender', 'receiver',
+                                                                        'receiver_id', 'sender_id'])
+
+
+def add_thanks(df, start_date, end_date, col_name, wmf_con, accumulator=None):
+    features = accumulator if accumulator is not None else FeatureAccumulator()
+
+    def lang_thank_counts(lang):
+        lang_df = df[df['lang'] == lang]
+        user_names = lang_df['user_name'].values
+        thank_df = get_thanks_of_users(lang, user_names, start_date, end_date, wmf_con)
+        thank_counts = thank_df.groupby('receiver').size()
+        features.add(col_name, lang, lang_df['user_id'].values,
+                     pd.Series(user_names).map(thank_counts).fillna(0).astype(int).values)
+
+    run_per_lang(lang_thank_counts, langs, 'add_thanks')
+    return df if accumulator is not None else features.join(df)
+
+
+def add_num_quality(df: object, col_name: object, namespace_fn: object, end_date: object, wmf_con: object,
+                    accumulator=None) -> object:
     """note this get thes the number of quality revisions that are 90 days before users last edit before the end_date
     so, it's different than num_edits_90_pre_treatment because it could go farther back"""
+    features = accumulator if accumulator is not None else FeatureAccumulator()
 
-
-
-    num_quality_dfs = []
-    for lang in langs:
+    def lang_num_quality(lang):
         user_ids = df[df['lang'] == lang]['user_id'].values
         for user_id in user_ids:
             # print(f'lang: {lang}, user_id: {user_id}')
             num_quality = num_quality_revisions(user_id=user_id, lang=lang, wmf_con=wmf_con, namespace_fn=namespace_fn,
                                                 end_date=end_date)
-            user_thank_count_df = pd.DataFrame.from_dict({col_name: [num_quality],
-                                                          'user_id': [user_id],
-                                                          'lang': [lang]}, orient='columns')
-            num_quality_dfs.append(user_thank_count_df)
+            features.append(col_name, lang, user_id, num_quality)
+
+    run_per_lang(lang_num_quality, langs, f'add_num_quality {col_name}')
+    return df if accumulator is not None else features.join(df)
 
-    quality_counts_df = pd.concat(num_quality_dfs)
-    df = pd.merge(df, quality_counts_df, how='left', on=['lang', 'user_id'])
-    return df
+
+def add_num_quality_by_namespace(df, namespace_fns, end_date, wmf_con, accumulator=None):
+    """add_num_quality for many namespaces at once, namespace_fns is {col_name: namespace_fn}.
+    each user's revisions are fetched and scored once and counted for every namespace_fn"""
+    features = accumulator if accumulator is not None else FeatureAccumulator()
+    col_names = list(namespace_fns)
+
+    def lang_num_quality(lang):
+        user_ids = df[df['lang'] == lang]['user_id'].values
+        for user_id in user_ids:
+            num_qualities = num_quality_revisions_by_namespace(user_id=user_id, lang=lang,
+                                                               namespace_fns=list(namespace_fns.values()),
+                                                               wmf_con=wmf_con, end_date=end_date)
+            for col_name, num_quality in zip(col_names, num_qualities):
+                features.append(col_name, lang, user_id, num_quality)
+
+    run_per_lang(lang_num_quality, langs, f"add_num_quality_by_namespace {', '.join(col_names)}")
+    return df if accumulator is not None else features.join(df)
+
+
+def get_users_edits(edit_getter_fn, lang, user_ids, wmf_con, start_date, end_date):
+    """edit_getter_fn(lang, user_id, wmf_con, start_date, end_date) for every user, fanned out
+    with only the cache misses going to the replicas when it's a make_cached_df fetcher"""
+    if hasattr(edit_getter_fn, 'get_many'):
+        return fetch_users(edit_getter_fn, [(lang, user_id) for user_id in user_ids], wmf_con, start_date, end_date)
+    return [edit_getter_fn(lang, user_id, wmf_con, start_date, end_date) for user_id in user_ids]
 
 
 def add_edits_fn_by_week(df, col_name, wmf_con, timestamp_list_fn, edit_getter_fn=get_timestamps_within_range, start_date=None, end_date=None):
@@ -157,13 +316,15 @@ def add_edits_fn_by_week(df, col_name, wmf_con, timestamp_list_fn, edit_getter_f
         df[week_col_name_any] = df[week_col_name].apply(lambda x: x>0)
     return df
 
-def add_edits_fn(df, col_name, wmf_con, timestamp_list_fn, edit_getter_fn=get_timestamps_within_range, start_date=None, end_date=None, week_number=None):
+def add_edits_fn(df, col_name, wmf_con, timestamp_list_fn, edit_getter_fn=get_timestamps_within_range, start_date=None, end_date=None, week_number=None,
+                 accumulator=None):
     '''add the number of edits a user made within range'''
-    edit_measure_dfs =[]
-    for lang in langs:
+    features = accumulator if accumulator is not None else FeatureAccumulator()
+
+    def lang_edit_measures(lang):
         user_ids = df[df['lang'] == lang]['user_id'].values
-        for user_id in user_ids:
-            ts_series = edit_getter_fn(lang, user_id, wmf_con, start_date, end_date)
+        ts_serieses = get_users_edits(edit_getter_fn, lang, user_ids, wmf_con, start_date, end_date)
+        for user_id, ts_series in zip(user_ids, ts_serieses):
             ts_list = list(ts_series['rev_timestamp'])
             if week_number is not None:
                 days_after_treat_start = week_number * 7
@@ -172,15 +333,108 @@ def add_edits_fn(df, col_name, wmf_con, timestamp_list_fn, edit_getter_fn=get_ti
                 week_end_date = start_date + td(days=days_after_treat_end)
 
                 ts_list = ts_in_week(ts_list, week_start_date, week_end_date)
-            edit_measure_df = pd.DataFrame.from_dict({col_name: [timestamp_list_fn(ts_list)],
-                                                          'user_id': [user_id],
-                                                          'lang': [lang]}, orient='columns')
-            edit_measure_dfs.append(edit_measure_df)
+            features.append(col_name, lang, user_id, timestamp_list_fn(ts_list))
 
-    edit_measures_df = pd.concat(edit_measure_dfs)
-    df = pd.merge(df, edit_measures_df, how='left', on=['lang', 'user_id'])
+    run_per_lang(lang_edit_measures, langs, f'add_edits_fn {col_name}')
+    return df if accumulator is not None else features.join(df)
 
-    return df
+
+def edit_window_feature(col_name, timestamp_list_fn, start_date, end_date, by_week=False):
+    """one add_edits_fn (or add_edits_fn_by_week when by_week) worth of columns, for add_edit_features"""
+    return {'col_name': col_name, 'timestamp_list_fn': timestamp_list_fn,
+            'start_date': start_date, 'end_date': end_date, 'by_week': by_week}
+
+
+def edit_window_measures(ts_list, features):
+    """the columns of every feature for one user's sorted timestamps"""
+    measures = {}
+    for feature in features:
+        start_date, end_date = feature['start_date'], feature['end_date']
+        # same as the rev_timestamp >= start_date and rev_timestamp < end_date of the query
+        window_ts_list = ts_list[bisect_left(ts_list, start_date):bisect_left(ts_list, end_date)]
+        timestamp_list_fn = feature['timestamp_list_fn']
+        if not feature['by_week']:
+            measures[feature['col_name']] = timestamp_list_fn(window_ts_list)
+            continue
+        for week_number in range(1, 13):
+            week_col_name = f"{feature['col_name']}_week_{week_number}"
+            week_start_date = start_date + td(days=week_number * 7)
+            week_end_date = start_date + td(days=(week_number + 1) * 7)
+            measures[week_col_name] = timestamp_list_fn(ts_in_week(window_ts_list, week_start_date, week_end_date))
+            measures[f'{week_col_name}_any'] = measures[week_col_name] > 0
+    return measures
+
+
+def edit_window_columns(features):
+    """the names of the columns edit_window_measures makes for `features`, in its order"""
+    columns = []
+    for feature in features:
+        if not feature['by_week']:
+            columns.append(feature['col_name'])
+            continue
+        for week_number in range(1, 13):
+            week_col_name = f"{feature['col_name']}_week_{week_number}"
+            columns += [week_col_name, f'{week_col_name}_any']
+    return columns
+
+
+# the per-user timestamp list functions that have a whole-population equivalent in wikipedia_helpers
+VECTORIZED_TIMESTAMP_LIST_FNS = {len: count_by_group, calc_labour_hours: calc_labour_hours_by_group}
+
+
+def _per_user(by_user, user_ids):
+    if len(by_user) == 0:
+        # every user's list was empty, which calc_labour_hours answers with an int 0
+        return np.zeros(len(user_ids), dtype=np.int64)
+    return by_user.reindex(user_ids, fill_value=0).values
+
+
+def edit_window_measures_by_user(user_ids, ts_user_ids, ts, features):
+    """edit_window_measures for all users at once, from long-format (user_id, rev_timestamp) arrays"""
+    measures = {}
+    for feature in features:
+        by_group = VECTORIZED_TIMESTAMP_LIST_FNS[feature['timestamp_list_fn']]
+        start_ts, end_ts = as_microseconds([feature['start_date'], feature['end_date']])
+        in_window = (ts >= start_ts) & (ts < end_ts)
+        window_user_ids, window_ts = ts_user_ids[in_window], ts[in_window]
+        if not feature['by_week']:
+            measures[feature['col_name']] = _per_user(by_group(window_user_ids, window_ts), user_ids)
+            continue
+        week_numbers = ts_week_numbers(window_ts, feature['start_date'])
+        for week_number in range(1, 13):
+            week_col_name = f"{feature['col_name']}_week_{week_number}"
+            in_week = week_numbers == week_number
+            measures[week_col_name] = _per_user(by_group(window_user_ids[in_week], window_ts[in_week]), user_ids)
+            measures[f'{week_col_name}_any'] = measures[week_col_name] > 0
+    return measures
+
+
+def add_edit_features(df, features, wmf_con, edit_getter_fn=get_timestamps_within_range, accumulator=None):
+    """add the columns of many add_edits_fn/add_edits_fn_by_week calls in one pass.
+    every user's timestamps are fetched once for the window spanning all the features
+    and each feature is computed from that, for the whole language at once when its
+    timestamp_list_fn has a vectorized equivalent. the result is merged once"""
+    feature_columns = accumulator if accumulator is not None else FeatureAccumulator()
+    fetch_start_date = min(feature['start_date'] for feature in features)
+    fetch_end_date = max(feature['end_date'] for feature in features)
+    vectorized = all(feature['timestamp_list_fn'] in VECTORIZED_TIMESTAMP_LIST_FNS for feature in features)
+    def lang_edit_measures(lang):
+        user_ids = df[df['lang'] == lang]['user_id'].values
+        ts_lists = [sorted(ts_series['rev_timestamp'])
+                    for ts_series in get_users_edits(edit_getter_fn, lang, user_ids, wmf_con, fetch_start_date,
+                                                     fetch_end_date)]
+        if vectorized:
+            ts_user_ids = np.repeat(user_ids, [len(ts_list) for ts_list in ts_lists])
+            ts = as_microseconds([t for ts_list in ts_lists for t in ts_list])
+            for col_name, values in edit_window_measures_by_user(user_ids, ts_user_ids, ts, features).items():
+                feature_columns.add(col_name, lang, user_ids, values)
+            return
+        for user_id, ts_list in zip(user_ids, ts_lists):
+            for col_name, value in edit_window_measures(ts_list, features).items():
+                feature_columns.append(col_name, lang, user_id, value)
+
+    run_per_lang(lang_edit_measures, langs, 'add_edit_features')
+    return df if accumulator is not None else feature_columns.join(df)
 
 
 def bin_from_td(delta):
@@ -203,30 +457,32 @@ def add_experience_bin(df):
     return df
 
 
-@make_cached_df('total_edits')
+# a new sub-dir, the entries in total_edits were counted with a predicate that didn't filter on dates
+@make_cached_df('total_edits_in_range', backend='sqlite')
 def get_total_user_edits(lang, user_id, start_date, end_date, wmf_con):
-    wmf_con.execute(f"use {lang}wiki_p;")
-    user_edit_sql = f"""select count(*) as edits_pre_treatment from revision_userindex 
-                where rev_user = {user_id} 
-                and {to_wmftimestamp(start_date)} <= rev_timestamp <= {to_wmftimestamp(end_date)};
-                """
-    df = pd.read_sql(user_edit_sql, wmf_con)
+    user_edit_sql = sqlalchemy.text("""select count(*) as edits_pre_treatment from revision_userindex
+                where rev_user = :user_id
+                and rev_timestamp >= :start_date and rev_timestamp <= :end_date;
+                """)
+    sql_params = {'user_id': int(user_id), 'start_date': to_wmftimestamp(start_date),
+                  'end_date': to_wmftimestamp(end_date)}
+    with lang_con(wmf_con, lang) as con:
+        df = pd.read_sql(user_edit_sql, con, params=sql_params)
     return df
 
 
-def add_total_edits(df, start_date, end_date, wmf_con):
-    user_edit_dfs = []
-    for lang in langs:
-        user_ids = user_ids = df[df['lang'] == lang]['user_id'].values
-        for user_id in user_ids:
-            user_edit_df = get_total_user_edits(lang, user_id, start_date, end_date, wmf_con)
-            user_edit_df['user_id'] = user_id
-            user_edit_df['lang'] = lang
-            user_edit_dfs.append(user_edit_df)
+def add_total_edits(df, start_date, end_date, wmf_con, accumulator=None):
+    features = accumulator if accumulator is not None else FeatureAccumulator()
 
-    users_edit_df = pd.concat(user_edit_dfs)
-    df = pd.merge(df, users_edit_df, how='left', on=['lang', 'user_id'])
-    return df
+    def lang_total_edits(lang):
+        user_ids = df[df['lang'] == lang]['user_id'].values
+        user_edit_dfs = fetch_users(get_total_user_edits, [(lang, user_id) for user_id in user_ids],
+                                    start_date, end_date, wmf_con)
+        for user_id, user_edit_df in zip(user_ids, user_edit_dfs):
+            features.append_frame(lang, user_id, user_edit_df)
+
+    run_per_lang(lang_total_edits, langs, 'add_total_edits')
+    return df if accumulator is not None else features.join(df)
 
 
 def remove_with_min_edit_count(df, min_edit_count=4):
@@ -260,12 +516,49 @@ def stratified_subsampler(df, sample_size, newcomer_multiplier=2):
     return pd.concat(subsamples)
 
 
+def make_feature_pipeline(wikipedia_start_date, sim_treatment_date, sim_observation_start_date, sim_experiment_end_date,
+                          wmf_con):
+    """the per-user columns make_data adds once the sample is settled, as checkpointed pipeline nodes"""
+    pipeline = FeaturePipeline()
+    pipeline.add('num_prev_thanks_in_90_pre_treatment', add_thanks, inputs=['user_name'],
+                 start_date=sim_observation_start_date, end_date=sim_treatment_date,
+                 col_name='num_prev_thanks_in_90_pre_treatment', wmf_con=wmf_con)
+    pipeline.add('edits_pre_treatment', add_total_edits, start_date=wikipedia_start_date, end_date=sim_treatment_date,
+                 wmf_con=wmf_con)
+    pipeline.add('has_email', add_has_email_currently, wmf_con=wmf_con)
+    quality_namespace_fns = {'num_quality_pre_treatment': namespace_all,
+                             'num_quality_pre_treatment_non_talk': namespace_nontalk,
+                             'num_quality_pre_treatment_main_only': namespace_mainonly}
+    # one node so every user's revisions are fetched and scored once for all three
+    pipeline.add('num_quality', add_num_quality_by_namespace, outputs=list(quality_namespace_fns),
+                 namespace_fns=quality_namespace_fns, end_date=sim_treatment_date, wmf_con=wmf_con)
+
+    edit_features = [
+        edit_window_feature('num_edits_90_pre_treatment', len, sim_observation_start_date, sim_treatment_date),
+        edit_window_feature('num_edits_90_post_treatment', len, sim_treatment_date, sim_experiment_end_date),
+        edit_window_feature('num_labor_hours_90_pre_treatment', calc_labour_hours, sim_observation_start_date,
+                            sim_treatment_date),
+        edit_window_feature('num_labor_hours_90_post_treatment', calc_labour_hours, sim_treatment_date,
+                            sim_experiment_end_date),
+        edit_window_feature('num_edits_90_post_treatment', len, sim_treatment_date, sim_experiment_end_date,
+                            by_week=True),
+        edit_window_feature('num_labor_hours_90_post_treatment', calc_labour_hours, sim_treatment_date,
+                            sim_experiment_end_date, by_week=True),
+    ]
+    # one node for all of them so every user's timestamps are still fetched once
+    pipeline.add('edit_windows', add_edit_features, outputs=edit_window_columns(edit_features),
+                 features=edit_features, wmf_con=wmf_con)
+    return pipeline
+
+
 def make_data(subsample, wikipedia_start_date, sim_treatment_date, sim_observation_start_date, sim_experiment_end_date,
-              wmf_con):
+              wmf_con, columns=None):
+    """columns is the pipeline columns to add, all of them by default"""
     print('starting to make data')
     # embed()
-    df = make_populations(start_date=wikipedia_start_date, end_date=sim_treatment_date, wmf_con=wmf_con)
-    df = remove_inactive_users(df, start_date=sim_observation_start_date, end_date=sim_treatment_date)
+    df = make_populations(start_date=wikipedia_start_date, end_date=sim_treatment_date, wmf_con=wmf_con,
+                          chunk_filter=lambda span_df: remove_inactive_users(span_df, start_date=sim_observation_start_date,
+                                                                             end_date=sim_treatment_date))
     if not subsample:
         output_bin_stats(df)
     df = add_experience_bin(df)
@@ -290,43 +583,12 @@ def make_data(subsample, wikipedia_start_date, sim_treatment_date, sim_observati
     print('Second Random Stratified subsample to Get Edit Quality Data')
     print(df.groupby(['lang','experience_level_pre_treatment']).size())
 
-    print("adding thanks")
-    df = add_thanks(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
-                    col_name='num_prev_thanks_in_90_pre_treatment', wmf_con=wmf_con)
-
-    print("adding thanks")
-    df = add_total_edits(df, start_date=wikipedia_start_date, end_date=sim_treatment_date, wmf_con=wmf_con)
-    print("adding email")
-    df = add_has_email_currently(df, wmf_con=wmf_con)
-
-    print("adding quality")
-    df = add_num_quality(df, col_name='num_quality_pre_treatment', wmf_con=wmf_con, namespace_fn=namespace_all, end_date=sim_treatment_date)
-    print("adding quality nontalk")
-    df = add_num_quality(df, col_name='num_quality_pre_treatment_non_talk', namespace_fn=namespace_nontalk, end_date=sim_treatment_date, wmf_con=wmf_con)
-    print("adding quality main only")
-    df = add_num_quality(df, col_name='num_quality_pre_treatment_main_only', namespace_fn=namespace_mainonly, end_date=sim_treatment_date, wmf_con=wmf_con)
-
-    print('adding 90 pre treatment')
-    df = add_edits_fn(df, col_name='num_edits_90_pre_treatment', wmf_con=wmf_con, start_date=sim_observation_start_date,
-                      end_date=sim_treatment_date, timestamp_list_fn=len)
-    print('adding 90 post treatment')
-    df = add_edits_fn(df, col_name='num_edits_90_post_treatment', wmf_con=wmf_con, start_date=sim_treatment_date,
-                      end_date=sim_experiment_end_date, timestamp_list_fn=len)
-    print('adding laborhours pre treatment')
-    df = add_edits_fn(df, col_name='num_labor_hours_90_pre_treatment', wmf_con=wmf_con, start_date=sim_observation_start_date,
-                      end_date=sim_treatment_date, timestamp_list_fn=calc_labour_hours)
-    print('adding laborhours post treatment')
-    df = add_edits_fn(df, col_name='num_labor_hours_90_post_treatment', wmf_con=wmf_con, start_date=sim_treatment_date,
-                      end_date=sim_experiment_end_date, timestamp_list_fn=calc_labour_hours)
-
-    print('adding 90 post treatment by week')
-    df = add_edits_fn_by_week(df, col_name='num_edits_90_post_treatment', wmf_con=wmf_con, start_date=sim_treatment_date,
-                      end_date=sim_experiment_end_date, timestamp_list_fn=len)
-    print('adding laborhours post treatment')
-    df = add_edits_fn_by_week(df, col_name='num_labor_hours_90_post_treatment', wmf_con=wmf_con, start_date=sim_treatment_date,
-                      end_date=sim_experiment_end_date, timestamp_list_fn=calc_labour_hours)
-
-
+    print('adding thanks, total edits, email, quality, and edits and laborhours 90 pre/post treatment, '
+          'and post treatment by week')
+    pipeline = make_feature_pipeline(wikipedia_start_date, sim_treatment_date, sim_observation_start_date,
+                                     sim_experiment_end_date, wmf_con)
+    df = pipeline.run(df, columns=columns)
+    print_cache_stats()
     print('done')
     return df
 
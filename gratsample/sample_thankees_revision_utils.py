@@ -1,5 +1,6 @@
 # coding: utf-8
 import datetime
+import threading
 import sqlalchemy
 
 import os
@@ -7,11 +8,23 @@ import pandas as pd
 
 from gratsample import ores_api
 
+from gratsample import cached_df
 from gratsample.cached_df import make_cached_df
-from gratsample.wikipedia_helpers import make_wmf_con, to_wmftimestamp, from_wmftimestamp
+from gratsample.display_store import DisplayDataStore
+from gratsample.http_clients import get_ores_session, get_mwapi_session, get_executor
+from gratsample.wikipedia_helpers import make_wmf_con, to_wmftimestamp, from_wmftimestamp, lang_con, \
+    make_internal_db_session
 
 CACHE_ROOT = os.getenv('CACHE_DIR', './cache')
+# one ScoreStore per sqlite path, its connections are per thread
+ORES_SCORE_STORES = {}
+ORES_SCORE_STORES_LOCK = threading.Lock()
 GRAT_ROOT = os.getenv('GRAT_DIR', '../gratitude/outputs/')
+# compare calls in flight at once for get_display_data_batched, and revisions per timestamp query (the api's limit)
+DISPLAY_DATA_WORKERS = int(os.getenv('DISPLAY_DATA_WORKERS', 8))
+DISPLAY_REVIDS_PER_QUERY = 50
+# a ceiling on requests to ORES, unset leaves it to the session's throttling backoff
+ORES_REQUESTS_PER_SECOND = float(os.getenv('ORES_REQUESTS_PER_SECOND', 0)) or None
 
 # In[130]:
 
@@ -40,8 +53,8 @@ def get_revisions_and_flagged_data(rev_ids, treatment_date, con):
     rev_flag_params = {
                        'treatment_date': to_wmftimestamp(treatment_date)}
     # print(rev_flag_params)
-    con.execute('use dewiki_p;')
-    rev_flag = pd.read_sql(sqlalchemy.text(rev_flag_sql), con, params=rev_flag_params)
+    with lang_con(con, 'de') as de_con:
+        rev_flag = pd.read_sql(sqlalchemy.text(rev_flag_sql), de_con, params=rev_flag_params)
     rev_flag['fr_timestamp'] = rev_flag['fr_timestamp'].apply(from_wmftimestamp)
     rev_flag['max_fr_ts'] = rev_flag['max_fr_ts'].apply(from_wmftimestamp)
     rev_flag['rev_timestamp'] = rev_flag['rev_timestamp'].apply(from_wmftimestamp)
@@ -93,8 +106,7 @@ def get_flagged_decision_df(rev_ids, treatment_date, con):
     rev_df = get_revisions_and_flagged_data(rev_ids, treatment_date, con)
     if len(rev_df)==0:
         return rev_df
-    mwapi_session_de = mwapi.Session('https://de.wikipedia.org',
-        user_agent='CivilServant Experiment Sampler <max.klein@civilservant.io>')
+    mwapi_session_de = get_mwapi_session('https://de.wikipedia.org')
     rev_df['was_reverted'] = rev_df.apply(
         lambda row: was_reverted(row['rev_id'], mwapi_session_de) if pd.isnull(row['fr_timestamp']) else 'no_check', axis=1)
     rev_df['flagged'] = rev_df.apply(decide_flagged, axis=1)
@@ -109,23 +121,24 @@ def get_flagged_revs(rev_ids, treatment_date, con):
 
 
 # Get Revisions of Editors
-@make_cached_df('timestamps')
+@make_cached_df('timestamps', backend='sqlite', memory_bytes=256 * 2 ** 20)
 def get_timestamps_within_range(lang, user_id, con, start_date, end_date):
     '''this will get all the timestamps of edits for a user that occured before or after 90 within a
     date range from start_date to end_date'''
 
-    con.execute('use {lang}wiki_p;'.format(lang=lang))
     rev_sql = '''select rev_timestamp from revision_userindex where rev_user = :user_id
                 and rev_timestamp >= :start_date and rev_timestamp < :end_date 
                 order by rev_timestamp
                 '''
     rev_sql_esc = sqlalchemy.text(rev_sql)
     sql_params = {'user_id': int(user_id), 'start_date': to_wmftimestamp(start_date), 'end_date': to_wmftimestamp(end_date)}
-    rev_ts_series = pd.read_sql(rev_sql_esc, con=con, params=sql_params)
+    with lang_con(con, lang) as wiki_con:
+        rev_ts_series = pd.read_sql(rev_sql_esc, con=wiki_con, params=sql_params)
     rev_ts_series['rev_timestamp'] = rev_ts_series['rev_timestamp'].apply(from_wmftimestamp)
     return rev_ts_series
 
-@make_cached_df('recent_edits')
+# end_date defaults to utcnow, so these go stale
+@make_cached_df('recent_edits', backend='sqlite', ttl=datetime.timedelta(days=1))
 def get_recent_edits_alias(lang, user_id, con, prior_days=None, max_revs=None, end_date=None):
     return get_recent_edits(lang, user_id, con, prior_days=None, max_revs=None, end_date=None)
 
@@ -141,7 +154,6 @@ def get_recent_edits(lang, user_id, con, prior_days=None, max_revs=None, end_dat
         prior_days = 84
     if not max_revs:
         max_revs = 50
-    con.execute('use {lang}wiki_p;'.format(lang=lang))
     revsql = ''' select user_id, rev_timestamp, rev_id, page_id, page_namespace from
             (select user_id, ts as rev_timestamp, rev_id, rev_page from
             (select a.rev_user as user_id, timestamp(a.rev_timestamp) as ts, a.rev_id as rev_id, timestamp(b.mts) as mts, rev_page
@@ -156,7 +168,8 @@ def get_recent_edits(lang, user_id, con, prior_days=None, max_revs=None, end_dat
             join page
             on rev_page = page_id;
             '''.format(user_id=user_id, prior_days=prior_days, max_revs=max_revs, end_date=to_wmftimestamp(end_date))
-    udf = pd.read_sql(revsql, con)
+    with lang_con(con, lang) as wiki_con:
+        udf = pd.read_sql(revsql, wiki_con)
     return udf
 
 
@@ -175,30 +188,36 @@ def get_all_users_revs(refresh_users, lang, wmf_con, end_date):
     return all_users_revs
 
 
-def get_ores_data_dgf_from_api(rev_ids, context_lang):
-    session = ores_api.Session(
-        'https://ores.wikimedia.org',
-        user_agent='CivilServant Experiment Sampler <max.klein@civilservant.io>',
+def get_ores_score_store():
+    """the per-revision ORES scores shared by every run, next to the other caches"""
+    path = os.path.join(cached_df.CACHE_ROOT, 'ores_scores', 'scores.sqlite')
+    with ORES_SCORE_STORES_LOCK:
+        if path not in ORES_SCORE_STORES:
+            ORES_SCORE_STORES[path] = ores_api.ScoreStore(path)
+        return ORES_SCORE_STORES[path]
+
+
+def get_ores_session_dgf():
+    # one session for the whole run, so its connections and thread pool are reused between calls
+    return get_ores_session(
         batch_size=50,
-        parallel_requests=4,
-        retries=2)
+        retries=2,
+        score_store=get_ores_score_store(),
+        requests_per_second=ORES_REQUESTS_PER_SECOND)
+
 
+def get_ores_data_dgf_from_api(rev_ids, context_lang):
     context = f'{context_lang}wiki'
-    return session.score(context, ('damaging', 'goodfaith'), rev_ids)
+    return get_ores_session_dgf().score(context, ('damaging', 'goodfaith'), rev_ids)
+
 
-@make_cached_df('ores_ndgf')
+@make_cached_df('ores_ndgf', backend='sqlite')
 def ores_quality_getter(rev_ids, context_lang):
     # print(rev_ids)
-    scores = get_ores_data_dgf_from_api(rev_ids, context_lang)
-    # print([s for s in scores])
-    try:
-        predictions = [(sc['damaging']['score']['prediction'], sc['goodfaith']['score']['prediction']) for sc in scores]
-        # print(predictions)
-        predictions_ndgf = [(not (d) and gf) for (d, gf) in predictions]
-        # print(predictions_ndgf)
-    except KeyError:  # probably couldn't get the score for because it doesn't exist
-        predictions_ndgf = [False for i in range(len(rev_ids))]
-    #     rev_ids_scores = dict(zip(rev_ids, predictions_ndgf))
+    # just the predictions, as arrays. a revision that couldn't be scored (probably because it doesn't exist)
+    # isn't quality
+    predictions = get_ores_session_dgf().predictions(f'{context_lang}wiki', ('damaging', 'goodfaith'), rev_ids)
+    predictions_ndgf = predictions['scored'] & ~predictions['damaging'] & predictions['goodfaith']
     rev_ids_scores = pd.DataFrame.from_dict({'rev_id': rev_ids, 'quality_enough': predictions_ndgf}, orient='columns')
     rev_ids_scores['lang'] = context_lang
     return rev_ids_scores
@@ -226,7 +245,9 @@ def remove_non_quality_revs(all_user_revs, lang, wmf_con, end_date):
     elif lang in ['de']:
         revs_quality = flagged_rev_quality_getter(rev_ids, 'de', wmf_con, treatment_date=end_date)
 
-    all_user_revs_quality = pd.merge(all_user_revs, revs_quality, how="left", on=['rev_id', 'lang'])
+    # just the decision, the flagged revs frame repeats page_namespace and rev_timestamp which would get suffixed
+    all_user_revs_quality = pd.merge(all_user_revs, revs_quality[['rev_id', 'lang', 'quality_enough']], how="left",
+                                     on=['rev_id', 'lang'])
     quality_user_revs = all_user_revs_quality[all_user_revs_quality['quality_enough'] == True]
     print(f'started with {len(all_user_revs)} revs, removed {len(all_user_revs)-len(quality_user_revs)}')
     return quality_user_revs
@@ -249,10 +270,39 @@ def get_rev_dict(old_rev_id, new_rev_id, mwapi_session):
         ({'timestamp': None}, rev_data[0])
 
 
-def get_display_data(rev_ids, lang):
+def make_display_datum(diff, lang, rev_id, new_rev_date, old_rev_date):
+    return {'editDeleted': False, 'diffHTML': diff['*'], 'lang': lang,
+            'newRevId': rev_id, 'newRevDate': new_rev_date,
+            'newRevUser': diff['touser'], 'newRevComment': diff['toparsedcomment'],
+            'oldRevId': diff.get('fromrevid'), 'oldRevDate': old_rev_date,
+            'oldRevUser': diff.get('fromuser'), 'oldRevComment': diff.get('fromparsedcomment'),
+            'pageTitle': diff['totitle']}
+
+
+def deleted_display_datum(lang):
+    return {'editDeleted': True, 'diffHTML': None, 'lang': lang,
+            'newRevId': None, 'newRevDate': None, 'newRevUser': None, 'newRevComment': None,
+            'oldRevId': None, 'oldRevDate': None, 'oldRevUser': None, 'oldRevComment': None,
+            'pageTitle': None}
+
+
+def get_display_data_through_store(get_display_data_fn, rev_ids, lang, display_store):
+    """the display data of rev_ids from display_store, with only the ones it doesn't have yet fetched by
+    get_display_data_fn and then kept"""
+    stored = display_store.get_many(lang, rev_ids)
+    missing = [rev_id for rev_id in dict.fromkeys(rev_ids) if int(rev_id) not in stored]
+    fetched = get_display_data_fn(missing, lang) if missing else []
+    display_store.put_many(lang, missing, fetched)
+    fetched = dict(zip(missing, fetched))
+    return [stored[int(rev_id)] if int(rev_id) in stored else fetched[rev_id] for rev_id in rev_ids]
+
+
+def get_display_data(rev_ids, lang, display_store=None):
+    """display_store is an optional display_store.DisplayDataStore to look the rev_ids up in first"""
+    if display_store is not None:
+        return get_display_data_through_store(get_display_data, rev_ids, lang, display_store)
     display_data = []
-    mwapi_session = mwapi.Session(host=f'https://{lang}.wikipedia.org',
-                                  user_agent='civilservant datagathering <max@notconfusing.com>')
+    mwapi_session = get_mwapi_session(f'https://{lang}.wikipedia.org')
     for rev_id in rev_ids:
         try:
             diff = get_diff_html_dict(rev_id=rev_id, mwapi_session=mwapi_session)
@@ -262,22 +312,59 @@ def get_display_data(rev_ids, lang):
                 old_rev_id = None
             old_rev_data, new_rev_data = get_rev_dict(old_rev_id=old_rev_id, new_rev_id=rev_id,
                                                       mwapi_session=mwapi_session)
-            display_datum = {'editDeleted': False, 'diffHTML': diff['*'], 'lang': lang,
-                             'newRevId': rev_id, 'newRevDate': new_rev_data['timestamp'],
-                             'newRevUser': diff['touser'], 'newRevComment': diff['toparsedcomment'],
-                             'oldRevId': diff['fromrevid'], 'oldRevDate': old_rev_data['timestamp'],
-                             'oldRevUser': diff['fromuser'], 'oldRevComment': diff['fromparsedcomment'],
-                             'pageTitle': diff['totitle']}
+            display_datum = make_display_datum(diff, lang, rev_id, new_rev_data['timestamp'],
+                                               old_rev_data['timestamp'])
         except mwapi.errors.APIError:
-            display_datum = {'editDeleted': True, 'diffHTML': None, 'lang': lang,
-                             'newRevId': None, 'newRevDate': None, 'newRevUser': None, 'newRevComment': None,
-                             'oldRevId': None, 'oldRevDate': None, 'oldRevUser': None, 'oldRevComment': None,
-                             'pageTitle': None}
+            display_datum = deleted_display_datum(lang)
         display_data.append(display_datum)
 
     return display_data
 
-@make_cached_df('qualityedits')
+
+def get_rev_timestamps(rev_ids, mwapi_session):
+    """{rev_id: timestamp} of many revisions, DISPLAY_REVIDS_PER_QUERY to a query"""
+    rev_ids = list(dict.fromkeys(int(rev_id) for rev_id in rev_ids))
+    timestamps = {}
+    for start in range(0, len(rev_ids), DISPLAY_REVIDS_PER_QUERY):
+        revids_str = '|'.join(str(rev_id) for rev_id in rev_ids[start:start + DISPLAY_REVIDS_PER_QUERY])
+        ret = mwapi_session.get(revids=revids_str, action='query', prop='revisions', rvprop='ids|timestamp')
+        # revisions that don't exist anymore come back under badrevids instead
+        for page in ret['query'].get('pages', {}).values():
+            for rev_data in page.get('revisions', []):
+                timestamps[rev_data['revid']] = rev_data['timestamp']
+    return timestamps
+
+
+def get_display_data_batched(rev_ids, lang, display_store=None):
+    """get_display_data with the compare calls made DISPLAY_DATA_WORKERS at a time and the timestamps
+    looked up in batches, in the order of rev_ids"""
+    if display_store is not None:
+        return get_display_data_through_store(get_display_data_batched, rev_ids, lang, display_store)
+    mwapi_session = get_mwapi_session(f'https://{lang}.wikipedia.org')
+    executor = get_executor('display_data', DISPLAY_DATA_WORKERS)
+
+    def get_diff_or_none(rev_id):
+        try:
+            return get_diff_html_dict(rev_id=rev_id, mwapi_session=mwapi_session)
+        except mwapi.errors.APIError:
+            return None
+
+    diffs = list(executor.map(get_diff_or_none, rev_ids))
+    timestamps = get_rev_timestamps([rev_id for rev_id, diff in zip(rev_ids, diffs) if diff is not None] +
+                                    [diff['fromrevid'] for diff in diffs if diff is not None and 'fromrevid' in diff],
+                                    mwapi_session)
+    display_data = []
+    for rev_id, diff in zip(rev_ids, diffs):
+        if diff is None:
+            display_data.append(deleted_display_datum(lang))
+            continue
+        # the very first edit on a page has no previous revision
+        old_rev_date = timestamps.get(diff['fromrevid']) if 'fromrevid' in diff else None
+        display_data.append(make_display_datum(diff, lang, rev_id, timestamps.get(int(rev_id)), old_rev_date))
+    return display_data
+
+
+@make_cached_df('qualityedits', backend='sqlite')
 def get_quality_edits_of_users(refresh_users, lang, wmf_con, namespace_fn=None, end_date=None):
     """get all the quality edits of refresh_users that are 90 days before their last stored or live"""
     all_user_revs = get_all_users_revs(refresh_users, lang, wmf_con, end_date)
@@ -298,19 +385,29 @@ def num_quality_revisions(user_id, lang, wmf_con=None, namespace_fn=None, end_da
     return len(all_user_revs)
 
 
-def refresh_revisions(refresh_users, lang, con):
+def num_quality_revisions_by_namespace(user_id, lang, namespace_fns, wmf_con=None, end_date=None):
+    """the number of quality revisions a user has in each of namespace_fns' namespaces, from one fetch
+    and scoring of their revisions. returns the counts lined up with namespace_fns"""
+    refresh_user = pd.DataFrame({'user_id': [user_id]})
+    if not wmf_con:
+        wmf_con = make_wmf_con()
+    all_user_revs = get_quality_edits_of_users(refresh_user, lang, wmf_con, end_date=end_date)
+    if len(all_user_revs) == 0:
+        return [0 for _ in namespace_fns]
+    return [int(all_user_revs['page_namespace'].apply(namespace_fn).sum()) for namespace_fn in namespace_fns]
+
+
+def refresh_revisions(refresh_users, lang, con, display_store=None):
     """assumption we are only refreshing users who are known to need refresh.
     we assume that another process calculates who needs refersh based on their edit count.
     In additon just doing 1 `lang` at a time. So a calling function would have to loop over langs"""
     # do this in a user-oriented way, or a process-oriented way?
     # revisions of users
     all_user_revs = get_quality_edits_of_users(refresh_users, lang, con)
-    # already recevied revisions
-    already_revs = get_already_revs(lang)
-    # revisions needing getting = revs - already
-    revs_to_get = set_subtract(all_user_revs, already_revs)
-    # get and store.
-    display_data = get_display_data(revs_to_get, lang)
+    # already recevied revisions are in the display store, only the rest are fetched, and then stored.
+    if display_store is None:
+        display_store = DisplayDataStore(make_internal_db_session())
+    display_data = get_display_data_batched(all_user_revs['rev_id'].tolist(), lang, display_store=display_store)
 
     # return explictly the display data that would need to be sync'd back to server
     return display_data
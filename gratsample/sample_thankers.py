@@ -24,6 +24,18 @@ from datetime import timedelta as td
 import time
 import functools
 
+from gratsample.cached_df import open_store
+from gratsample.features import FeatureAccumulator
+from gratsample.pipeline import FeaturePipeline
+from gratsample.wikipedia_helpers import stream_sql_to_parquet, read_spilled, lang_con, run_per_lang
+
+# the per-user caches live in one sqlite store per sub-dir, import old pickle dirs with
+# python -m gratsample.cache_cli migrate ../cache/edithistory edithistory --cache-root ../cache
+THANKER_CACHE_ROOT = os.path.join('..', 'cache')
+
+# stream the population queries this many rows at a time instead of loading a whole wiki, 0 turns it off
+POPULATION_CHUNKSIZE = int(os.getenv('POPULATION_CHUNKSIZE', 0)) or None
+
 
 def wmftimestamp(bytestring):
     if bytestring:
@@ -120,27 +132,43 @@ lang_sqlparams = {'de': {'pop_sql': de_pop_sql,
                   }
 
 
-def create_thanker_pop(lang, pop_sql, true_cols_to_add):
-    cache_key = f'../cache/pops/{lang}'
+def decode_thanker_pop(df, lang, true_cols_to_add):
+    decode_cols = ['ug_group', 'user_name', ]
+    timestamp_cols = ['user_registration', 'most_recent_edit']
+    for decode_col in decode_cols:
+        try:
+            df[decode_col] = df[decode_col].apply(decode_or_none)
+        except KeyError:
+            df[decode_col] = float('nan')
+    for timestamp_col in timestamp_cols:
+        df[timestamp_col] = df[timestamp_col].apply(wmftimestamp)
+    for true_col_to_add in true_cols_to_add:
+        df[true_col_to_add] = True
+
+    df['lang'] = lang
+    return df
+
+
+def create_thanker_pop(lang, pop_sql, true_cols_to_add, chunksize=POPULATION_CHUNKSIZE):
+    if chunksize:
+        # the streamed population is filtered, so it can't share a key with the unfiltered one
+        cache_key = f'../cache/pops/{lang}_active_since_{sim_observation_start_date.strftime("%Y%m%d")}'
+    else:
+        cache_key = f'../cache/pops/{lang}'
     print(f'working on pop for {cache_key}')
     if os.path.exists(cache_key):
         return pd.read_pickle(cache_key)
     else:
-        con.execute(f'use {lang}wiki_p;')
-        df = pd.read_sql(pop_sql, con)
-        decode_cols = ['ug_group', 'user_name', ]
-        timestamp_cols = ['user_registration', 'most_recent_edit']
-        for decode_col in decode_cols:
-            try:
-                df[decode_col] = df[decode_col].apply(decode_or_none)
-            except KeyError:
-                df[decode_col] = float('nan')
-        for timestamp_col in timestamp_cols:
-            df[timestamp_col] = df[timestamp_col].apply(wmftimestamp)
-        for true_col_to_add in true_cols_to_add:
-            df[true_col_to_add] = True
-
-        df['lang'] = lang
+        with lang_con(con, lang) as wiki_con:
+            if chunksize:
+                # inactive users are dropped chunk by chunk as they come off the cursor
+                run_dir = stream_sql_to_parquet(pop_sql, wiki_con, f'../cache/pops/lang={lang}', chunksize,
+                                                chunk_fn=lambda chunk_df: remove_inactive_users(
+                                                    decode_thanker_pop(chunk_df, lang, true_cols_to_add)))
+                df = read_spilled(run_dir, remove=True)
+            else:
+                df = pd.read_sql(pop_sql, wiki_con)
+                df = decode_thanker_pop(df, lang, true_cols_to_add)
         df.to_pickle(cache_key)
         return df
 
@@ -154,12 +182,12 @@ def get_bans(lang, start_date, end_date):
     if not os.path.exists(cache_key):
         start_stamp = start_date.strftime('%Y%m%d%H%M%S')
         end_stamp = end_date.strftime('%Y%m%d%H%M%S')
-        con.execute(f'use {lang}wiki_p;')
         ban_sql = f"""select log_user as blocking_user_id, log_user_text as blocking_user_name, log_title as blocked_user_name 
         from logging where log_action='block' 
         and log_timestamp >= {start_stamp} and log_timestamp < {end_stamp};"""
         #         print(ban_sql)
-        ban_df = pd.read_sql(ban_sql, con)
+        with lang_con(con, lang) as wiki_con:
+            ban_df = pd.read_sql(ban_sql, wiki_con)
         ban_df['blocking_user_name'] = ban_df['blocking_user_name'].apply(decode_or_none)
         ban_df['blocked_user_name'] = ban_df['blocked_user_name'].apply(decode_or_none)
         ban_df['lang'] = lang
@@ -172,13 +200,8 @@ def get_bans(lang, start_date, end_date):
 
 
 def add_blocks(start_date, end_date, col_label, df):
-    ban_dfs = []
-    for lang in lang_sqlparams.keys():
-        #     print(lang)
-        t0 = time.time()
-        ban_df = get_bans(lang, start_date, end_date)
-        ban_dfs.append(ban_df)
-    #         print(f'{lang} took {time.time()-t0}.')
+    ban_dfs = run_per_lang(lambda lang: get_bans(lang, start_date, end_date), lang_sqlparams.keys(),
+                           f'add_blocks {col_label}')
 
     bans = pd.concat(ban_dfs)
 
@@ -206,11 +229,13 @@ def add_blocks_post_treatment(df):
 
 # Just cache user histories
 def get_user_edits(lang, user_id, start_date, end_date):
-    cache_key = f'../cache/edithistory/{lang}_{user_id}_{start_date}_{end_date}.pickle'
-    if not os.path.exists(cache_key):
+    store = open_store('edithistory', cache_root=THANKER_CACHE_ROOT)
+    cache_key = f'{lang}_{user_id}_{start_date}_{end_date}'
+    try:
+        user_df = store.get(cache_key)
+    except KeyError:
         start_stamp = start_date.strftime('%Y%m%d%H%M%S')
         end_stamp = end_date.strftime('%Y%m%d%H%M%S')
-        con.execute(f'use {lang}wiki_p;')
         user_sql = f"""select rev_id, rev_timestamp, page_id, page_namespace from
                         (select * from revision_userindex 
                          where rev_user = {user_id} and
@@ -218,39 +243,37 @@ def get_user_edits(lang, user_id, start_date, end_date):
                         user_revs
                         join page where rev_page = page_id;"""
 
-        user_df = pd.read_sql(user_sql, con)
+        with lang_con(con, lang) as wiki_con:
+            user_df = pd.read_sql(user_sql, wiki_con)
         user_df['rev_timestamp'] = user_df['rev_timestamp'].apply(wmftimestamp)
         user_df['lang'] = lang
 
-        user_df.to_pickle(cache_key)
-    else:
-        user_df = pd.read_pickle(cache_key)
+        store.put(cache_key, user_df, {'lang': lang, 'user_id': int(user_id)})
 
     return user_df
 
 
 # @timeit
 def cache_all_user_edits(df):
-    count = 0
-    for lang in lang_sqlparams.keys():
+    def lang_cache_user_edits(lang):
         for start_date, end_date in ((sim_observation_start_date, sim_treatment_date),
                                      (sim_treatment_date, sim_experiment_end_date)):
             user_ids = df[df['lang'] == lang]['user_id'].values
             for user_id in user_ids:
-                #                 if count % 1000 == 0:
-                #                     print(f'Count {count} lang {lang} userid {user_id}')
                 user_df = get_user_edits(lang, user_id, start_date, end_date)
-                count += 1
+
+    run_per_lang(lang_cache_user_edits, lang_sqlparams.keys(), 'cache_all_user_edits')
 
 
 # REVERTS
 
 
 def get_num_reverts(lang, user_id, user_df, start_date, end_date, schema):
-    cache_key = f'../cache/reverts/{lang}_{user_id}_{start_date}_{end_date}.pickle'
-    if os.path.exists(cache_key):
-        return pd.read_pickle(cache_key)
-    else:
+    store = open_store('reverts', cache_root=THANKER_CACHE_ROOT)
+    cache_key = f'{lang}_{user_id}_{start_date}_{end_date}'
+    try:
+        return store.get(cache_key)
+    except KeyError:
         # session = mwapi.Session(f"https://{lang}.wikipedia.org", user_agent="max.klein@civilservant.io gratitude power analysis generator")
 
         revertings = 0
@@ -266,7 +289,7 @@ def get_num_reverts(lang, user_id, user_df, start_date, end_date, schema):
         col_name = f'num_reverts_90_{col_name_suffix}_treatment'
         user_reverts_df = pd.DataFrame.from_dict({col_name: [revertings], 'user_id': [user_id], 'lang': [lang]},
                                                  orient='columns')
-        user_reverts_df.to_pickle(cache_key)
+        store.put(cache_key, user_reverts_df, {'lang': lang, 'user_id': int(user_id)})
         return user_reverts_df
 
 
@@ -276,22 +299,19 @@ def get_schema(lang):
 
 
 
-def create_reverts_df(df, start_date, end_date):
-    count = 0
-    reverts_dfs = []
-    for lang in lang_sqlparams.keys():
+def create_reverts_df(df, start_date, end_date, accumulator):
+    """add every user's number of reverts to accumulator"""
+    def lang_reverts(lang):
         schema = get_schema(lang)
         user_ids = df[df['lang'] == lang]['user_id'].values
         for user_id in user_ids:
             user_df = get_user_edits(lang, user_id, start_date, end_date)
-            t0 = time.time()
             tries = 0
             while tries < 5:
                 try:
                     # print(f'working on user_id {user_id} having {len(user_df)} edits')
                     user_revert_df = get_num_reverts(lang, user_id, user_df, start_date, end_date, schema)
-                    reverts_dfs.append(user_revert_df)
-                    count += 1
+                    accumulator.append_frame(lang, user_id, user_revert_df)
                     break
                 except OperationalError as e:
                     print(e)
@@ -299,24 +319,27 @@ def create_reverts_df(df, start_date, end_date):
                     tries += 1
                     if tries > 5:
                         raise e
-    reverts_df = pd.concat(reverts_dfs)
-    return reverts_df
 
+    run_per_lang(lang_reverts, lang_sqlparams.keys(), 'create_reverts_df')
+    return accumulator
 
-def create_and_merge_revert_actions(df, start_date, end_date):
-    reverts_df = create_reverts_df(df, start_date, end_date)
-    df = pd.merge(df, reverts_df, how='left', on=['lang', 'user_id'])
-    return df
+
+def create_and_merge_revert_actions(df, start_date, end_date, accumulator=None):
+    features = create_reverts_df(df, start_date, end_date,
+                                 accumulator if accumulator is not None else FeatureAccumulator())
+    return df if accumulator is not None else features.join(df)
 
 
 # @timeit
-def add_revert_actions_pre_treatment(df):
-    return create_and_merge_revert_actions(df, start_date=sim_observation_start_date, end_date=sim_treatment_date)
+def add_revert_actions_pre_treatment(df, accumulator=None):
+    return create_and_merge_revert_actions(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
+                                           accumulator=accumulator)
 
 
 # @timeit
-def add_revert_actions_post_treatment(df):
-    return create_and_merge_revert_actions(df, start_date=sim_treatment_date, end_date=sim_experiment_end_date)
+def add_revert_actions_post_treatment(df, accumulator=None):
+    return create_and_merge_revert_actions(df, start_date=sim_treatment_date, end_date=sim_experiment_end_date,
+                                           accumulator=accumulator)
 
 
 # TALKPAGES
@@ -328,27 +351,22 @@ def get_talk_counts(lang, user_id, user_df, start_date, end_date, namespace_fn):
     return user_talk_df
 
 
-def create_talk_df(df, start_date, end_date, namespace_fn):
-    count = 0
-    talk_dfs = []
-    for lang in lang_sqlparams.keys():
+def create_talk_df(df, start_date, end_date, namespace_fn, accumulator):
+    """add every user's number of edits in namespace_fn's namespaces to accumulator"""
+    def lang_talk(lang):
         user_ids = df[df['lang'] == lang]['user_id'].values
         for user_id in user_ids:
-            #                 if count % 1000 == 0:
-            #                     print(f'Count {count} lang {lang} userid {user_id}')
             user_df = get_user_edits(lang, user_id, start_date, end_date)
-            t0 = time.time()
-            user_talk_df = get_talk_counts(lang, user_id, user_df, start_date, end_date, namespace_fn)
-            #                 print(f'user_id {user_id} took {time.time()-t0} to get reverts')
-            talk_dfs.append(user_talk_df)
-    talk_df = pd.concat(talk_dfs)
-    return talk_df
+            accumulator.append(namespace_fn['col'], lang, user_id, user_df['page_namespace'].apply(namespace_fn['fn']).sum())
 
+    run_per_lang(lang_talk, lang_sqlparams.keys(), f"create_talk_df {namespace_fn['col']}")
+    return accumulator
 
-def create_and_merge_talk(df, start_date, end_date, namespace_fn):
-    talk_df = create_talk_df(df, start_date, end_date, namespace_fn)
-    df = pd.merge(df, talk_df, how='left', on=['lang', 'user_id'])
-    return df
+
+def create_and_merge_talk(df, start_date, end_date, namespace_fn, accumulator=None):
+    features = create_talk_df(df, start_date, end_date, namespace_fn,
+                              accumulator if accumulator is not None else FeatureAccumulator())
+    return df if accumulator is not None else features.join(df)
 
 
 def is_wp_page(namespace):
@@ -360,27 +378,31 @@ def is_talk_page(namespace):
 
 
 # @timeit
-def add_support_talk_90_pre_treatment(df):
+def add_support_talk_90_pre_treatment(df, accumulator=None):
     return create_and_merge_talk(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
-                                 namespace_fn={'col': 'support_talk_90_pre_treatment', 'fn': is_talk_page})
+                                 namespace_fn={'col': 'support_talk_90_pre_treatment', 'fn': is_talk_page},
+                                 accumulator=accumulator)
 
 
 # @timeit
-def add_support_talk_90_post_treatment(df):
+def add_support_talk_90_post_treatment(df, accumulator=None):
     return create_and_merge_talk(df, start_date=sim_treatment_date, end_date=sim_experiment_end_date,
-                                 namespace_fn={'col': 'support_talk_90_post_treatment', 'fn': is_talk_page})
+                                 namespace_fn={'col': 'support_talk_90_post_treatment', 'fn': is_talk_page},
+                                 accumulator=accumulator)
 
 
 # @timeit
-def add_project_talk_90_pre_treatment(df):
+def add_project_talk_90_pre_treatment(df, accumulator=None):
     return create_and_merge_talk(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
-                                 namespace_fn={'col': 'project_talk_90_pre_treatment', 'fn': is_wp_page})
+                                 namespace_fn={'col': 'project_talk_90_pre_treatment', 'fn': is_wp_page},
+                                 accumulator=accumulator)
 
 
 # @timeit
-def add_project_talk_90_post_treatment(df):
+def add_project_talk_90_post_treatment(df, accumulator=None):
     return create_and_merge_talk(df, start_date=sim_treatment_date, end_date=sim_experiment_end_date,
-                                 namespace_fn={'col': 'project_talk_90_post_treatment', 'fn': is_wp_page})
+                                 namespace_fn={'col': 'project_talk_90_post_treatment', 'fn': is_wp_page},
+                                 accumulator=accumulator)
 
 
 # ENCOURAGEMENT
@@ -399,10 +421,11 @@ class preloaded_csvs():
 
 
 def get_num_grats(lang, user_id, user_df, start_date, end_date, grat_type, preloaded):
-    cache_key = f'../cache/{grat_type}/{lang}_{user_id}_{start_date}_{end_date}.pickle'
-    if os.path.exists(cache_key):
-        return pd.read_pickle(cache_key)
-    else:
+    store = open_store(grat_type, cache_root=THANKER_CACHE_ROOT)
+    cache_key = f'{lang}_{user_id}_{start_date}_{end_date}'
+    try:
+        return store.get(cache_key)
+    except KeyError:
         # this could be optimized by keeping this in memory
         csv_path = os.path.join(GRAT_DIR, lang, 'outputs')
         lsdir = os.listdir(csv_path)
@@ -420,66 +443,59 @@ def get_num_grats(lang, user_id, user_df, start_date, end_date, grat_type, prelo
         user_grat_df = pd.DataFrame.from_dict({col_name: [num_grats],
                                                'user_id': [user_id],
                                                'lang': [lang]}, orient='columns')
+        store.put(cache_key, user_grat_df, {'lang': lang, 'user_id': int(user_id)})
         return user_grat_df
 
 
-def create_grat_df(df, start_date, end_date, grat_type):
-    count = 0
-    grat_dfs = []
+def create_grat_df(df, start_date, end_date, grat_type, accumulator):
+    """add every user's number of `grat_type`s sent to accumulator"""
     preloaded = preloaded_csvs()
-    for lang in lang_sqlparams.keys():
+
+    def lang_grats(lang):
         user_ids = df[df['lang'] == lang]['user_id'].values
         for user_id in user_ids:
-            #                 if count % 1000 == 0:
-            #                     print(f'Count {count} lang {lang} userid {user_id}')
             user_df = get_user_edits(lang, user_id, start_date, end_date)
-            t0 = time.time()
             user_grat_df = get_num_grats(lang, user_id, user_df, start_date, end_date, grat_type, preloaded)
-            #                 print(f'user_id {user_id} took {time.time()-t0} to get reverts')
-            grat_dfs.append(user_grat_df)
-            count += 1
-    grat_df = pd.concat(grat_dfs)
-    return grat_df
+            accumulator.append_frame(lang, user_id, user_grat_df)
 
+    run_per_lang(lang_grats, lang_sqlparams.keys(), f'create_grat_df {grat_type}')
+    return accumulator
 
-def create_and_merge_encouragement(df, start_date, end_date, grat_type):
-    grat_df = create_grat_df(df, start_date, end_date, grat_type)
-    df = pd.merge(df, grat_df, how='left', on=['lang', 'user_id'])
-    return df
+
+def create_and_merge_encouragement(df, start_date, end_date, grat_type, accumulator=None):
+    features = create_grat_df(df, start_date, end_date, grat_type,
+                              accumulator if accumulator is not None else FeatureAccumulator())
+    return df if accumulator is not None else features.join(df)
 
 
 # @timeit
-def add_thanks_90_pre_treatment(df):
+def add_thanks_90_pre_treatment(df, accumulator=None):
     return create_and_merge_encouragement(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
-                                          grat_type='thank')
+                                          grat_type='thank', accumulator=accumulator)
 
 
 # @timeit
-def add_thanks_90_post_treatment(df):
+def add_thanks_90_post_treatment(df, accumulator=None):
     return create_and_merge_encouragement(df, start_date=sim_treatment_date, end_date=sim_experiment_end_date,
-                                          grat_type='thank')
+                                          grat_type='thank', accumulator=accumulator)
 
 
 # @timeit
-def add_wikilove_90_pre_treatment(df):
+def add_wikilove_90_pre_treatment(df, accumulator=None):
     return create_and_merge_encouragement(df, start_date=sim_observation_start_date, end_date=sim_treatment_date,
-                                          grat_type='love')
+                                          grat_type='love', accumulator=accumulator)
 
 
 # @timeit
-def add_wikilove_90_post_treatment(df):
+def add_wikilove_90_post_treatment(df, accumulator=None):
     return create_and_merge_encouragement(df, start_date=sim_treatment_date, end_date=sim_experiment_end_date,
-                                          grat_type='love')
+                                          grat_type='love', accumulator=accumulator)
 
 
 # @timeit
 def get_populations():
-    lang_dfs = []
-
-    for lang, sqlparams in lang_sqlparams.items():
-        # print(f'Doing {lang}, with {sqlparams}.')
-        lang_df = create_thanker_pop(lang, **sqlparams)
-        lang_dfs.append(lang_df)
+    lang_dfs = run_per_lang(lambda lang: create_thanker_pop(lang, **lang_sqlparams[lang]), lang_sqlparams.keys(),
+                            'get_populations')
 
     df = pd.concat(lang_dfs)
     del lang_dfs
@@ -489,7 +505,29 @@ def remove_inactive_users(df):
     return df[df['most_recent_edit'] >= sim_observation_start_date]
 
 
-def make_data(subsample=None):
+def make_feature_pipeline():
+    """the per-user columns make_data adds, as checkpointed pipeline nodes"""
+    pipeline = FeaturePipeline(cache_root=THANKER_CACHE_ROOT)
+    windows = {'pre': (sim_observation_start_date, sim_treatment_date),
+               'post': (sim_treatment_date, sim_experiment_end_date)}
+    for suffix, (start_date, end_date) in windows.items():
+        col_name = f'num_reverts_90_{suffix}_treatment'
+        pipeline.add(col_name, create_and_merge_revert_actions, start_date=start_date, end_date=end_date)
+    for talk_type, namespace_fn in (('support', is_talk_page), ('project', is_wp_page)):
+        for suffix, (start_date, end_date) in windows.items():
+            col_name = f'{talk_type}_talk_90_{suffix}_treatment'
+            pipeline.add(col_name, create_and_merge_talk, start_date=start_date, end_date=end_date,
+                         namespace_fn={'col': col_name, 'fn': namespace_fn})
+    for grat_type in ('thank', 'love'):
+        for suffix, (start_date, end_date) in windows.items():
+            col_name = f'wiki{grat_type}_90_{suffix}_treatment'
+            pipeline.add(col_name, create_and_merge_encouragement, start_date=start_date, end_date=end_date,
+                         grat_type=grat_type)
+    return pipeline
+
+
+def make_data(subsample=None, columns=None):
+    """columns is the pipeline columns to add, all of them by default"""
     print('starting to make data')
     print('making populations')
     df = get_populations()
@@ -510,26 +548,8 @@ def make_data(subsample=None):
     # print('cache user edits')
     # cache_all_user_edits(df)
 
-    print('adding reverts')
-    df = add_revert_actions_pre_treatment(df)
-    df = add_revert_actions_post_treatment(df)
-
-    print('adding support talk')
-    df = add_support_talk_90_pre_treatment(df)
-    df = add_support_talk_90_post_treatment(df)
-
-    print('adding project talk')
-    df = add_project_talk_90_pre_treatment(df)
-    df = add_project_talk_90_post_treatment(df)
-
-    print('adding wikithanks')
-    df = add_thanks_90_pre_treatment(df)
-    df = add_thanks_90_post_treatment(df)
-
-    print('adding wikiloves')
-    df = add_wikilove_90_pre_treatment(df)
-    df = add_wikilove_90_post_treatment(df)
-
+    print('adding reverts, support talk, project talk, wikithanks and wikiloves')
+    df = make_feature_pipeline().run(df, columns=columns)
     print('finished making data')
     return df
 
@@ -1,13 +1,32 @@
 import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime as dt, timedelta as td
+import sqlalchemy
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from itertools import islice
 
+import numpy as np
+import pandas as pd
+
 from sqlalchemy.orm import sessionmaker
 
 from gratsample.orm_models import Base
 
 
+WMF_URL_TEMPLATE = 'mysql+pymysql://{user}:{pwd}@{host}:{port}/{database}?charset=utf8'
+# per wiki database, the replicas limit how many connections one account can hold
+WMF_POOL_SIZE = int(os.getenv('WMF_POOL_SIZE', 4))
+WMF_MAX_OVERFLOW = int(os.getenv('WMF_MAX_OVERFLOW', 2))
+# how many languages a make_data stage works on at once, 1 runs them one after another
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', 4))
+
+
 def from_wmftimestamp(bytestring):
     if bytestring:
         s = bytestring.decode('utf-8')
@@ -29,11 +48,130 @@ def make_a_con(user, pwd, host, port):
     con = create_engine(constr, encoding='utf-8')
     return con
 
+class WikiConnections():
+    """
+    one engine per `{lang}wiki_p` database, each with its own bounded pool, instead of one engine that
+    gets `use {lang}wiki_p` run on it. a connection from here is never pointed at another wiki, so
+    fetchers for different languages (or different users of the same one) can run at the same time.
+    connections are pinged before they're handed out since the ssh tunnel drops idle ones.
+
+        with wmf_con.connect('fa') as con:
+            df = pd.read_sql(sql, con)
+    """
+    def __init__(self, user, pwd, host, port, pool_size=None, max_overflow=None, pool_recycle=3600,
+                 pool_timeout=60):
+        self.url_args = dict(user=user, pwd=pwd, host=host, port=port)
+        self.base_url = make_url(WMF_URL_TEMPLATE.format(database='', **self.url_args))
+        self.pool_size = pool_size or WMF_POOL_SIZE
+        self.max_overflow = max_overflow if max_overflow is not None else WMF_MAX_OVERFLOW
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
+        self.engines = {}
+        self.lock = threading.Lock()
+
+    def engine(self, lang):
+        database = f'{lang}wiki_p'
+        with self.lock:
+            if database not in self.engines:
+                self.engines[database] = create_engine(WMF_URL_TEMPLATE.format(database=database, **self.url_args),
+                                                       encoding='utf-8',
+                                                       pool_size=self.pool_size, max_overflow=self.max_overflow,
+                                                       pool_pre_ping=True, pool_recycle=self.pool_recycle,
+                                                       pool_timeout=self.pool_timeout)
+            return self.engines[database]
+
+    @contextmanager
+    def connect(self, lang):
+        with self.engine(lang).connect() as con:
+            yield con
+
+    def ping(self, lang):
+        """fail early if the tunnel or the wiki's replica is down"""
+        with self.connect(lang) as con:
+            con.execute(sqlalchemy.text('select 1'))
+
+    def dispose(self):
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            self.engines = {}
+
+    def cache_token(self):
+        # the same as the single engine this replaced, so cached results stay valid
+        return repr(self.base_url)
+
+
+@contextmanager
+def lang_con(wmf_con, lang):
+    """a connection to `lang`wiki_p from either WikiConnections or a plain engine.
+    for a plain engine `use` is run on the one connection that's checked out, not on the pool"""
+    if isinstance(wmf_con, WikiConnections):
+        with wmf_con.connect(lang) as con:
+            yield con
+    else:
+        with wmf_con.connect() as con:
+            con.execute(f'use {lang}wiki_p;')
+            yield con
+
+
 def make_wmf_con():
-    return make_a_con(user=os.environ['WMF_MYSQL_USERNAME'],
-                      pwd=os.environ['WMF_MYSQL_PASSWORD'],
-                      host=os.environ['WMF_MYSQL_HOST'],
-                      port=os.environ['WMF_MYSQL_PORT'])
+    return WikiConnections(user=os.environ['WMF_MYSQL_USERNAME'],
+                           pwd=os.environ['WMF_MYSQL_PASSWORD'],
+                           host=os.environ['WMF_MYSQL_HOST'],
+                           port=os.environ['WMF_MYSQL_PORT'])
+
+def run_per_lang(lang_fn, langs, stage_name=None, workers=None):
+    """
+    run the per-language part of a stage, lang_fn(lang), for all the languages at once in a thread pool
+    (the work is waiting on the replicas, and each wiki has its own connections). the results come back
+    in the order of `langs`, so concatenating them gives the same frame the serial loop did.
+    prints how long each language took.
+    """
+    langs = list(langs)
+    workers = STAGE_WORKERS if workers is None else workers
+    stage_name = stage_name or lang_fn.__name__
+
+    def timed_lang_fn(lang):
+        start = time.time()
+        result = lang_fn(lang)
+        # one write, so lines from different threads don't run together
+        print(f'{stage_name} {lang}: {time.time() - start:.1f}s\n', end='')
+        return result
+
+    if workers <= 1 or len(langs) <= 1:
+        return [timed_lang_fn(lang) for lang in langs]
+    with ThreadPoolExecutor(max_workers=min(workers, len(langs))) as executor:
+        return list(executor.map(timed_lang_fn, langs))
+
+
+def stream_sql_to_parquet(sql, con, spill_dir, chunksize, params=None, chunk_fn=None):
+    """run `sql` on the open connection `con` (eg. from lang_con) through an unbuffered server-side cursor
+    and read it `chunksize` rows at a time.
+    every chunk goes through `chunk_fn` (decode, filter) as it arrives and what's left of it is
+    written to spill_dir/run-XXXXXXXX/part-NNNNN.parquet, in a run dir of its own that's returned,
+    so memory depends on the chunk size and not the size of the wiki"""
+    os.makedirs(spill_dir, exist_ok=True)
+    # a dir per run, so runs spilling to the same place at the same time never delete each other's parts
+    run_dir = tempfile.mkdtemp(prefix='run-', dir=spill_dir)
+    stream_con = con.execution_options(stream_results=True)
+    for chunk_number, chunk_df in enumerate(pd.read_sql(sql, stream_con, params=params, chunksize=chunksize)):
+        if chunk_fn:
+            chunk_df = chunk_fn(chunk_df)
+        chunk_df.to_parquet(os.path.join(run_dir, f'part-{chunk_number:05d}.parquet'), index=False)
+    return run_dir
+
+
+def read_spilled(run_dir, remove=False):
+    """everything a stream_sql_to_parquet run kept, as one frame. with remove the run dir is deleted once it's read"""
+    part_paths = sorted(os.path.join(run_dir, fname) for fname in os.listdir(run_dir) if fname.startswith('part-'))
+    if not part_paths:
+        df = pd.DataFrame()
+    else:
+        df = pd.concat([pd.read_parquet(part_path) for part_path in part_paths], ignore_index=True)
+    if remove:
+        shutil.rmtree(run_dir)
+    return df
+
 
 def load_session_from_con(con):
     Base.metadata.bind = con
@@ -106,6 +244,98 @@ def ts_in_week(ts_list, date_start, date_end):
             in_week.append(ts)
     return in_week
 
+SESSION_GAP_MICROSECONDS = int(td(hours=1).total_seconds()) * 10 ** 6
+
+
+def as_microseconds(timestamps):
+    """datetimes (a list, datetime64 array or Series) as int64 microseconds since the epoch.
+    int64 arrays are taken to be microseconds already"""
+    if isinstance(timestamps, np.ndarray) and timestamps.dtype == np.int64:
+        return timestamps
+    return pd.to_datetime(pd.Series(timestamps)).values.astype('datetime64[us]').astype(np.int64)
+
+
+def make_group_sessions(group_ids, timestamps):
+    """make_sessions for every group (usually a user) at once, from long-format arrays.
+    edits are ordered by group, keeping their order within the group like make_sessions sees it,
+    and a session starts at a new group or wherever the gap to the previous edit is an hour or more.
+    returns the ordered group ids, the ordered microsecond timestamps and the positions where sessions start"""
+    group_ids = np.asarray(group_ids)
+    ts = as_microseconds(timestamps)
+    order = np.argsort(group_ids, kind='stable')
+    group_ids, ts = group_ids[order], ts[order]
+    session_start = np.ones(len(ts), dtype=bool)
+    session_start[1:] = (group_ids[1:] != group_ids[:-1]) | (ts[1:] - ts[:-1] >= SESSION_GAP_MICROSECONDS)
+    return group_ids, ts, np.flatnonzero(session_start)
+
+
+def calc_labour_hours_by_group(group_ids, timestamps):
+    """calc_labour_hours for every group at once, a Series indexed by the groups that have edits"""
+    group_ids, ts, session_starts = make_group_sessions(group_ids, timestamps)
+    if len(ts) == 0:
+        return pd.Series([], dtype=float, index=group_ids[:0])
+    session_durations = np.maximum.reduceat(ts, session_starts) - np.minimum.reduceat(ts, session_starts)
+    # timedelta.seconds, which calc_labour_hours uses, leaves out whole days
+    session_seconds = (session_durations // 10 ** 6) % 86400
+    session_hours = session_seconds / (60 * 60) + 1
+    session_groups = group_ids[session_starts]
+
+    # add up session by session in the same order as calc_labour_hours so the floats come out identical.
+    # groups are visited longest first so the ones still adding up are always a prefix
+    first_sessions = np.flatnonzero(np.r_[True, session_groups[1:] != session_groups[:-1]])
+    num_sessions = np.diff(np.r_[first_sessions, len(session_groups)])
+    by_num_sessions = np.argsort(-num_sessions, kind='stable')
+    sorted_first_sessions = first_sessions[by_num_sessions]
+    sorted_num_sessions = num_sessions[by_num_sessions]
+    sorted_totals = np.zeros(len(first_sessions))
+    for k in range(sorted_num_sessions[0]):
+        still_adding = np.searchsorted(-sorted_num_sessions, -k, side='left')
+        sorted_totals[:still_adding] += session_hours[sorted_first_sessions[:still_adding] + k]
+    totals = np.empty_like(sorted_totals)
+    totals[by_num_sessions] = sorted_totals
+    if len(session_starts) == len(ts):
+        # every session is a single edit, which calc_labour_hours counts in ints
+        totals = totals.astype(np.int64)
+    return pd.Series(totals, index=session_groups[first_sessions])
+
+
+def count_by_group(group_ids, timestamps):
+    """len of every group's timestamps, a Series indexed by the groups that have edits"""
+    return pd.Series(np.asarray(group_ids)).value_counts(sort=False)
+
+
+def ts_week_numbers(timestamps, start_date, weeks=12):
+    """ts_in_week for every week at once: the week i in 1..weeks whose
+    (start_date + 7*i days, start_date + 7*(i+1) days] holds each timestamp, or 0 for none"""
+    week_bounds = as_microseconds([start_date + td(days=7 * i) for i in range(1, weeks + 2)])
+    week_numbers = np.searchsorted(week_bounds, as_microseconds(timestamps), side='left')
+    return np.where((week_numbers >= 1) & (week_numbers <= weeks), week_numbers, 0)
+
+
+def user_edit_stats(user_ids, timestamps, week_start_date=None, weeks=12):
+    """sessions, edit counts and labour hours of every user in long-format (user_id, rev_timestamp) arrays,
+    and edit counts and labour hours by week of week_start_date when it's given. one row per user with edits"""
+    user_ids = np.asarray(user_ids)
+    ts = as_microseconds(timestamps)
+    group_ids, _, session_starts = make_group_sessions(user_ids, ts)
+    stats = pd.DataFrame({'num_sessions': count_by_group(group_ids[session_starts], None),
+                          'num_edits': count_by_group(user_ids, ts),
+                          'labour_hours': calc_labour_hours_by_group(user_ids, ts)})
+    if week_start_date is not None:
+        user_index, user_codes = np.unique(user_ids, return_inverse=True)
+        week_numbers = ts_week_numbers(ts, week_start_date, weeks)
+        in_week = week_numbers > 0
+        # one group per (user, week)
+        week_group_ids = user_codes[in_week] * (weeks + 1) + week_numbers[in_week]
+        for name, by_group in (('num_edits', count_by_group), ('labour_hours', calc_labour_hours_by_group)):
+            by_week = by_group(week_group_ids, ts[in_week])
+            table = np.zeros((len(user_index), weeks + 1), dtype=by_week.dtype)
+            table[by_week.index.values // (weeks + 1), by_week.index.values % (weeks + 1)] = by_week.values
+            for week_number in range(1, weeks + 1):
+                stats[f'{name}_week_{week_number}'] = pd.Series(table[:, week_number], index=user_index)
+    return stats.rename_axis('user_id')
+
+
 def window_seq(seq, n=2):
     "Returns a sliding window (of width n) over data from the iterable"
     "   s -> (s0,s1,...s[n-1]), (s1,s2,...,sn), ...                   "
@@ -26,6 +26,13 @@ setup(
     packages=find_packages(),
     long_description=read('README.md'),
     install_requires=requirements('requirements.txt'),
+    extras_require={
+        # faster ORES json decoding and smaller edits_display rows, both have fallbacks
+        'fast': ['orjson', 'zstandard'],
+    },
+    entry_points={
+        'console_scripts': ['gratsample-cache=gratsample.cache_cli:main'],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Topic :: Software Development :: Libraries :: Python Modules",
@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy import create_engine, event
+
+from gratsample import cached_df
+from gratsample.wikipedia_helpers import WikiConnections
+
+
+@pytest.fixture
+def cache_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(cached_df, 'CACHE_ROOT', str(tmp_path))
+    return tmp_path
+
+
+class SqliteWikis(WikiConnections):
+    """WikiConnections with a sqlite file per wiki. text comes back as bytes, like it does from the replicas"""
+    def __init__(self, db_dir):
+        super().__init__(user='test', pwd='test', host='localhost', port=3306)
+        self.db_dir = db_dir
+
+    def engine(self, lang):
+        with self.lock:
+            if lang not in self.engines:
+                engine = create_engine(f'sqlite:///{self.db_dir}/{lang}wiki.db')
+                event.listen(engine, 'connect', lambda dbapi_con, record: setattr(dbapi_con, 'text_factory', bytes))
+                self.engines[lang] = engine
+            return self.engines[lang]
+
+    def cache_token(self):
+        return f'sqlite:{self.db_dir}'
+
+
+@pytest.fixture
+def wiki_dbs(tmp_path):
+    wikis = SqliteWikis(tmp_path)
+    yield wikis
+    wikis.dispose()
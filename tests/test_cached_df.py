@@ -0,0 +1,198 @@
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gratsample import cached_df
+from gratsample.cache_cli import migrate_pickle_dir, main
+from gratsample.cached_df import make_cached_df, open_store, MemoryLRU, bind_arguments, make_cache_key
+
+
+def entry_key(cached_fn, *args):
+    return make_cache_key(cached_fn.__wrapped__, bind_arguments(cached_fn.__wrapped__, args, {}))
+
+
+def test_long_arrays_get_distinct_keys(cache_root):
+    calls = []
+
+    @make_cached_df('revs')
+    def rev_frame(rev_ids, lang):
+        calls.append(rev_ids)
+        return pd.DataFrame({'rev_id': rev_ids, 'lang': lang})
+
+    rev_ids = np.arange(5000)
+    other_rev_ids = rev_ids.copy()
+    other_rev_ids[2500] = -1  # same shortened repr as rev_ids
+    assert str(rev_ids) == str(other_rev_ids)
+
+    rev_frame(rev_ids, 'fa')
+    rev_frame(rev_ids, lang='fa')
+    assert rev_frame(other_rev_ids, 'fa')['rev_id'][2500] == -1
+    assert len(calls) == 2
+
+
+def test_parquet_serializer_and_manifest(cache_root):
+    @make_cached_df('spans', serializer='parquet')
+    def span_frame(lang, user_ids):
+        return pd.DataFrame({'lang': lang, 'user_id': user_ids,
+                             'first_edit': pd.to_datetime(['2019-01-01', None, '2019-02-01'])})
+
+    df = span_frame('de', [1, 2, 3])
+    assert span_frame('de', [1, 2, 3]).equals(df)
+
+    entries = [e for e in os.listdir(os.path.join(str(cache_root), 'spans')) if not e.startswith('.')]
+    assert sorted(os.path.splitext(e)[1] for e in entries) == ['.json', '.parquet']
+    manifest_name = [e for e in entries if e.endswith('.json')][0]
+    manifest = json.load(open(os.path.join(str(cache_root), 'spans', manifest_name)))
+    assert manifest['arguments'] == {'lang': 'de', 'user_ids': [1, 2, 3]}
+
+    # arrays and long lists are summarized, their contents are in the key
+    span_frame('de', np.array([4, 5, 6]))
+    manifests = [json.load(open(os.path.join(str(cache_root), 'spans', e)))
+                 for e in os.listdir(os.path.join(str(cache_root), 'spans')) if e.endswith('.json')]
+    summary = [m['arguments']['user_ids'] for m in manifests if isinstance(m['arguments']['user_ids'], dict)][0]
+    assert summary['type'] == 'ndarray' and summary['length'] == 3 and len(summary['hash']) == 32
+    assert cached_df._jsonable(list(range(1000))) == {'type': 'list', 'length': 1000,
+                                                      'hash': cached_df._content_hash(list(range(1000)))}
+
+
+def test_sqlite_backend_batched_and_migration(cache_root, capsys):
+    calls = []
+
+    @make_cached_df('total_edits', backend='sqlite')
+    def total_edits(lang, user_id):
+        calls.append(user_id)
+        return pd.DataFrame({'edits_pre_treatment': [user_id * 10]})
+
+    total_edits('ar', 1)
+    hits = total_edits.get_many([('ar', 1), ('ar', 2)])
+    assert hits[0]['edits_pre_treatment'][0] == 10 and hits[1] is None
+
+    total_edits.put_many([('ar', 2)], [pd.DataFrame({'edits_pre_treatment': [20]})])
+    assert total_edits('ar', 2)['edits_pre_treatment'][0] == 20
+    assert calls == [1]
+    assert all(e.startswith('entries.sqlite') or e == '.locks'
+               for e in os.listdir(os.path.join(str(cache_root), 'total_edits')))
+
+    pickle_dir = cache_root / 'old_edithistory'
+    pickle_dir.mkdir()
+    pd.DataFrame({'rev_id': [1, 2]}).to_pickle(str(pickle_dir / 'de_7_2018-03-06 00:00:00_2018-06-04 00:00:00.pickle'))
+    assert migrate_pickle_dir(str(pickle_dir), 'edithistory') == 1
+    store = open_store('edithistory')
+    assert list(store.get('de_7_2018-03-06 00:00:00_2018-06-04 00:00:00')['rev_id']) == [1, 2]
+
+    # --delete only removes what was imported, the policy and a stray manifest and dir stay
+    (pickle_dir / '.policy.json').write_text('{"ttl_seconds": 60}')
+    (pickle_dir / 'orphan.json').write_text('{}')
+    (pickle_dir / 'sub').mkdir()
+    pd.DataFrame({'rev_id': [4]}).to_pickle(str(pickle_dir / 'fa_9_2018-03-06'))
+    pd.DataFrame({'rev_id': [3]}).to_pickle(str(pickle_dir / 'fa_8.pickle'))
+    (pickle_dir / 'fa_8.json').write_text('{"created": 1}')
+    assert migrate_pickle_dir(str(pickle_dir), 'edithistory', delete=True) == 2
+    assert sorted(os.listdir(str(pickle_dir))) == ['.policy.json', 'fa_9_2018-03-06', 'orphan.json', 'sub']
+    assert 'skipped 1 files' in capsys.readouterr().out
+    assert list(store.get('fa_8')['rev_id']) == [3]
+
+
+def test_memory_tier_lru(cache_root):
+    @make_cached_df('timestamps', backend='sqlite', memory_bytes=10 ** 6)
+    def timestamps(user_id):
+        return pd.DataFrame({'rev_timestamp': pd.date_range('2019-01-01', periods=100, freq='h')})
+
+    first = timestamps(1)
+    first['user_id'] = 1  # callers add columns, that mustn't leak into the cache
+    for _ in range(27):
+        assert list(timestamps(1).columns) == ['rev_timestamp']
+    stats = timestamps.cache_stats()
+    assert stats['memory_hits'] == 27 and stats['disk_misses'] == 1 and stats['disk_hits'] == 0
+
+    lru = MemoryLRU(max_bytes=2500)
+    frame = pd.DataFrame({'x': np.arange(100)})  # 800 bytes of data plus the index
+    for key in 'abcd':
+        lru.put(key, frame)
+    assert lru.used_bytes <= 2500 and lru.evictions >= 1
+    with pytest.raises(KeyError):
+        lru.get('a')
+    assert lru.get('d').equals(frame)
+
+
+def test_single_flight_and_corrupt_entries(cache_root):
+    calls = []
+
+    @make_cached_df('active_users')
+    def slow_query(lang):
+        calls.append(lang)
+        time.sleep(0.2)
+        return pd.DataFrame({'user_id': [1, 2, 3]})
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(slow_query, ['fa'] * 8))
+    assert calls == ['fa']
+    assert all(len(df) == 3 for df in results)
+
+    entry_dir = os.path.join(str(cache_root), 'active_users')
+    entry = [e for e in os.listdir(entry_dir) if e.endswith('.pickle')][0]
+    with open(os.path.join(entry_dir, entry), 'wb') as f:
+        f.write(b'half a pickle')
+    assert len(slow_query('fa')) == 3
+    assert calls == ['fa', 'fa']
+
+
+def test_ttl_and_garbage_collection(cache_root, capsys):
+    calls = []
+
+    @make_cached_df('recent_edits', backend='sqlite', ttl=datetime.timedelta(seconds=60))
+    def recent_edits(user_id):
+        calls.append(user_id)
+        return pd.DataFrame({'rev_id': np.arange(user_id * 100)})
+
+    for user_id in (1, 2, 3):
+        recent_edits(user_id)
+    store = open_store('recent_edits')
+    con = store._connect()
+    with con:
+        con.execute('update entries set created_at = created_at - 120 where key = ?',
+                    (entry_key(recent_edits, 1),))
+    recent_edits(1)
+    assert calls == [1, 2, 3, 1]
+
+    with con:
+        con.execute('update entries set created_at = created_at - 120')
+    main(['gc', '--cache-root', str(cache_root)])
+    assert 'recent_edits (sqlite): dropped 3 entries' in capsys.readouterr().out
+    assert list(store.entries()) == []
+
+    # the sub-dir's store already has a 60 second ttl, another one can't quietly be ignored
+    @make_cached_df('recent_edits', backend='sqlite', ttl=datetime.timedelta(days=1))
+    def recent_edits_longer(user_id):
+        return pd.DataFrame({'rev_id': [user_id]})
+
+    with pytest.raises(ValueError):
+        recent_edits_longer(1)
+
+
+def test_key_locks_are_per_key(cache_root):
+    barrier = threading.Barrier(2, timeout=5)
+
+    @make_cached_df('user_edits', backend='sqlite')
+    def user_edits(user_id):
+        # both keys have to be computing at once to get past the barrier
+        barrier.wait()
+        return pd.DataFrame({'user_id': [user_id]})
+
+    @make_cached_df('user_edits', backend='sqlite')
+    def edit_count(user_id):
+        # a nested call into the same sub-dir while this key's lock is held
+        return pd.DataFrame({'edits': [len(user_edits(user_id + 100))]})
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert [df['user_id'][0] for df in executor.map(user_edits, [1, 2])] == [1, 2]
+    barrier = threading.Barrier(1)
+    assert edit_count(3)['edits'][0] == 1
+    assert os.listdir(os.path.join(str(cache_root), 'user_edits', '.locks')) == []
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import pandas as pd
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from gratsample.cached_df import make_cached_df
+from gratsample.fanout import fetch_users, run_jobs
+
+
+def test_fetch_users_bounds_retries_and_skips_hits(cache_root):
+    lock = threading.Lock()
+    in_flight = {'ar': 0, 'fa': 0}
+    most_in_flight = {'ar': 0, 'fa': 0}
+    calls = []
+    failed_once = set()
+
+    @make_cached_df('total_edits', backend='sqlite')
+    def total_edits(lang, user_id, start_date):
+        with lock:
+            calls.append((lang, user_id))
+            in_flight[lang] += 1
+            most_in_flight[lang] = max(most_in_flight[lang], in_flight[lang])
+        time.sleep(0.01)
+        with lock:
+            in_flight[lang] -= 1
+        if user_id == 7 and lang not in failed_once:
+            failed_once.add(lang)
+            raise OperationalError('select', {}, Exception('Lost connection to MySQL server during query'))
+        return pd.DataFrame({'edits_pre_treatment': [user_id * 10]})
+
+    lang_user_ids = [(lang, user_id) for user_id in range(40) for lang in ('ar', 'fa')]
+    dfs = fetch_users(total_edits, lang_user_ids, '2019-03-01', per_lang_limit=3, backoff_seconds=0)
+    assert [df['edits_pre_treatment'][0] for df in dfs] == [user_id * 10 for _, user_id in lang_user_ids]
+    assert max(most_in_flight.values()) <= 3
+    assert len(calls) == 82  # a retry for user 7 in each language
+
+    dfs = fetch_users(total_edits, lang_user_ids[:10], '2019-03-01')
+    assert len(calls) == 82
+    assert total_edits('fa', 3, '2019-03-01')['edits_pre_treatment'][0] == 30
+
+
+def test_run_jobs_gives_up_after_retries():
+    def always_down(lang, user_id):
+        raise OperationalError('select', {}, Exception("Can't connect to MySQL server"))
+
+    with pytest.raises(OperationalError):
+        run_jobs([('de', 1), ('de', 2)], always_down, retries=2, backoff_seconds=0)
+
+
+def test_concurrent_fan_outs_compute_each_key_once(cache_root):
+    calls = []
+
+    @make_cached_df('thanks', backend='sqlite')
+    def thanks(lang, user_id):
+        calls.append(user_id)
+        time.sleep(0.05)
+        return pd.DataFrame({'thanks': [user_id]})
+
+    lang_user_ids = [('de', user_id) for user_id in range(6)]
+    results = []
+    fan_outs = [threading.Thread(target=lambda: results.append(fetch_users(thanks, lang_user_ids)))
+                for _ in range(2)]
+    for fan_out in fan_outs:
+        fan_out.start()
+    for fan_out in fan_outs:
+        fan_out.join()
+    assert sorted(calls) == list(range(6))
+    assert [[df['thanks'][0] for df in dfs] for dfs in results] == [list(range(6))] * 2
+
+
+def test_run_jobs_inside_a_running_event_loop():
+    async def notebook_cell():
+        return run_jobs([('de', 1), ('fa', 2)], lambda lang, user_id: (lang, user_id * 2))
+
+    assert asyncio.run(notebook_cell()) == [('de', 2), ('fa', 4)]
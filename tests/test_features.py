@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from gratsample.features import FeatureAccumulator
+
+
+def test_accumulator_join_matches_merging_one_row_frames():
+    df = pd.DataFrame({'lang': ['fa', 'fa', 'de', 'de', 'de'], 'user_id': [1, 2, 1, 5, 9],
+                       'user_name': ['a', 'b', 'c', 'd', 'e']})
+    grats = {('fa', 1): 3, ('fa', 2): float('nan'), ('de', 1): 0, ('de', 5): 2, ('de', 9): 1}
+
+    merged = df
+    for col_name, value_fn in (('num_grats', lambda lang, user_id: grats[(lang, user_id)]),
+                               ('num_reverts', lambda lang, user_id: user_id * 2)):
+        user_dfs = [pd.DataFrame.from_dict({col_name: [value_fn(lang, user_id)], 'user_id': [user_id], 'lang': [lang]})
+                    for lang, user_id in zip(df['lang'], df['user_id'])]
+        merged = pd.merge(merged, pd.concat(user_dfs), how='left', on=['lang', 'user_id'])
+    merged = pd.merge(merged, pd.DataFrame({'has_email': [True, False], 'user_id': [1, 2], 'lang': 'fa'}),
+                      how='left', on=['lang', 'user_id'])
+
+    accumulator = FeatureAccumulator()
+    for lang, user_id in zip(df['lang'], df['user_id']):
+        accumulator.append('num_grats', lang, user_id, grats[(lang, user_id)])
+    for lang, user_id in zip(df['lang'], df['user_id']):
+        accumulator.append_frame(lang, user_id, pd.DataFrame({'num_reverts': [user_id * 2], 'user_id': [user_id],
+                                                              'lang': [lang]}))
+    accumulator.add('has_email', 'fa', np.array([1, 2]), np.array([True, False]))
+    accumulator.add('has_email', 'pl', np.array([], dtype=int), np.array([], dtype=bool))
+
+    joined = accumulator.join(df)
+    pd.testing.assert_frame_equal(joined, merged)
+    assert list(accumulator.column('num_reverts').loc['de']) == [2, 10, 18]
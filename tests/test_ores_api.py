@@ -0,0 +1,294 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gratsample import http_clients, ores_api
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.text = str(doc)
+
+    def json(self):
+        return self.doc
+
+
+class FakeOres:
+    """answers like ORES' v3 scores endpoint, remembering what it was asked to score"""
+    def __init__(self, versions):
+        self.versions = versions
+        self.scored_rev_ids = []
+
+    def get(self, url, params=None, **kwargs):
+        context = url.rstrip('/').split('/')[-1]
+        models = params['models'].split('|')
+        doc = {'models': {model: {'version': self.versions[model]} for model in models}}
+        if 'revids' in params:
+            rev_ids = [int(rev_id) for rev_id in params['revids'].split('|')]
+            self.scored_rev_ids += rev_ids
+            doc['scores'] = {str(rev_id): {model: {'score': {'prediction': rev_id % 2 == 0}} for model in models}
+                             for rev_id in rev_ids}
+        return FakeResponse({context: doc})
+
+
+def test_score_store_only_scores_missing_revisions(tmp_path):
+    store = ores_api.ScoreStore(str(tmp_path / 'scores.sqlite'))
+    fake_ores = FakeOres({'damaging': '0.5.0', 'goodfaith': '0.5.0'})
+    session = ores_api.Session('https://ores.test', user_agent='test', session=fake_ores, batch_size=3,
+                               score_store=store)
+
+    first = list(session.score('fawiki', ['damaging', 'goodfaith'], [1, 2, 3, 4]))
+    assert sorted(fake_ores.scored_rev_ids) == [1, 2, 3, 4]
+    second = list(session.score('fawiki', ['damaging', 'goodfaith'], [4, 5, 2, 2]))
+    assert sorted(fake_ores.scored_rev_ids) == [1, 2, 3, 4, 5]
+    assert second == [first[3], {'damaging': {'score': {'prediction': False}},
+                                 'goodfaith': {'score': {'prediction': False}}}, first[1], first[1]]
+
+    # a new model version is a miss, and so is a model that hasn't been stored
+    session = ores_api.Session('https://ores.test', user_agent='test', session=FakeOres({'damaging': '0.6.0'}),
+                               score_store=store)
+    list(session.score('fawiki', ['damaging'], [1, 2]))
+    assert session._session.scored_rev_ids == [1, 2]
+    assert store.get_many('fawiki', {'damaging': '0.5.0', 'reverted': '0.1.0'}, [1, 2]) == {}
+    assert store.get_many('fawiki', {'damaging': '0.5.0'}, [1, 9]) == {1: {'damaging': {'score': {'prediction': False}}}}
+
+
+class SlowOres(FakeOres):
+    """a FakeOres whose requests take a while, counting how many are in flight at once"""
+    def __init__(self, delays):
+        super().__init__({'damaging': '0.5.0'})
+        self.delays = delays
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def get(self, url, params=None, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(self.delays(int(params['revids'].split('|')[0])))
+        with self.lock:
+            self.in_flight -= 1
+        return super().get(url, params=params, **kwargs)
+
+
+def test_score_streams_a_bounded_number_of_batches():
+    read = []
+
+    def rev_ids():
+        for rev_id in range(1, 1001):
+            read.append(rev_id)
+            yield rev_id
+
+    fake_ores = SlowOres(lambda first_rev_id: 0.01)
+    session = ores_api.Session('https://ores.test', user_agent='test', session=fake_ores, batch_size=10,
+                               parallel_requests=2, batches_in_flight=2)
+    scores = session.score('fawiki', ['damaging'], rev_ids())
+    next(scores)
+    # only the 2 x 2 batches in flight have been read so far
+    assert len(read) <= 4 * 10
+    assert [score['damaging']['score']['prediction'] for score in scores] == [rev_id % 2 == 0
+                                                                              for rev_id in range(2, 1001)]
+    assert fake_ores.most_in_flight <= 2
+
+
+def test_unordered_score_yields_batches_as_they_finish():
+    # the first batch is the slowest, so unordered it comes last
+    fake_ores = SlowOres(lambda first_rev_id: 0.2 if first_rev_id == 1 else 0.01)
+    session = ores_api.Session('https://ores.test', user_agent='test', session=fake_ores, batch_size=5,
+                               parallel_requests=2)
+    rev_id_scores = list(session.score('fawiki', ['damaging'], iter(range(1, 21)), ordered=False))
+    assert sorted(rev_id for rev_id, _ in rev_id_scores) == list(range(1, 21))
+    assert [rev_id for rev_id, _ in rev_id_scores][-5:] == [1, 2, 3, 4, 5]
+    assert all(score['damaging']['score']['prediction'] == (rev_id % 2 == 0) for rev_id, score in rev_id_scores)
+
+
+def stub_score(rev_id, model):
+    if StubOres.deleted_every and rev_id % StubOres.deleted_every == 0:
+        return {'error': {'type': 'TextDeleted', 'message': 'Text deleted'}}
+    prediction = (rev_id % 2 == 0) != (model == 'goodfaith' and rev_id % 3 == 0)
+    return {'score': {'prediction': prediction, 'probability': {'true': 0.9 if prediction else 0.2,
+                                                                'false': 0.1 if prediction else 0.8}}}
+
+
+class StubOres(BaseHTTPRequestHandler):
+    """a local ORES that throttles the first `throttle` score requests and takes `latency` seconds for the rest.
+    the next `fail` requests get a 502, the next `drop` have their connection closed without an answer,
+    and any request with one of `bad_rev_ids` gets an error document"""
+    throttle = 0
+    latency = 0
+    fail = 0
+    bad_rev_ids = set()
+    deleted_every = 0
+    drop = 0
+    requests = []
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        context = url.path.rstrip('/').split('/')[-1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        StubOres.requests.append(params)
+        if StubOres.drop > 0:
+            StubOres.drop -= 1
+            self.close_connection = True
+            return
+        if StubOres.throttle > 0:
+            StubOres.throttle -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        time.sleep(StubOres.latency)
+        models = params['models'].split('|')
+        rev_ids = params['revids'].split('|') if 'revids' in params else []
+        if StubOres.fail > 0:
+            StubOres.fail -= 1
+            self.send_response(502)
+            self.end_headers()
+            self.wfile.write(b'<html>bad gateway</html>')
+            return
+        if StubOres.bad_rev_ids & set(rev_ids):
+            body = json.dumps({'error': {'code': 'bad request', 'message': 'Could not score the revisions'}}).encode()
+        elif 'revids' not in params:
+            body = json.dumps({context: {'models': {model: {'version': '0.5.0'} for model in models}}}).encode()
+        else:
+            body = json.dumps({context: {'scores': {rev_id: {model: stub_score(int(rev_id), model) for model in models}
+                                                    for rev_id in rev_ids}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_ores():
+    StubOres.throttle, StubOres.latency, StubOres.fail, StubOres.bad_rev_ids, StubOres.requests = 0, 0, 0, set(), []
+    StubOres.deleted_every, StubOres.drop = 0, 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOres)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_throttling_backs_off_concurrency_and_retries(stub_ores):
+    StubOres.throttle = 3
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=10, parallel_requests=4, retries=5)
+    scores = list(session.score('fawiki', ['damaging'], range(1, 31)))
+    assert [score['damaging']['score']['prediction'] for score in scores] == [rev_id % 2 == 0
+                                                                              for rev_id in range(1, 31)]
+    # halved to 1 and only three successes to grow back with
+    stats = session.stats()
+    assert stats['throttled'] == 3
+    assert stats['requests'] == len(StubOres.requests)
+    assert stats['concurrency_limit'] < 4
+
+
+def test_slow_responses_shrink_batches(stub_ores):
+    StubOres.latency = 0.05
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=40, parallel_requests=1, target_latency=0.01)
+    list(session.score('fawiki', ['damaging'], range(1, 101)))
+    batch_sizes = [len(params['revids'].split('|')) for params in StubOres.requests]
+    # two batches are read before the first one comes back slow
+    assert batch_sizes[:3] == [40, 40, 20] and session.batch_size < 40
+    assert sum(batch_sizes) == 100
+
+
+def test_rate_limit(stub_ores):
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=1, parallel_requests=4,
+                               requests_per_second=40)
+    start = time.time()
+    list(session.score('fawiki', ['damaging'], range(1, 11)))
+    # one request right away, the other nine a 40th of a second apart
+    assert time.time() - start >= 9 / 40 * 0.9
+
+
+def test_failed_batches_are_bisected_down_to_the_bad_revision(stub_ores):
+    StubOres.fail = 2
+    StubOres.bad_rev_ids = {'13'}
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=16, parallel_requests=2, retries=2,
+                               backoff_seconds=0)
+    scores = list(session.score('fawiki', ['damaging', 'goodfaith'], range(1, 33)))
+    assert 'error' in scores[12]['damaging'] and 'error' in scores[12]['goodfaith']
+    assert [score['damaging']['score']['prediction'] for score in scores[:12] + scores[13:]] == [
+        rev_id % 2 == 0 for rev_id in range(1, 33) if rev_id != 13]
+    # the two flaky failures are retried, the batch with 13 splits into 8, 4, 2 and 1 without retrying
+    assert len(StubOres.requests) <= 2 + 2 + 2 * 4 + 1
+
+
+def test_a_bad_revision_does_not_shrink_the_batch_size(stub_ores):
+    StubOres.bad_rev_ids = {'13'}
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=16, parallel_requests=1)
+    scores = list(session.score('fawiki', ['damaging'], range(1, 65)))
+    assert 'error' in scores[12]['damaging']
+    assert session.batch_size == 16
+    assert [len(params['revids'].split('|')) for params in StubOres.requests].count(16) == 4
+
+
+def test_persistent_server_errors_fail_batches_without_splitting(stub_ores):
+    StubOres.fail = 1000
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=8, parallel_requests=2, retries=1,
+                               backoff_seconds=0)
+    scores = list(session.score('fawiki', ['damaging'], range(1, 17)))
+    assert len(scores) == 16 and all('error' in score['damaging'] for score in scores)
+    # each of the two batches is tried and retried once, and never split
+    assert len(StubOres.requests) == 2 * 2
+
+
+def test_shared_ores_session_reuses_its_thread_pool(stub_ores):
+    session = http_clients.get_ores_session(stub_ores, batch_size=5)
+    assert http_clients.get_ores_session(stub_ores) is session
+    list(session.score('fawiki', ['damaging'], range(1, 21)))
+    executor = session._executor
+    list(session.score('fawiki', ['damaging'], range(21, 41)))
+    assert session._executor is executor
+
+    with pytest.raises(ValueError):
+        http_clients.get_ores_session(stub_ores, batch_size=10)
+
+    http_clients.close_clients()
+    assert session._executor is None
+    assert http_clients.get_ores_session(stub_ores) is not session
+    http_clients.close_clients()
+
+
+def test_dropped_connections_are_retried_once_per_attempt(stub_ores):
+    StubOres.drop = 1000
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=10, retries=2, backoff_seconds=0)
+    scores = list(session.score('fawiki', ['damaging'], range(1, 11)))
+    assert all('error' in score['damaging'] for score in scores)
+    # the first try and two retries, nothing retried again underneath them
+    assert len(StubOres.requests) == 3
+
+
+def test_predictions_match_the_score_documents(stub_ores, tmp_path):
+    StubOres.deleted_every = 7
+    session = ores_api.Session(stub_ores, user_agent='test', batch_size=7)
+    rev_ids = list(range(1, 30))
+    scores = list(session.score('fawiki', ['damaging', 'goodfaith'], rev_ids))
+
+    for score_store in (None, ores_api.ScoreStore(str(tmp_path / 'scores.sqlite'))):
+        session.score_store = score_store
+        for _ in range(2):  # the second time from the store
+            predictions = session.predictions('fawiki', ['damaging', 'goodfaith'], rev_ids, probabilities=True)
+            assert list(predictions['rev_id']) == rev_ids
+            assert list(predictions['scored']) == ['error' not in score['damaging'] for score in scores]
+            for model in ('damaging', 'goodfaith'):
+                assert list(predictions[model]) == [score[model].get('score', {}).get('prediction', False)
+                                                    for score in scores]
+                assert [probability for probability, score in zip(predictions[f'{model}_probability'], scores)
+                        if 'score' in score[model]] == [score[model]['score']['probability']['true']
+                                                        for score in scores if 'score' in score[model]]
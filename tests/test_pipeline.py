@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+from gratsample.pipeline import FeaturePipeline
+
+
+def test_pipeline_runs_only_needed_nodes_and_resumes_from_checkpoints(cache_root):
+    calls = []
+
+    def add_name_length(df, col_name, accumulator=None):
+        calls.append(col_name)
+        for lang, lang_df in df.groupby('lang'):
+            accumulator.add(col_name, lang, lang_df['user_id'].values, lang_df['user_name'].str.len().values)
+        return df
+
+    def add_doubled(df, col_name, input_col, accumulator=None):
+        calls.append(col_name)
+        for lang, lang_df in df.groupby('lang'):
+            accumulator.add(col_name, lang, lang_df['user_id'].values, lang_df[input_col].values * 2)
+        return df
+
+    def make_pipeline():
+        pipeline = FeaturePipeline()
+        pipeline.add('name_length', add_name_length, inputs=['user_name'], col_name='name_length')
+        pipeline.add('doubled', add_doubled, inputs=['name_length'], col_name='doubled', input_col='name_length')
+        pipeline.add('id_length', add_name_length, inputs=['user_name'], col_name='id_length')
+        return pipeline
+
+    df = pd.DataFrame({'lang': ['fa', 'de', 'de'], 'user_id': [1, 2, 3], 'user_name': ['ab', 'cde', 'f']})
+    out = make_pipeline().run(df, columns=['doubled'])
+    assert calls == ['name_length', 'doubled']
+    assert list(out.columns) == ['lang', 'user_id', 'user_name', 'doubled']
+    assert list(out['doubled']) == [4, 6, 2]
+
+    # a new run only computes the column it hasn't got a checkpoint for
+    out = make_pipeline().run(df)
+    assert calls == ['name_length', 'doubled', 'id_length']
+    assert list(out.columns) == ['lang', 'user_id', 'user_name', 'name_length', 'doubled', 'id_length']
+
+    # a different population is a different checkpoint
+    make_pipeline().run(df.iloc[:2], columns=['name_length'])
+    assert calls[-1] == 'name_length' and len(calls) == 4
+
+    with pytest.raises(KeyError):
+        make_pipeline().plan(['not_a_column'])
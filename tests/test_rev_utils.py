@@ -1,9 +1,19 @@
 import json
 import os
+import random
+from datetime import datetime as dt, timedelta as td
 from unittest.mock import patch
 import pytest
+import numpy as np
 import pandas as pd
-from gratsample.sample_thankees_revision_utils import num_quality_revisions, get_display_data
+import mwapi
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from gratsample import cached_df, orm_models, sample_thankees
+from gratsample.display_store import DisplayDataStore
+from gratsample.sample_thankees_revision_utils import num_quality_revisions, get_display_data, \
+    num_quality_revisions_by_namespace, get_display_data_batched, refresh_revisions
+from gratsample.wikipedia_helpers import namespace_all, namespace_nontalk, namespace_mainonly, calc_labour_hours
 
 
 def load_path_files_to_dict(sub_dirname, filetype):
@@ -45,3 +55,169 @@ def test_get_display_data(mock_mwapi_session, display_data, mwapi_responses):
     mock_mwapi_session.side_effect = [mwapi_responses['r0.json'], mwapi_responses['r1.json'], mwapi_responses['r3.json'], mwapi_responses['r4.json']]
     assert get_display_data([32932453, 32745075], 'ar') == display_data['display_data_ar_2.json']
 
+
+@patch('mwapi.Session.get')
+def test_get_display_data_batched(mock_mwapi_session, display_data, mwapi_responses):
+    compares = {32932453: mwapi_responses['r0.json'], 32745075: mwapi_responses['r3.json']}
+    timestamps = {32932453: '2019-02-02T17:25:14Z', 32745075: '2019-01-22T17:39:27Z', 30699278: '2018-09-23T17:55:24Z'}
+    queried_revids = []
+
+    def mwapi_get(action, **params):
+        if action == 'compare':
+            if params['fromrev'] == 404:
+                raise mwapi.errors.APIError('nosuchrevid', 'There is no revision with ID 404.', None)
+            return compares[params['fromrev']]
+        revids = [int(rev_id) for rev_id in params['revids'].split('|')]
+        queried_revids.append(revids)
+        return {'query': {'pages': {'1332702': {'revisions': [{'revid': rev_id, 'timestamp': timestamps[rev_id]}
+                                                              for rev_id in revids]}}}}
+
+    mock_mwapi_session.side_effect = mwapi_get
+    expected = display_data['display_data_ar_2.json']
+    assert get_display_data_batched([32932453, 32745075], 'ar') == expected
+    # one timestamp query for both revisions and their previous ones, instead of one query per revision
+    assert queried_revids == [[32932453, 32745075, 30699278]]
+    deleted = {'editDeleted': True, 'diffHTML': None, 'lang': 'ar',
+               'newRevId': None, 'newRevDate': None, 'newRevUser': None, 'newRevComment': None,
+               'oldRevId': None, 'oldRevDate': None, 'oldRevUser': None, 'oldRevComment': None,
+               'pageTitle': None}
+    assert get_display_data_batched([404, 32745075], 'ar') == [deleted, expected[1]]
+
+
+@patch('mwapi.Session.get')
+def test_display_store_only_fetches_misses(mock_mwapi_session, display_data, mwapi_responses):
+    compares = {32932453: mwapi_responses['r0.json'], 32745075: mwapi_responses['r3.json']}
+    timestamps = {32932453: '2019-02-02T17:25:14Z', 32745075: '2019-01-22T17:39:27Z', 30699278: '2018-09-23T17:55:24Z'}
+    compared = []
+
+    def mwapi_get(action, **params):
+        if action == 'compare':
+            compared.append(params['fromrev'])
+            if params['fromrev'] == 404:
+                raise mwapi.errors.APIError('nosuchrevid', 'There is no revision with ID 404.', None)
+            return compares[params['fromrev']]
+        revids = [int(rev_id) for rev_id in params['revids'].split('|')]
+        return {'query': {'pages': {'1332702': {'revisions': [{'revid': rev_id, 'timestamp': timestamps[rev_id]}
+                                                              for rev_id in revids]}}}}
+
+    mock_mwapi_session.side_effect = mwapi_get
+    engine = create_engine('sqlite://')
+    orm_models.edits_display.__table__.create(engine)
+    display_store = DisplayDataStore(sessionmaker(bind=engine)())
+    expected = display_data['display_data_ar_2.json']
+
+    assert get_display_data_batched([32932453, 404], 'ar', display_store=display_store)[0] == expected[0]
+    assert sorted(compared) == [404, 32932453]
+    # the stored revision comes back from the store as it was fetched, the deleted one is asked for again
+    assert get_display_data_batched([32745075, 32932453, 404], 'ar', display_store=display_store)[:2] == expected[::-1]
+    assert sorted(compared) == [404, 404, 32745075, 32932453]
+    assert sorted(display_store.get_many('ar', [32932453, 32745075, 404])) == [32745075, 32932453]
+    assert display_store.get_many('fa', [32932453]) == {}
+
+
+@patch('gratsample.sample_thankees_revision_utils.get_quality_edits_of_users')
+@patch('mwapi.Session.get')
+def test_refresh_revisions_only_fetches_revisions_not_in_the_store(mock_mwapi_session, mock_quality_edits,
+                                                                  display_data, mwapi_responses):
+    timestamps = {32745075: '2019-01-22T17:39:27Z', 30699278: '2018-09-23T17:55:24Z'}
+    compared = []
+
+    def mwapi_get(action, **params):
+        if action == 'compare':
+            compared.append(params['fromrev'])
+            return mwapi_responses['r3.json']
+        revids = [int(rev_id) for rev_id in params['revids'].split('|')]
+        return {'query': {'pages': {'1332702': {'revisions': [{'revid': rev_id, 'timestamp': timestamps[rev_id]}
+                                                              for rev_id in revids]}}}}
+
+    mock_mwapi_session.side_effect = mwapi_get
+    mock_quality_edits.return_value = pd.DataFrame({'rev_id': [32932453, 32745075], 'lang': 'ar'})
+    engine = create_engine('sqlite://')
+    orm_models.edits_display.__table__.create(engine)
+    display_store = DisplayDataStore(sessionmaker(bind=engine)())
+    expected = display_data['display_data_ar_2.json']
+    display_store.put_many('ar', [32932453], expected[:1])
+
+    assert refresh_revisions([7], 'ar', 'con', display_store=display_store) == expected
+    assert compared == [32745075]
+
+
+@patch('gratsample.sample_thankees_revision_utils.ores_quality_getter')
+@patch('gratsample.sample_thankees_revision_utils.get_all_users_revs')
+def test_num_quality_revisions_by_namespace_scores_once(mock_revs, mock_ores, tmp_path, monkeypatch):
+    monkeypatch.setattr(cached_df, 'CACHE_ROOT', str(tmp_path))
+    revs = pd.DataFrame({'user_id': 7, 'rev_id': [1, 2, 3, 4, 5], 'page_namespace': [0, 1, 2, 0, 4], 'lang': 'fa'})
+    mock_revs.side_effect = lambda refresh_users, lang, wmf_con, end_date: revs.copy()
+    mock_ores.side_effect = lambda rev_ids, lang: pd.DataFrame({'rev_id': rev_ids, 'lang': lang,
+                                                                'quality_enough': [rev_id != 4 for rev_id in rev_ids]})
+    namespace_fns = [namespace_all, namespace_nontalk, namespace_mainonly]
+
+    assert num_quality_revisions_by_namespace(7, 'fa', namespace_fns, wmf_con='con') == [4, 3, 1]
+    assert mock_revs.call_count == 1 and mock_ores.call_count == 1
+    assert [num_quality_revisions(7, 'fa', 'con', namespace_fn=fn) for fn in namespace_fns] == [4, 3, 1]
+
+
+def compare_edit_window_paths(user_ts_lists, monkeypatch):
+    """the old add_edits_fn/add_edits_fn_by_week calls and both add_edit_features paths on the same edits"""
+    treatment_date = dt(2019, 3, 1)
+    observation_start_date, experiment_end_date = treatment_date - td(days=90), treatment_date + td(days=90)
+    monkeypatch.setattr(sample_thankees, 'langs', sorted(set(lang for lang, _ in user_ts_lists)), raising=False)
+
+    def fake_edits(lang, user_id, wmf_con, start_date, end_date):
+        return pd.DataFrame({'rev_timestamp': [ts for ts in user_ts_lists[(lang, user_id)]
+                                               if start_date <= ts < end_date]})
+
+    df = pd.DataFrame({'lang': [lang for lang, _ in user_ts_lists], 'user_id': [user_id for _, user_id in user_ts_lists]})
+    old = df
+    for col_name, fn, start_date, end_date in (
+            ('num_edits_90_pre_treatment', len, observation_start_date, treatment_date),
+            ('num_edits_90_post_treatment', len, treatment_date, experiment_end_date),
+            ('num_labor_hours_90_pre_treatment', calc_labour_hours, observation_start_date, treatment_date),
+            ('num_labor_hours_90_post_treatment', calc_labour_hours, treatment_date, experiment_end_date)):
+        old = sample_thankees.add_edits_fn(old, col_name, None, fn, edit_getter_fn=fake_edits,
+                                           start_date=start_date, end_date=end_date)
+    for col_name, fn in (('num_edits_90_post_treatment', len),
+                         ('num_labor_hours_90_post_treatment', calc_labour_hours)):
+        old = sample_thankees.add_edits_fn_by_week(old, col_name, None, fn, edit_getter_fn=fake_edits,
+                                                   start_date=treatment_date, end_date=experiment_end_date)
+
+    edit_window_feature = sample_thankees.edit_window_feature
+    features = [
+        edit_window_feature('num_edits_90_pre_treatment', len, observation_start_date, treatment_date),
+        edit_window_feature('num_edits_90_post_treatment', len, treatment_date, experiment_end_date),
+        edit_window_feature('num_labor_hours_90_pre_treatment', calc_labour_hours, observation_start_date,
+                            treatment_date),
+        edit_window_feature('num_labor_hours_90_post_treatment', calc_labour_hours, treatment_date,
+                            experiment_end_date),
+        edit_window_feature('num_edits_90_post_treatment', len, treatment_date, experiment_end_date, by_week=True),
+        edit_window_feature('num_labor_hours_90_post_treatment', calc_labour_hours, treatment_date,
+                            experiment_end_date, by_week=True)]
+    vectorized = sample_thankees.add_edit_features(df, features, None, edit_getter_fn=fake_edits)
+    pd.testing.assert_frame_equal(vectorized, old)
+    with monkeypatch.context() as per_user_only:
+        per_user_only.setattr(sample_thankees, 'VECTORIZED_TIMESTAMP_LIST_FNS', {})
+        per_user = sample_thankees.add_edit_features(df, features, None, edit_getter_fn=fake_edits)
+    pd.testing.assert_frame_equal(per_user, old)
+    return old
+
+
+def test_add_edit_features_matches_add_edits_fn(monkeypatch):
+    rng = random.Random(1854)
+    user_ts_lists = {}
+    for lang in ('de', 'fa'):
+        for user_id in range(40):
+            ts = dt(2019, 3, 1) - td(days=100) + td(seconds=rng.randint(0, 180 * 86400))
+            ts_list = []
+            for _ in range(rng.choice([0, 1, 3, 20, 80])):
+                ts += td(seconds=rng.choice([30, 600, 3599, 3600, 7200, int(86400 * rng.random())]))
+                ts_list.append(ts)
+            user_ts_lists[(lang, user_id)] = ts_list
+    old = compare_edit_window_paths(user_ts_lists, monkeypatch)
+    assert old['num_labor_hours_90_post_treatment'].dtype == float
+
+    # only single-edit sessions, calc_labour_hours counts those in ints
+    singles = {('de', user_id): [dt(2019, 3, 1) + td(days=8, hours=2 * i) for i in range(user_id % 4)]
+               for user_id in range(10)}
+    old = compare_edit_window_paths(singles, monkeypatch)
+    assert old['num_labor_hours_90_post_treatment'].dtype == np.int64
+    assert old['num_labor_hours_90_post_treatment_week_1'].dtype == np.int64
@@ -0,0 +1,107 @@
+from datetime import datetime as dt, timedelta as td
+
+import pandas as pd
+
+from gratsample import sample_thankees
+from gratsample.wikipedia_helpers import to_wmftimestamp, from_wmftimestamp, decode_or_nan
+
+START_DATE = dt(2019, 1, 1)
+END_DATE = dt(2019, 3, 1)
+
+
+def to_table(wiki_dbs, lang, table, df):
+    with wiki_dbs.engine(lang).begin() as con:
+        df.to_sql(table, con, index=False)
+
+
+def test_thanks_and_total_edits_count_only_inside_the_window(wiki_dbs, cache_root, monkeypatch):
+    monkeypatch.setattr(sample_thankees, 'langs', ['fa'], raising=False)
+    second = td(seconds=1)
+    # on the bounds counts, a second outside them doesn't
+    window_edges = [START_DATE - second, START_DATE, END_DATE, END_DATE + second]
+    to_table(wiki_dbs, 'fa', 'user', pd.DataFrame({'user_id': [1, 2, 3], 'user_name': ['Ali Reza', 'Sara', 'Nima']}))
+    to_table(wiki_dbs, 'fa', 'logging_logindex', pd.DataFrame({
+        'log_timestamp': [to_wmftimestamp(ts) for ts in window_edges] + [to_wmftimestamp(START_DATE + td(days=3))],
+        'log_title': ['Ali_Reza'] * 4 + ['Sara'],
+        'log_action': 'thank',
+        'log_user_text': 'Nima'}))
+    to_table(wiki_dbs, 'fa', 'revision_userindex', pd.DataFrame({
+        'rev_user': 1, 'rev_timestamp': [to_wmftimestamp(ts) for ts in window_edges]}))
+
+    df = pd.DataFrame({'lang': 'fa', 'user_id': [1, 2, 3], 'user_name': ['Ali Reza', 'Sara', 'Nima']})
+    df = sample_thankees.add_thanks(df, START_DATE, END_DATE, 'num_prev_thanks', wiki_dbs)
+    assert list(df['num_prev_thanks']) == [2, 1, 0]
+    thanks = sample_thankees.get_thanks_thanking_user('fa', 'Ali Reza', START_DATE, END_DATE, wiki_dbs)
+    assert list(thanks['thank_timestamp']) == [START_DATE, END_DATE]
+    assert list(thanks['sender_id']) == [3, 3]
+
+    total_edits = sample_thankees.get_total_user_edits('fa', 1, START_DATE, END_DATE, wiki_dbs)
+    assert total_edits['edits_pre_treatment'][0] == 2
+
+
+def test_disablemail_lookups_are_chunked_and_cache_every_user(wiki_dbs, cache_root, monkeypatch):
+    monkeypatch.setattr(sample_thankees, 'langs', ['de'], raising=False)
+    to_table(wiki_dbs, 'de', 'user_properties', pd.DataFrame({'up_user': [2, 5, 5], 'up_value': '1',
+                                                              'up_property': ['disablemail', 'disablemail',
+                                                                              'gender']}))
+    user_ids = list(range(1, 8))
+    props = sample_thankees.get_users_disablemail_properties('de', user_ids, wiki_dbs, chunk_size=3)
+    assert sorted(props['up_user']) == [2, 5]
+
+    # every user is cached, the ones without a row too, so nothing goes to the wiki again
+    with wiki_dbs.engine('de').begin() as con:
+        con.exec_driver_sql('drop table user_properties')
+    cached = sample_thankees.get_user_disablemail_properties.get_many([('de', user_id, wiki_dbs)
+                                                                       for user_id in user_ids])
+    assert [len(user_df) for user_df in cached] == [0, 1, 0, 0, 1, 0, 0]
+    df = sample_thankees.add_has_email_currently(pd.DataFrame({'lang': 'de', 'user_id': user_ids}), wiki_dbs)
+    assert list(df['has_email']) == [True, False, True, True, False, True, True]
+
+
+def per_user_spans(wiki_dbs, lang, start_date, end_date):
+    """the first and last edits the way get_users_edit_spans used to find them, two subqueries per user"""
+    span_sql = '''select user_id, user_name, user_registration,
+       (select min(rev_timestamp) from revision_userindex where rev_user=user_id
+        and rev_timestamp >= '{start_date}' and rev_timestamp <= '{end_date}') as first_edit,
+       (select max(rev_timestamp) from revision_userindex where rev_user=user_id
+        and rev_timestamp >= '{start_date}' and rev_timestamp <= '{end_date}') as last_edit
+from user order by user_id'''.format(start_date=to_wmftimestamp(start_date), end_date=to_wmftimestamp(end_date))
+    with wiki_dbs.connect(lang) as con:
+        span_df = pd.read_sql(span_sql, con)
+    for col_name in ('user_registration', 'first_edit', 'last_edit'):
+        span_df[col_name] = span_df[col_name].apply(from_wmftimestamp)
+    span_df['user_name'] = span_df['user_name'].apply(decode_or_nan)
+    return span_df
+
+
+def test_chunked_edit_spans_match_the_per_user_query(wiki_dbs, cache_root):
+    user_ids = list(range(1, 26))
+    to_table(wiki_dbs, 'fa', 'user', pd.DataFrame({'user_id': user_ids,
+                                                   'user_name': [f'user {user_id}' for user_id in user_ids],
+                                                   'user_registration': to_wmftimestamp(START_DATE - td(days=30))}))
+    edits = []
+    for user_id in user_ids:
+        if user_id % 6 == 4:
+            continue  # never edited
+        if user_id == 7:
+            # only outside the window
+            edits += [(user_id, START_DATE - td(seconds=1)), (user_id, END_DATE + td(seconds=1))]
+            continue
+        edits += [(user_id, START_DATE + td(days=user_id, hours=hour)) for hour in range(user_id % 3 + 1)]
+    # 9 and 10, 19 and 20 are either side of a chunk boundary
+    edits += [(10, START_DATE), (19, END_DATE), (20, END_DATE + td(days=1))]
+    to_table(wiki_dbs, 'fa', 'revision_userindex', pd.DataFrame({
+        'rev_user': [user_id for user_id, _ in edits], 'rev_timestamp': [to_wmftimestamp(ts) for _, ts in edits]}))
+
+    expected = per_user_spans(wiki_dbs, 'fa', START_DATE, END_DATE)
+    assert list(expected.loc[expected['first_edit'].isnull(), 'user_id']) == [4, 7, 16, 22]
+    with wiki_dbs.connect('fa') as con:
+        users_df = pd.read_sql('select user_id, user_name, user_registration from user order by user_id', con)
+    spans = sample_thankees.fill_edit_spans('fa', users_df.copy(), START_DATE, END_DATE, wiki_dbs, chunk_size=10)
+    pd.testing.assert_frame_equal(spans, expected)
+
+    # a streamed batch of users that starts and ends mid-chunk shares the cached chunks
+    batch_df = users_df.iloc[8:21].copy().reset_index(drop=True)
+    batch_spans = sample_thankees.fill_edit_spans('fa', batch_df, START_DATE, END_DATE, wiki_dbs, chunk_size=10)
+    pd.testing.assert_frame_equal(batch_spans, expected.iloc[8:21].reset_index(drop=True))
+    assert sample_thankees.get_edit_spans_chunk.cache_stats()['disk_hits'] == 3
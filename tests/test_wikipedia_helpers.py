@@ -0,0 +1,104 @@
+import os
+import random
+import time
+from datetime import datetime as dt, timedelta as td
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from gratsample.wikipedia_helpers import calc_labour_hours, make_sessions, ts_in_week, user_edit_stats, \
+    stream_sql_to_parquet, read_spilled, run_per_lang
+
+
+def test_user_edit_stats_matches_per_user_functions():
+    rng = random.Random(1854)
+    week_start_date = dt(2019, 3, 1)
+    user_ts_lists = {}
+    for user_id in range(200):
+        ts = week_start_date - td(days=3) + td(seconds=rng.randint(0, 10 * 86400))
+        ts_list = []
+        for _ in range(rng.choice([0, 1, 2, 7, 60, 300])):
+            # gaps either side of the hour cutoff, and some long runs that make sessions over a day
+            ts += td(seconds=rng.choice([30, 600, 3599, 3600, 7200, int(86400 * rng.random())]))
+            ts_list.append(ts)
+        user_ts_lists[user_id] = ts_list
+
+    user_ids = np.repeat(list(user_ts_lists), [len(ts_list) for ts_list in user_ts_lists.values()])
+    timestamps = [ts for ts_list in user_ts_lists.values() for ts in ts_list]
+    stats = user_edit_stats(user_ids, timestamps, week_start_date=week_start_date)
+
+    for user_id, ts_list in user_ts_lists.items():
+        if not ts_list:
+            assert user_id not in stats.index
+            continue
+        user_stats = stats.loc[user_id]
+        assert user_stats['num_edits'] == len(ts_list)
+        assert user_stats['num_sessions'] == len(make_sessions(ts_list))
+        # exactly, not approximately
+        assert user_stats['labour_hours'] == calc_labour_hours(ts_list)
+        for week_number in range(1, 13):
+            week_ts_list = ts_in_week(ts_list, week_start_date + td(days=7 * week_number),
+                                      week_start_date + td(days=7 * (week_number + 1)))
+            assert user_stats[f'num_edits_week_{week_number}'] == len(week_ts_list)
+            assert user_stats[f'labour_hours_week_{week_number}'] == calc_labour_hours(week_ts_list)
+
+
+def test_stream_sql_to_parquet_filters_each_chunk(tmp_path):
+    con = create_engine(f'sqlite:///{tmp_path}/wiki.db')
+    pd.DataFrame({'user_id': np.arange(1000), 'user_name': [f'user{i}'.encode('utf-8') for i in range(1000)]}) \
+        .to_sql('user', con, index=False)
+    chunk_sizes = []
+
+    def decode_and_filter(chunk_df):
+        chunk_sizes.append(len(chunk_df))
+        chunk_df['user_name'] = chunk_df['user_name'].str.decode('utf-8')
+        return chunk_df[chunk_df['user_id'] % 10 == 0]
+
+    spill_dir = str(tmp_path / 'lang=fa')
+    with con.connect() as stream_con:
+        run_dir = stream_sql_to_parquet('select user_id, user_name from user order by user_id', stream_con, spill_dir,
+                                        chunksize=300, chunk_fn=decode_and_filter)
+    assert chunk_sizes == [300, 300, 300, 100]
+    df = read_spilled(run_dir)
+    assert list(df['user_id']) == list(range(0, 1000, 10))
+    assert df['user_name'][1] == 'user10'
+
+
+def test_runs_spilling_to_the_same_dir_keep_their_own_parts(tmp_path):
+    con = create_engine(f'sqlite:///{tmp_path}/wiki.db')
+    pd.DataFrame({'user_id': np.arange(100)}).to_sql('user', con, index=False)
+    spill_dir = str(tmp_path / 'lang=fa')
+    user_sql = 'select user_id from user where user_id % 2 = {parity} order by user_id'
+    run_dirs = {}
+
+    def start_the_odd_run(chunk_df):
+        # the odd run starts and finishes while the even one is between chunks
+        if 'odd' not in run_dirs:
+            with con.connect() as odd_con:
+                run_dirs['odd'] = stream_sql_to_parquet(user_sql.format(parity=1), odd_con, spill_dir, chunksize=20)
+        return chunk_df
+
+    with con.connect() as even_con:
+        run_dirs['even'] = stream_sql_to_parquet(user_sql.format(parity=0), even_con, spill_dir, chunksize=20,
+                                                 chunk_fn=start_the_odd_run)
+    assert run_dirs['even'] != run_dirs['odd']
+    assert list(read_spilled(run_dirs['odd'], remove=True)['user_id']) == list(range(1, 100, 2))
+    assert list(read_spilled(run_dirs['even'], remove=True)['user_id']) == list(range(0, 100, 2))
+    assert os.listdir(spill_dir) == []
+
+
+def test_run_per_lang_keeps_lang_order(capsys):
+    lang_delays = {'ar': 0.3, 'de': 0.1, 'fa': 0.2, 'pl': 0}
+
+    def lang_frame(lang):
+        time.sleep(lang_delays[lang])
+        return pd.DataFrame({'lang': [lang] * 2, 'user_id': [1, 2]})
+
+    start = time.time()
+    parallel = pd.concat(run_per_lang(lang_frame, lang_delays.keys(), 'stage', workers=4))
+    assert time.time() - start < 0.55
+    serial = pd.concat(run_per_lang(lang_frame, lang_delays.keys(), 'stage', workers=1))
+    assert parallel.equals(serial)
+    assert list(parallel['lang']) == ['ar', 'ar', 'de', 'de', 'fa', 'fa', 'pl', 'pl']
+    assert 'stage fa: 0.2s' in capsys.readouterr().out